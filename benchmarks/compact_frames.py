@@ -0,0 +1,44 @@
+""" Report the memory saved by the compact query mode on a large result.
+
+Run against a populated database, e.g. a year of GXP level demand:
+
+    python benchmarks/compact_frames.py --begin 01/01/2014 --end 31/12/2014
+"""
+
+import argparse
+import time
+
+from lode.database.queries import query_nodal_demand
+
+
+def memory_mb(df):
+    """ Deep memory usage of a DataFrame in MB, including the strings """
+    return df.memory_usage(deep=True).sum() / 1024. ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--begin", default="01/01/2014")
+    parser.add_argument("--end", default="31/12/2014")
+    args = parser.parse_args()
+
+    results = []
+    for label, options in (("default", {}),
+                           ("compact", {"compact": True}),
+                           ("compact float32", {"compact": True,
+                                                "float32": True})):
+        begin = time.time()
+        df = query_nodal_demand(begin_date=args.begin, end_date=args.end,
+                                **options)
+        results.append((label, memory_mb(df), time.time() - begin))
+
+    print "Rows: %s" % len(df)
+    print "Dtypes:\n%s" % df.dtypes.to_string()
+    baseline = results[0][1]
+    for label, size, elapsed in results:
+        print "%-16s %8.1f MB  %5.1fx smaller  %.2fs" % (
+            label, size, baseline / size, elapsed)
+
+
+if __name__ == '__main__':
+    main()
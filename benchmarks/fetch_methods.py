@@ -0,0 +1,54 @@
+""" Compare fetching a large query result with pandas read_sql against the
+COPY based fetch path of query_to_df.
+
+Run against a populated database, e.g. a year of GXP level demand:
+
+    python benchmarks/fetch_methods.py --database nodal_database \\
+        --table nodal_demand_2014
+"""
+
+import argparse
+import time
+
+from lode.database.utilities import query_to_df
+
+
+def time_fetch(database, sql, fetch_method, repeats):
+    """ Return the best wall clock time of a number of runs as well as the
+    final DataFrame fetched
+    """
+    best = None
+    for _ in range(repeats):
+        begin = time.time()
+        df = query_to_df(database, sql, fetch_method=fetch_method)
+        elapsed = time.time() - begin
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--database", default="nodal_database")
+    parser.add_argument("--table", default="nodal_demand_2014")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    sql = "SELECT * FROM %s" % args.table
+    if args.limit:
+        sql += " LIMIT %s" % args.limit
+
+    read_sql_time, expected = time_fetch(args.database, sql, "read_sql",
+                                         args.repeats)
+    copy_time, result = time_fetch(args.database, sql, "copy", args.repeats)
+
+    print "Rows fetched: %s" % len(result)
+    print "read_sql: %.2fs" % read_sql_time
+    print "copy:     %.2fs" % copy_time
+    print "Speedup:  %.1fx" % (read_sql_time / copy_time)
+    print "Identical frames: %s" % expected.equals(result)
+
+
+if __name__ == '__main__':
+    main()
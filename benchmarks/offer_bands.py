@@ -0,0 +1,58 @@
+""" Compare stack_bands with stacking the offer bands row by row.
+
+Run against a populated database, e.g. a year of energy offers:
+
+    python benchmarks/offer_bands.py --begin 01/01/2014 --end 31/12/2014
+"""
+
+import argparse
+import time
+
+import pandas as pd
+
+from lode.database.queries import query_offer
+from lode.offers import band_slots, stack_bands
+
+
+def stack_rows(offers):
+    """ The bands of each offer appended one row at a time """
+    slots = band_slots(offers.columns)
+    rows = []
+    for _, offer in offers.iterrows():
+        for slot in slots:
+            quantity = offer[slot.columns["quantity"]]
+            if quantity > 0:
+                rows.append((offer["station"], offer["trading_date"],
+                             offer["trading_period"], slot.band,
+                             offer[slot.columns["price"]], quantity))
+    return pd.DataFrame(rows, columns=["station", "trading_date",
+                                       "trading_period", "band", "price",
+                                       "quantity"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--begin", default="01/01/2014")
+    parser.add_argument("--end", default="31/12/2014")
+    args = parser.parse_args()
+
+    offers = query_offer("Energy", begin_date=args.begin, end_date=args.end,
+                         as_offerframe=False)
+    print "Offers: %s" % len(offers)
+
+    begin = time.time()
+    stacked = stack_bands(offers)
+    vector_elapsed = time.time() - begin
+    print "stack_bands %8.2fs  %s bands" % (vector_elapsed, len(stacked))
+
+    begin = time.time()
+    looped = stack_rows(offers)
+    loop_elapsed = time.time() - begin
+    print "row by row  %8.2fs  %5.1fx slower" % (
+        loop_elapsed, loop_elapsed / vector_elapsed)
+
+    assert (looped["quantity"].values == stacked["quantity"].values).all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+""" Compare the per row create_timestamp with periods_to_timestamps.
+
+Run against a populated database, e.g. a year of GXP level demand:
+
+    python benchmarks/timestamps.py --begin 01/01/2014 --end 31/12/2014
+"""
+
+import argparse
+import time
+
+from lode.database.queries import query_nodal_demand
+from lode.utilities.util import create_timestamp, periods_to_timestamps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--begin", default="01/01/2014")
+    parser.add_argument("--end", default="31/12/2014")
+    args = parser.parse_args()
+
+    df = query_nodal_demand(begin_date=args.begin, end_date=args.end,
+                            columns=["trading_date", "trading_period"])
+    print "Rows: %s" % len(df)
+
+    begin = time.time()
+    vectorised = periods_to_timestamps(df["trading_date"].values,
+                                       df["trading_period"].values)
+    vector_elapsed = time.time() - begin
+    print "periods_to_timestamps %8.2fs" % vector_elapsed
+
+    begin = time.time()
+    looped = [create_timestamp((d, p)) for d, p in
+              zip(df["trading_date"].values, df["trading_period"].values)]
+    loop_elapsed = time.time() - begin
+    print "create_timestamp      %8.2fs  %5.1fx slower" % (
+        loop_elapsed, loop_elapsed / vector_elapsed)
+
+    assert (vectorised == looped).all()
+
+
+if __name__ == '__main__':
+    main()
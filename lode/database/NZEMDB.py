@@ -2,21 +2,29 @@
 import psycopg2 as pg2
 import pandas.io.sql as psql
 import pandas as pd
-import os
-import shutil
-import glob
 import datetime
 from collections import defaultdict
 from dateutil.parser import parse
 
 from lode.utilities.util import (parse_date, load_config,
-                                 get_file_year_str, meta_path)
-
-from lode.database.helpers import (check_csv_headers,
-                                   strip_fileendings)
+                                 get_file_year_str)
+
+from lode.database.utilities import pooled_connection, read_meta
+from lode.database.cache import invalidate_shard
+from lode.database.partitions import (create_partitioned_table,
+                                      ensure_partition)
+from lode.database.indexes import create_indexes
+from lode.database.metadata import load_node_metadata, meta_keys
+from lode.database.loader import (load_folder, summarise, load_columns,
+                                  load_file, unique_keys,
+                                  DEFAULT_SHARD_WORKERS)
+from lode.database.ledger import create_ledger
+from lode.database.rollups import (has_rollups, create_rollup_tables,
+                                   refresh_rollups, last_loaded_key,
+                                   loaded_date_ranges, merge_ranges)
 
 from itertools import izip
-from OfferPandas import Frame
+from lode.offers import stack_bands
 
 
 class NZEMDB(object):
@@ -45,60 +53,66 @@ class NZEMDB(object):
 
         return self
 
-    def insert_to_database(self, query, csvfile, tabname):
+    def insert_to_database(self, csvfile, table, table_name,
+                           on_conflict=None):
+        """ Stream a csv file into a table with COPY FROM STDIN and record
+        it in the load ledger, merging it through a staging table if
+        on_conflict is given, see lode.database.loader.load_file
+        """
+        columns = load_columns(self.db_key, table_name)
+        keys = unique_keys(self.db_key, table_name) if on_conflict else None
+        create_ledger(self.db_key)
         try:
-            self.execute_and_commit_sql(query)
+            return load_file(self.db_key, table, table_name, columns,
+                             csvfile, keys=keys, on_conflict=on_conflict)
         except pg2.IntegrityError as e:
             print "You're trying to add rows which already exist!"
             print e
 
-        except pg2.ProgrammingError as e:
-            print e
-            #print "Going to do some permission editing from a local drive"
-            #print "You're probably running from an external drive if you see"
-            #print "This often"
-            fName = os.path.basename(csvfile)
-            homeName = os.path.expanduser("~/%s" % fName)
-            shutil.copy(csvfile, homeName)
-            os.chmod(homeName, 0644)
-            query = """COPY %s FROM '%s' DELIMITER ',' CSV HEADER;
-                    """ % (tabname, homeName)
-            try:
-                self.execute_and_commit_sql(query)
-            except pg2.IntegrityError as e:
-                print "You're trying to add rows which already exist!"
-                print e
-            except pg2.DataError as e:
-                print e
-                strip_fileendings(homeName)
-                self.execute_and_commit_sql(query)
-
-            os.remove(homeName)
-
-    def insert_from_csv(self, table, csvfile):
+    def insert_from_csv(self, table, csvfile, update_rollups=True,
+                        on_conflict=None):
+        """ Load a csv file into a master table, returning the (begin,
+        end) ranges of the dates loaded or revised if the table has
+        rollups. The rollups are refreshed over each range unless
+        update_rollups is False, e.g. when loading many files at once.
+        Files overlapping rows already loaded are merged with on_conflict
+        "nothing" or "update".
+        """
 
         # Check the Schemas for the split year:
         if self.schemas[table]['split_by_year']:
             year = get_file_year_str(csvfile)
             table_name = "%s_%s" % (table, year)
+
+            # New years need a partition before they can be loaded
+            if self.schemas[table].get("partitioned"):
+                ensure_partition(self.db_key, table, year)
         else:
+            year = None
             table_name = table
 
-        table_headers = self.get_column_names(table_name)
-        insert_headers = ",".join([x[0] for x in
-                                   table_headers if "key" not in x[0]])
-        tabname = "%s(%s)" % (table_name, insert_headers)
+        rollups = has_rollups(self.db_key, table)
+        if rollups:
+            key_column = "%s_key" % table
+            last_key = last_loaded_key(self.db_key, table_name, key_column)
 
-        existing_headers = check_csv_headers(csvfile, table_headers)
+        counts = self.insert_to_database(csvfile, table, table_name,
+                                         on_conflict=on_conflict)
 
-        if existing_headers:
-            query = """COPY %s FROM '%s' DELIMITER ',' CSV HEADER;
-                    """ % (tabname, csvfile)
-        else:
-            query = """COPY %s FROM '%s' DELIMITER ',' CSV;
-                    """ % (tabname, csvfile)
+        # Cached query results for this shard are now out of date
+        invalidate_shard(self.db_key, table, year)
+
+        if rollups:
+            ranges = loaded_date_ranges(self.db_key, table_name,
+                                        key_column, last_key)
 
-        self.insert_to_database(query, csvfile, tabname)
+            # Updated rows keep their keys so their dates are added apart
+            if counts and counts.revised:
+                ranges = merge_ranges(ranges + [counts.revised])
+            if update_rollups:
+                for begin, end in ranges:
+                    refresh_rollups(self.db_key, table, begin, end)
+            return ranges
 
     def strip_fileendings(self, fName):
         print "Attempting to strip the shitty endings"
@@ -113,13 +127,13 @@ class NZEMDB(object):
 
     def execute_and_commit_sql(self, sql):
 
-        with pg2.connect(self.conn_string) as conn:
+        with pooled_connection(self.db_key) as conn:
             with conn.cursor() as curs:
                 curs.execute(sql)
                 conn.commit()
 
     def ex_sql_and_fetch(self, sql):
-        with pg2.connect(self.conn_string) as conn:
+        with pooled_connection(self.db_key) as conn:
             with conn.cursor() as curs:
                 curs.execute(sql)
                 records = curs.fetchall()
@@ -136,16 +150,29 @@ class NZEMDB(object):
     def create_all_tables(self):
 
         for key in self.schemas.keys():
-            with open(self.schemas[key]["schema_location"], 'rb') as f:
-                sql = f.read()
-
-            sql = """%s""" % sql
-            if self.schemas[key]["split_by_year"]:
-                for year in self.schemas[key]["split_years"]:
-                    sql_year = sql % year
-                    self.execute_and_commit_sql(sql_year)
+            if self.schemas[key].get("partitioned"):
+                create_partitioned_table(self.db_key, key)
+
             else:
-                self.execute_and_commit_sql(sql)
+                with open(self.schemas[key]["schema_location"], 'rb') as f:
+                    sql = f.read()
+
+                sql = """%s""" % sql
+                if self.schemas[key]["split_by_year"]:
+                    for year in self.schemas[key]["split_years"]:
+                        sql_year = sql % year
+                        self.execute_and_commit_sql(sql_year)
+                else:
+                    self.execute_and_commit_sql(sql)
+
+            # Secondary indexes declared in the config
+            create_indexes(self.db_key, key)
+
+            if has_rollups(self.db_key, key):
+                create_rollup_tables(self.db_key, key)
+
+        load_node_metadata(self.db_key)
+        create_ledger(self.db_key)
 
     def drop_table(self, table):
         sql = """DROP TABLE %s""" % table
@@ -160,16 +187,24 @@ class NZEMDB(object):
     def query_to_df(self, sql):
         """ Use a Generator here as we're Lazy """
 
-        with pg2.connect(self.conn_string) as conn:
+        with pooled_connection(self.db_key) as conn:
             return psql.read_sql(sql, conn)
 
-    def insert_many_csv(self, table, folder):
+    def insert_many_csv(self, table, folder, workers=None,
+                        shard_workers=DEFAULT_SHARD_WORKERS, resume=True,
+                        on_conflict=None):
+        """ Load every csv file in a folder, grouped by year shard and in
+        parallel, skipping those loaded by an earlier run unless resume is
+        False. Files overlapping rows already loaded are merged with
+        on_conflict "nothing" or "update". Returns a LoadResult for each
+        file, see lode.database.loader
+        """
+        results = load_folder(self.db_key, table, folder, workers=workers,
+                              shard_workers=shard_workers, resume=resume,
+                              on_conflict=on_conflict)
+        print summarise(results)
 
-        allcsv_files = glob.glob(folder + "/*.csv")
-        for f in allcsv_files:
-            print "Attempting to load %s" % f
-            self.insert_from_csv(table, f)
-            print "%s succesfully loaded to %s" % (f, table)
+        return results
 
     def list_all_tables(self):
         return self.ex_sql_and_fetch("SELECT * FROM pg_catalog.pg_tables")
@@ -235,10 +270,9 @@ class NZEMDB(object):
                                      q in completed_queries),
                                     ignore_index=True)
 
-        # Optionally modify to an offer frame.
+        # Optionally stack the offer bands, one row per band
         if as_offerframe:
-            df = Frame(all_information)
-            return df.modify_frame()
+            return stack_bands(all_information)
 
         return all_information
 
@@ -294,11 +328,10 @@ class NZEMDB(object):
                            ignore_index=True)
 
         if apply_meta:
-            meta_info = pd.read_csv(meta_path)
-            demand = demand.merge(meta_info, left_on="node", right_on="Node")
+            demand = demand.merge(read_meta(), on="node")
 
             if meta_group and meta_agg:
-                grouped = demand.groupby(meta_group)
+                grouped = demand.groupby(meta_keys(meta_group))
                 aggregate = grouped.aggregate(meta_agg)
 
                 return aggregate
@@ -346,8 +379,7 @@ class NZEMDB(object):
                            ignore_index=True)
 
         if apply_meta:
-            meta_info = pd.read_csv(meta_path)
-            prices = prices.merge(meta_info, left_on="node", right_on="Node")
+            prices = prices.merge(read_meta(), on="node")
 
         return prices
 
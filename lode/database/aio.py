@@ -0,0 +1,213 @@
+"""
+Non blocking versions of the query interface for use from event driven
+servers, e.g. dashboards, where a blocking multi shard query would stall
+every other request.
+
+Each function returns a concurrent.futures.Future immediately instead of a
+DataFrame. The queries are run on a process wide pool of worker threads
+using the pooled connections of lode.database.utilities, so many requests
+can overlap their database I/O in a single process while the number of
+open connections stays bounded by "pool_max_size". The worker pool size is
+set by the "aio_max_workers" key of the configuration file.
+
+The futures can be awaited from most event loops, for example:
+
+    # asyncio (Python 3)
+    df = await asyncio.wrap_future(aio.query_nodal_price(...))
+
+    # tornado
+    df = yield aio.query_nodal_price(...)
+
+    # blocking
+    df = aio.query_nodal_price(...).result()
+
+Python 2 has no asyncio, and psycopg2 has no native async pool, so worker
+threads are used rather than an async driver. psycopg2 releases the GIL
+while waiting on the server, so the threads overlap their I/O.
+"""
+
+import os
+import threading
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    raise ImportError('lode.database.aio requires the futures package on '
+                      'Python 2, pip install futures')
+
+from lode.utilities.util import load_config
+from lode.database import utilities
+from lode.database import queries as sync_queries
+
+DEFAULT_AIO_MAX_WORKERS = 32
+
+# Process wide executors, keyed by the process id like the connection pools
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the worker thread pool of this process, creating it on first use
+
+    Returns:
+    --------
+    executor: ThreadPoolExecutor which the queries are run on
+    """
+    pid = os.getpid()
+    executor = _executors.get(pid)
+    if executor is not None:
+        return executor
+
+    with _executors_lock:
+        if pid not in _executors:
+            max_workers = load_config().get("aio_max_workers",
+                                            DEFAULT_AIO_MAX_WORKERS)
+            _executors[pid] = ThreadPoolExecutor(max_workers)
+
+        return _executors[pid]
+
+
+def close_executor(wait=True):
+    """
+    Shut down the worker threads of this process, e.g. when stopping a
+    server. A new pool is created if further queries are submitted.
+    """
+    with _executors_lock:
+        executor = _executors.pop(os.getpid(), None)
+
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def gather(futures, combine=list):
+    """
+    Combine several futures into a single future without blocking a worker
+    thread to wait for them
+
+    Parameters:
+    -----------
+    futures: List of futures
+    combine: Function applied to the list of results, in the same order as
+             the futures, to give the result of the combined future
+
+    Returns:
+    --------
+    Future: Resolves with the combined result once every future has
+            finished, or with the first error raised by any of them
+    """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+
+        failed = [f for f in futures if f.exception() is not None]
+        try:
+            if failed:
+                combined.set_exception(failed[0].exception())
+            else:
+                combined.set_result(combine([f.result() for f in futures]))
+        except Exception as e:
+            combined.set_exception(e)
+
+    if not futures:
+        combined.set_result(combine([]))
+
+    for future in futures:
+        future.add_done_callback(done)
+
+    return combined
+
+
+def query_to_df(db, sql, fetch_method="auto"):
+    """
+    Run a single SQL query in the background, see
+    lode.database.utilities.query_to_df
+
+    Returns:
+    --------
+    Future: Resolves with the DataFrame of the query result
+    """
+    return get_executor().submit(utilities.query_to_df, db, sql,
+                                 fetch_method)
+
+
+def multi_query(db, queries, fetch_method="auto", compact=False,
+                float32=False):
+    """
+    Run the per shard SQL queries concurrently in the background and
+    concatenate the results in query order, see
+    lode.database.utilities.multi_query
+
+    Parameters:
+    -----------
+    db: The Database to run the queries on (string)
+    queries: Iterable object containing the SQL queries as strings or
+             (sql, params) pairs
+    fetch_method: How to fetch the results, see query_to_df
+    compact: Whether to shrink the column types, see compact_frame
+    float32: Whether to also store the floating point columns as float32
+
+    Returns:
+    --------
+    Future: Resolves with the concatenated DataFrame
+    """
+    executor = get_executor()
+
+    def fetch(sql):
+        df = utilities.query_to_df(db, sql, fetch_method)
+        return utilities.compact_frame(df, float32) if compact else df
+
+    def combine(frames):
+        return utilities.concat_frames(utilities.share_categories(frames))
+
+    return gather([executor.submit(fetch, sql) for sql in queries], combine)
+
+
+def query_nodal_price(*args, **kwargs):
+    """
+    Query the nodal prices in the background, takes the same filters as
+    lode.database.queries.query_nodal_price
+
+    Returns:
+    --------
+    Future: Resolves with the DataFrame of nodal prices
+    """
+    return get_executor().submit(sync_queries.query_nodal_price, *args,
+                                 **kwargs)
+
+
+def query_nodal_demand(*args, **kwargs):
+    """
+    Query the nodal demand in the background, takes the same filters as
+    lode.database.queries.query_nodal_demand
+
+    Returns:
+    --------
+    Future: Resolves with the DataFrame of nodal demand
+    """
+    return get_executor().submit(sync_queries.query_nodal_demand, *args,
+                                 **kwargs)
+
+
+def query_offer(*args, **kwargs):
+    """
+    Query the offers in the background, takes the same filters as
+    lode.database.queries.query_offer
+
+    Returns:
+    --------
+    Future: Resolves with the DataFrame of the offers, band level if
+            as_offerframe
+    """
+    return get_executor().submit(sync_queries.query_offer, *args,
+                                 **kwargs)
+
+
+if __name__ == '__main__':
+    pass
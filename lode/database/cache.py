@@ -0,0 +1,198 @@
+"""
+A persistent, on disk cache of query results so that repeatedly running the
+same query does not need to hit the database each time.
+
+Results are stored as Parquet files (a columnar binary format, requires
+pyarrow) alongside a small JSON index which records the size, last use and
+the (table, year) shards each result was read from. The cache is kept below
+a disk budget by evicting the least recently used results and an entry is
+invalidated whenever new data is loaded into any of the shards it touches.
+
+The location and budget are set by the "query_cache_folder" and
+"query_cache_max_bytes" keys of the configuration file.
+"""
+
+import os
+import re
+import time
+import hashlib
+import threading
+import warnings
+import simplejson
+import pandas as pd
+
+from lode.utilities.util import load_config
+
+DEFAULT_CACHE_FOLDER = os.path.expanduser("~/.lode/query_cache")
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Matches the tables within an SQL query, capturing the year of the yearly
+# shards, e.g. nodal_prices_2014, and no year for a partitioned master table
+# or a joined table such as node_metadata
+shard_pattern = re.compile(
+    r"\b(?:FROM|JOIN)\s+([a-z_]+?)(?:_(\d{4}))?\b", re.IGNORECASE)
+
+_cache_lock = threading.Lock()
+
+
+class QueryCache(object):
+    """
+    On disk LRU cache of query results keyed on the database and the set of
+    SQL queries which produced them.
+
+    Parameters:
+    -----------
+    folder: Directory to store the cache in
+    max_bytes: Disk budget for the cached results
+    """
+
+    def __init__(self, folder=None, max_bytes=None):
+        super(QueryCache, self).__init__()
+
+        # The config is only needed for the settings not passed in
+        if folder is None or max_bytes is None:
+            config = load_config()
+            folder = folder or config.get("query_cache_folder",
+                                          DEFAULT_CACHE_FOLDER)
+            max_bytes = max_bytes or config.get("query_cache_max_bytes",
+                                                DEFAULT_CACHE_MAX_BYTES)
+
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.folder, "index.json")
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def key(self, db, queries):
+        """ Hash the database and queries, the order the per shard queries
+        are run in does not change the result so it is ignored
+        """
+        normalised = simplejson.dumps([db, sorted(set(query_text(q)
+                                                      for q in queries))])
+        return hashlib.sha1(normalised).hexdigest()
+
+    def get(self, db, queries):
+        """ Return the cached DataFrame or None if it is not cached """
+        key = self.key(db, queries)
+        with _cache_lock:
+            index = self._read_index()
+            if key not in index or not os.path.exists(self._path(key)):
+                return None
+
+            index[key]["last_used"] = time.time()
+            self._write_index(index)
+
+        return pd.read_parquet(self._path(key), engine="pyarrow")
+
+    def put(self, db, queries, df):
+        """ Store a DataFrame in the cache, evicting old results if the disk
+        budget is exceeded
+        """
+        key = self.key(db, queries)
+        shards = sorted(set([(db, t.lower(), int(y) if y else None)
+                             for q in queries
+                             for t, y in shard_pattern.findall(
+                                 query_text(q))]))
+
+        try:
+            df.to_parquet(self._path(key), engine="pyarrow")
+        except Exception as e:
+            warnings.warn("Unable to cache query result: %s" % e)
+            return
+
+        with _cache_lock:
+            index = self._read_index()
+            index[key] = {"size": os.path.getsize(self._path(key)),
+                          "last_used": time.time(),
+                          "shards": shards}
+            self._evict(index)
+            self._write_index(index)
+
+    def invalidate(self, db, table, year=None):
+        """ Remove every cached result which read from a table shard, if the
+        year is None all of the shards of the table are invalidated. Results
+        read from a partitioned master table are invalidated for any year.
+        """
+        with _cache_lock:
+            index = self._read_index()
+            for key, entry in index.items():
+                for shard_db, shard_table, shard_year in entry["shards"]:
+                    if (shard_db == db and shard_table == table.lower() and
+                            (year is None or shard_year is None or
+                             shard_year == int(year))):
+                        self._remove(index, key)
+                        break
+            self._write_index(index)
+
+    def clear(self):
+        """ Remove every cached result """
+        with _cache_lock:
+            index = self._read_index()
+            for key in index.keys():
+                self._remove(index, key)
+            self._write_index(index)
+
+    def _evict(self, index):
+        total = sum(entry["size"] for entry in index.itervalues())
+        by_age = sorted(index, key=lambda k: index[k]["last_used"])
+        while total > self.max_bytes and by_age:
+            key = by_age.pop(0)
+            total -= index[key]["size"]
+            self._remove(index, key)
+
+    def _remove(self, index, key):
+        del index[key]
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.folder, "%s.parquet" % key)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+
+        with open(self.index_path, 'rb') as f:
+            return simplejson.load(f)
+
+    def _write_index(self, index):
+        # Write then rename so a reader never sees a partial index
+        temp_path = "%s.%s.tmp" % (self.index_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            simplejson.dump(index, f)
+        os.rename(temp_path, self.index_path)
+
+
+def query_text(query):
+    """ A query as text, an (sql, params) pair is written with its
+    parameters after the SQL
+    """
+    if isinstance(query, basestring):
+        return query
+
+    sql, params = query
+    return "%s -- %s" % (sql, simplejson.dumps(list(params), default=str))
+
+
+def invalidate_shard(db, table, year=None):
+    """
+    Invalidate the cached results which read from a table shard, this should
+    be called whenever new data is loaded into the shard.
+
+    Parameters:
+    -----------
+    db: The database key the table is in
+    table: The master table, e.g. nodal_prices
+    year: The year of the shard, or None for all of them
+    """
+    # Nothing has been cached if the cache was never used
+    folder = load_config().get("query_cache_folder", DEFAULT_CACHE_FOLDER)
+    if not os.path.exists(os.path.join(folder, "index.json")):
+        return
+
+    QueryCache(folder=folder).invalidate(db, table, year)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,318 @@
+"""
+A dense, memory mapped store of the nodal prices for fast slicing by node,
+date and trading period without going through SQL and a pandas pivot.
+
+Each year of nodal_prices is materialised as a (day, trading period, node)
+NumPy array saved as prices_<year>_<build>.npy. The manifest cube_<year>.json
+names the price file of the current build and holds its node order and
+dates, so replacing the manifest swaps the prices and their axes together.
+Every day has 50 trading periods so that daylight saving days fit, periods
+without a price (including periods 49 and 50 on normal days) are NaN.
+
+The arrays are opened with mmap_mode so only the pages which are sliced are
+read from disk. The store lives in the "price_cube_folder" of the
+configuration file and is rebuilt with:
+
+    python -m lode.database.cube --years 2013 2014
+"""
+
+import os
+import glob
+import argparse
+import datetime
+import threading
+import collections
+import simplejson
+import numpy as np
+import pandas as pd
+
+from lode.utilities.util import load_config, parse_date
+from lode.database.utilities import query_to_df
+from lode.database.queries import node_groups
+
+DEFAULT_CUBE_FOLDER = os.path.expanduser("~/.lode/price_cube")
+
+# Enough trading periods for the long day when daylight saving ends
+CUBE_PERIODS = 50
+
+_cube_lock = threading.Lock()
+
+
+def cube_folder():
+    """ The folder the price cube is stored in """
+    return load_config().get("price_cube_folder", DEFAULT_CUBE_FOLDER)
+
+
+def build_price_cube(year, database="nodal_database", folder=None,
+                     dtype=np.float64):
+    """
+    Materialise a year of nodal prices into the memory mapped cube, any
+    existing arrays for the year are replaced once the new ones are built.
+
+    Parameters:
+    -----------
+    year: The year to build
+    database: The database holding the nodal_prices tables
+    folder: Where to store the cube, defaults to the configured folder
+    dtype: Type of the price array, float32 halves the size on disk
+
+    Returns:
+    --------
+    shape: The (days, periods, nodes) shape of the array built
+    """
+    folder = folder or cube_folder()
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    prices = query_to_df(database, """SELECT trading_date, trading_period,
+                                             node, price
+                                      FROM nodal_prices_%s""" % year)
+
+    dates = pd.date_range("%s-01-01" % year, "%s-12-31" % year).values
+    nodes = sorted(prices["node"].unique())
+
+    days = (pd.to_datetime(prices["trading_date"]).values -
+            dates[0]).astype("timedelta64[D]").astype(np.int64)
+    periods = prices["trading_period"].values.astype(np.int64) - 1
+    columns = np.searchsorted(nodes, prices["node"].values)
+
+    # Each build writes a new price file, readers never see a partial year
+    build = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    prices_file = "prices_%s_%s.npy" % (year, build)
+    cube = np.lib.format.open_memmap(
+        os.path.join(folder, prices_file), mode="w+", dtype=dtype,
+        shape=(len(dates), CUBE_PERIODS, len(nodes)))
+    cube[:] = np.nan
+    cube[days, periods, columns] = prices["price"].values
+    cube.flush()
+    shape = cube.shape
+    del cube
+
+    path = manifest_path(folder, year)
+    previous = read_manifest(path) if os.path.exists(path) else None
+    write_manifest(folder, year, prices_file, dates, nodes)
+
+    # Readers which have mapped the old prices keep them until they close
+    if previous and previous["prices"] != prices_file:
+        os.remove(os.path.join(folder, previous["prices"]))
+
+    print "Built price cube for %s with shape %s" % (year, shape)
+    return shape
+
+
+def build_all_price_cubes(database="nodal_database", folder=None,
+                          dtype=np.float64):
+    """ Build the price cube for every split year of nodal_prices """
+    schema = load_config()[database]['schemas']["nodal_prices"]
+    for year in schema["split_years"]:
+        build_price_cube(year, database=database, folder=folder,
+                         dtype=dtype)
+
+
+def manifest_path(folder, year):
+    """ The manifest of a year of the cube """
+    return os.path.join(folder, "cube_%s.json" % year)
+
+
+def read_manifest(path):
+    """ The price file, nodes and dates of a year of the cube """
+    with open(path, 'rb') as f:
+        return simplejson.load(f)
+
+
+def write_manifest(folder, year, prices_file, dates, nodes):
+    """ Point a year of the cube at a price file and its axes, the manifest
+    is renamed into place so readers see either the old or the new year
+    """
+    path = manifest_path(folder, year)
+    temp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        simplejson.dump({"prices": prices_file, "nodes": list(nodes),
+                         "dates": [str(d) for d in
+                                   dates.astype("datetime64[D]")]}, f)
+    os.rename(temp_path, path)
+
+
+class CubeSlice(collections.namedtuple("CubeSlice",
+                                       ["values", "dates", "periods",
+                                        "nodes"])):
+    """
+    A (day, trading period, node) block of prices along with its labels.
+    Slices within a single year and of a contiguous run of nodes are views
+    onto the memory map, others are copies.
+    """
+    __slots__ = ()
+
+    @property
+    def mask(self):
+        """ Boolean array which is True where a price is missing """
+        return np.isnan(self.values)
+
+    def to_frame(self):
+        """ Flatten to the long trading_date, trading_period, node, price
+        layout returned by query_nodal_price, dropping missing prices
+        """
+        days, periods, nodes = self.values.shape
+        df = pd.DataFrame({
+            "trading_date": np.repeat(self.dates, periods * nodes),
+            "trading_period": np.tile(np.repeat(self.periods, nodes), days),
+            "node": np.tile(self.nodes, days * periods),
+            "price": self.values.ravel()})
+        df = df[["trading_date", "trading_period", "node", "price"]]
+        return df.dropna(subset=["price"]).reset_index(drop=True)
+
+
+class PriceCube(object):
+    """
+    Reader for the memory mapped nodal price cube
+
+    Parameters:
+    -----------
+    folder: Where the cube is stored, defaults to the configured folder
+    """
+
+    def __init__(self, folder=None):
+        super(PriceCube, self).__init__()
+
+        self.folder = folder or cube_folder()
+        self._years = {}
+
+    @property
+    def years(self):
+        """ The years which have been materialised """
+        return sorted(int(os.path.basename(f)[5:9]) for f in
+                      glob.glob(os.path.join(self.folder, "cube_*.json")))
+
+    def year(self, year):
+        """ The memory mapped prices, dates and node positions of a year """
+        if year not in self._years:
+            with _cube_lock:
+                path = manifest_path(self.folder, year)
+                manifest = read_manifest(path)
+                try:
+                    values = np.load(self._path(manifest["prices"]),
+                                     mmap_mode='r')
+                except IOError:
+                    # Rebuilt between reading the manifest and the prices
+                    manifest = read_manifest(path)
+                    values = np.load(self._path(manifest["prices"]),
+                                     mmap_mode='r')
+
+                dates = np.array(manifest["dates"], dtype="datetime64[ns]")
+                nodes = manifest["nodes"]
+                self._years[year] = (values, dates, nodes,
+                                     dict((n, i) for i, n in
+                                          enumerate(nodes)))
+
+        return self._years[year]
+
+    def slice(self, nodes=None, begin_date=None, end_date=None,
+              periods=None, begin_period=None, end_period=None):
+        """
+        Slice the prices of a set of nodes over a date range and trading
+        periods.
+
+        Parameters:
+        -----------
+        nodes: List of nodes, "Core" or "Major", defaults to every node
+        begin_date: Start of the date range, defaults to the first year
+        end_date: End of the date range, defaults to the last year
+        periods: List of trading periods, defaults to all 50
+        begin_period: Beginning of a trading period range, int
+        end_period: End of a trading period range, int
+
+        Returns:
+        --------
+        CubeSlice: The (day, trading period, node) array of prices along
+                   with the dates, periods and nodes labelling each axis
+        """
+        if isinstance(nodes, basestring):
+            nodes = list(node_groups.get(nodes, (nodes,)))
+
+        years = self.years
+        begin = (np.datetime64(parse_date(begin_date).date()) if begin_date
+                 else np.datetime64("%s-01-01" % years[0]))
+        end = (np.datetime64(parse_date(end_date).date()) if end_date
+               else np.datetime64("%s-12-31" % years[-1]))
+
+        begin_year = begin.astype(object).year
+        end_year = end.astype(object).year
+        missing = [y for y in range(begin_year, end_year + 1)
+                   if y not in years]
+        if missing:
+            raise ValueError("The price cube has not been built for %s" %
+                             ", ".join(str(y) for y in missing))
+
+        if nodes is None:
+            nodes = sorted(set(n for y in range(begin_year, end_year + 1)
+                               for n in self.year(y)[2]))
+
+        if begin_period and end_period:
+            periods = range(begin_period, end_period + 1)
+        periods = list(periods) if periods else range(1, CUBE_PERIODS + 1)
+        period_index = as_slice([p - 1 for p in periods])
+
+        blocks, dates = [], []
+        for y in range(begin_year, end_year + 1):
+            values, year_dates, _, positions = self.year(y)
+            days = slice(np.searchsorted(year_dates, begin),
+                         np.searchsorted(year_dates, end, side="right"))
+
+            blocks.append(select_nodes(values[days][:, period_index],
+                                       [positions.get(n) for n in nodes]))
+            dates.append(year_dates[days])
+
+        values = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        return CubeSlice(values, np.concatenate(dates), np.array(periods),
+                         np.array(nodes))
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+
+def as_slice(positions):
+    """ A slice for a contiguous run of positions so indexing gives a view,
+    otherwise the positions themselves
+    """
+    if positions and positions == range(positions[0],
+                                        positions[0] + len(positions)):
+        return slice(positions[0], positions[0] + len(positions))
+    return positions
+
+
+def select_nodes(block, positions):
+    """ Select the node columns of a block, nodes which were not present in
+    the year (a None position) are filled with NaN
+    """
+    if None not in positions:
+        return block[:, :, as_slice(positions)]
+
+    selected = np.full(block.shape[:2] + (len(positions),), np.nan,
+                       dtype=block.dtype)
+    present = [i for i, p in enumerate(positions) if p is not None]
+    if present:
+        selected[:, :, present] = block[:, :, [positions[i]
+                                               for i in present]]
+    return selected
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the memory mapped nodal price cube")
+    parser.add_argument("--database", default="nodal_database")
+    parser.add_argument("--years", type=int, nargs="*",
+                        help="Years to build, defaults to every split year")
+    parser.add_argument("--float32", action="store_true",
+                        help="Store the prices as float32")
+    args = parser.parse_args()
+
+    dtype = np.float32 if args.float32 else np.float64
+    if args.years:
+        for year in args.years:
+            build_price_cube(year, database=args.database, dtype=dtype)
+    else:
+        build_all_price_cubes(database=args.database, dtype=dtype)
+
+
+if __name__ == '__main__':
+    main()
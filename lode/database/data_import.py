@@ -1,46 +1,35 @@
-import psycopg2 as pg2
 import pandas as pd
 import numpy as np
 
-from lode.database.utilities import (execute_and_commit_sql,
-                                     strip_fileendings,
+from lode.database.utilities import (pooled_connection,
                                      get_column_names,
                                      check_csv_headers,
                                      list_all_tables,
                                      ex_sql_and_fetch)
 
-from lode.utilities.util import (get_file_year_str, parse_date)
+from lode.utilities.util import (get_file_year_str, parse_dates)
+from lode.database.loader import load_columns, copy_csv
 
 
-def insert_to_database(database, sql, table, csvfile):
+def insert_to_database(database, table, csvfile):
     """
+    Stream a CSV file into a table with COPY FROM STDIN, the line endings,
+    trailing spaces and any header are handled as the file is read so the
+    file itself is never modified, see lode.database.loader.copy_csv
 
-    """
-
-    try:
-        execute_and_commit_sql(database, sql)
-    except pg2.ProgrammingError as e:
-        print e
-
-        # Copy the file from the existing location to the home directory
-        fName = os.path.basename(csvfile)
-        homeName = os.path.expanduser("~/%s" % fName)
-        shutil.copy(csvfile, homeName)
-
-        # Modify the permissions to give control over the file to the system
-        os.chmod(homeName, 0644)
-
-        # Recreate a new query
-        sql = """COPY %s FROM '%s' DELIMITER ',' CSV HEADER;""" % (table,
-                                                                   homeName)
+    Parameters:
+    -----------
+    database: What database to load into
+    table: The table to load into, e.g. energy_offers_2014
+    csvfile: What CSV file to load, full path
 
-        try:
-            execute_and_commit_sql(sql)
-        except pg2.DataError as e:
-            strip_fileendings(homeName)
-            execute_and_commit_sql(sql)
-        finally:
-            os.remove(homeName)
+    Returns:
+    --------
+    rows: The number of rows loaded
+    """
+    columns = load_columns(database, table)
+    with pooled_connection(database) as conn:
+        return copy_csv(conn, table, columns, csvfile)
 
 
 def load_csv_with_headers(csvfile, database, tablename, replace=True):
@@ -83,18 +72,21 @@ def load_csv_with_headers(csvfile, database, tablename, replace=True):
 def unloaded_csv_dates(csvfile, database, table, column="trading_date",
                        replace=False):
     """
-
+    The trading dates in a CSV file which are not yet in the database table,
+    sorted in date order
     """
 
     # Get the appropriate table name
     table = match_csv_to_table(csvfile, database, table)
 
     df = load_csv_with_headers(csvfile, database, table, replace=replace)
-    csv_dates = [parse_date(x) for x in (df[column].unique()]
+    csv_dates = parse_dates(df[column].unique())
 
     # Get all of the existing dates from the
     sql = """SELECT DISTINCT trading_date FROM %s""" % table
-    db_dates = ex_sql_and_fetch(database, sql)
+    db_dates = set(parse_dates(np.ravel(ex_sql_and_fetch(database, sql))))
+
+    return sorted(set(csv_dates) - db_dates)
 
 
 def existing_database_entries(database, table, column):
@@ -0,0 +1,193 @@
+"""
+Management of the secondary indexes on the master tables.
+
+The UNIQUE constraint of each schema only gives an index led by its first
+column, so filters on e.g. Node or Company would otherwise scan the whole
+shard. Further indexes are declared per master table in the "indexes" key
+of its schema in the configuration file, for example:
+
+    "indexes": [{"columns": ["Trading_date"], "method": "brin"},
+                {"columns": ["Node", "Trading_date", "Trading_period"]}]
+
+BRIN indexes suit the Trading_date columns as the data is loaded in date
+order, they are a tiny fraction of the size of a B-tree. The method defaults
+to btree.
+
+Running this module reports the indexes which are never used and the tables
+which are mostly read by sequential scans, to tune the declarations against
+the real query load:
+
+    python -m lode.database.indexes --database nodal_database
+"""
+
+import argparse
+import hashlib
+
+from lode.utilities.util import load_config
+from lode.database.utilities import execute_and_commit_sql, query_to_df
+
+index_methods = ("btree", "brin", "hash", "gin", "gist")
+
+# Postgres truncates identifiers longer than this
+max_identifier_length = 63
+
+
+def index_name(table, columns, method="btree"):
+    """
+    A deterministic name for an index so that it is only ever built once
+
+    Parameters:
+    -----------
+    table: The table the index is on, e.g. nodal_prices_2014
+    columns: List of the indexed columns
+    method: The index access method
+
+    Returns:
+    --------
+    name: The index name, shortened with a hash if too long for Postgres
+    """
+    name = "%s_%s_%s_idx" % (table, "_".join(columns), method)
+    name = name.lower()
+    if len(name) > max_identifier_length:
+        digest = hashlib.sha1(name).hexdigest()[:8]
+        name = "%s_%s_idx" % (table.lower()[:max_identifier_length - 13],
+                              digest)
+    return name
+
+
+def create_index_sql(table, columns, method="btree"):
+    """
+    SQL to build an index if it does not already exist
+
+    Parameters:
+    -----------
+    table: The table the index is on, e.g. nodal_prices_2014
+    columns: List of the indexed columns
+    method: The index access method, e.g. btree or brin
+
+    Returns:
+    --------
+    SQL: CREATE INDEX statement
+    """
+    if method not in index_methods:
+        raise ValueError("Index method %s is not one of %s" % (
+            method, ", ".join(index_methods)))
+
+    if not columns:
+        raise ValueError("An index needs at least one column")
+
+    return "CREATE INDEX IF NOT EXISTS %s ON %s USING %s (%s);" % (
+        index_name(table, columns, method), table, method,
+        ", ".join(columns))
+
+
+def declared_indexes(database, master_table):
+    """ The indexes declared for a master table in the configuration """
+    schema = load_config()[database]['schemas'][master_table]
+    return schema.get("indexes", [])
+
+
+def indexed_tables(database, master_table):
+    """
+    The tables which the indexes of a master table are built on, a
+    partitioned master table only needs them on the parent as Postgres
+    cascades them to every partition, including those created later.
+    """
+    schema = load_config()[database]['schemas'][master_table]
+    if schema.get("partitioned") or not schema.get("split_by_year"):
+        return [master_table]
+
+    return ["%s_%s" % (master_table, year) for year in schema["split_years"]]
+
+
+def create_indexes(database, master_table):
+    """
+    Build every index declared for a master table on each of its shards.
+    Indexes which already exist are left alone so this is safe to re-run
+    after adding a new declaration or a new year.
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. nodal_prices
+    """
+    for index in declared_indexes(database, master_table):
+        method = index.get("method", "btree")
+        for table in indexed_tables(database, master_table):
+            print "Building %s index on %s(%s)" % (
+                method, table, ", ".join(index["columns"]))
+            execute_and_commit_sql(database, create_index_sql(
+                table, index["columns"], method))
+
+
+def unused_indexes(database, max_scans=0):
+    """
+    Report the indexes which have been scanned no more than max_scans times
+    since the statistics were last reset. Indexes backing a primary key or
+    unique constraint are excluded as they enforce integrity.
+
+    Parameters:
+    -----------
+    database: The database key
+    max_scans: Indexes with at most this many scans are reported
+
+    Returns:
+    --------
+    DataFrame: One row per index with the table, scans and size in bytes
+    """
+    sql = """SELECT s.relname AS table_name, s.indexrelname AS index_name,
+                    s.idx_scan, pg_relation_size(s.indexrelid) AS size_bytes
+             FROM pg_stat_user_indexes s
+             JOIN pg_index i ON i.indexrelid = s.indexrelid
+             WHERE NOT i.indisunique AND s.idx_scan <= %s
+             ORDER BY size_bytes DESC""" % int(max_scans)
+    return query_to_df(database, sql, fetch_method="read_sql")
+
+
+def missing_indexes(database, min_rows=10000):
+    """
+    Report the tables which are read mostly by sequential scans, these are
+    the candidates for a new index. Small tables are excluded as scanning
+    them is cheaper than using an index.
+
+    Parameters:
+    -----------
+    database: The database key
+    min_rows: Only tables with at least this many live rows are reported
+
+    Returns:
+    --------
+    DataFrame: One row per table with the scan counts and rows read by
+               sequential scans, the worst tables first
+    """
+    sql = """SELECT relname AS table_name, seq_scan, seq_tup_read,
+                    COALESCE(idx_scan, 0) AS idx_scan, n_live_tup
+             FROM pg_stat_user_tables
+             WHERE n_live_tup >= %s AND seq_scan > COALESCE(idx_scan, 0)
+             ORDER BY seq_tup_read DESC""" % int(min_rows)
+    return query_to_df(database, sql, fetch_method="read_sql")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report unused and missing indexes")
+    parser.add_argument("--database", default="nodal_database")
+    parser.add_argument("--max-scans", type=int, default=0,
+                        help="Report indexes used at most this many times")
+    parser.add_argument("--min-rows", type=int, default=10000,
+                        help="Ignore tables smaller than this")
+    args = parser.parse_args()
+
+    unused = unused_indexes(args.database, args.max_scans)
+    print "Unused indexes (%s):" % len(unused)
+    if len(unused):
+        print unused.to_string(index=False)
+
+    missing = missing_indexes(args.database, args.min_rows)
+    print "\nTables read mostly by sequential scans (%s):" % len(missing)
+    if len(missing):
+        print missing.to_string(index=False)
+
+
+if __name__ == '__main__':
+    main()
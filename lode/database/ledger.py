@@ -0,0 +1,212 @@
+"""
+The load ledger, a lode_load_ledger table in each database recording every
+file loaded: its path, size, modification time and content hash, the table
+it was loaded into, the number of rows and how long the load took.
+
+The bulk loaders consult the ledger before loading so that re-running over
+a folder only loads the new or changed files. A file is already loaded if
+its path, size and modification time match the ledger, or failing that if
+a file with the same content has been loaded into the master table, e.g.
+after the folder was moved. The ledger row is written in the same
+transaction as the COPY of the file, so a file is never recorded without
+its rows or loaded without being recorded.
+
+The files still to load are listed with:
+
+    python -m lode.database.loader --database offer_database \\
+        --table energy_offers --pending /path/to/Energy_Offers
+"""
+
+import os
+import re
+import hashlib
+import datetime
+import threading
+import pandas as pd
+
+from lode.database.utilities import (execute_and_commit_sql,
+                                     ex_sql_and_fetch, query_to_df)
+
+ledger_table = "lode_load_ledger"
+
+# Bytes of a file hashed at a time
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# A date in a file name, e.g. 20140813_Offers.csv
+file_date_pattern = re.compile(r"(?<!\d)(\d{8})(?!\d)")
+
+# The databases whose ledger has been created by this process
+_created = set()
+_created_lock = threading.Lock()
+
+
+def create_ledger_sql():
+    """ SQL to create the ledger table """
+    return """CREATE TABLE IF NOT EXISTS %s
+(
+ledger_key serial primary key,
+file_path text,
+file_size bigint,
+file_mtime timestamp,
+content_hash varchar(40),
+master_table text,
+target_table text,
+row_count bigint,
+load_seconds double precision,
+loaded_at timestamp DEFAULT now(),
+UNIQUE(file_path, target_table)
+);""" % ledger_table
+
+
+def create_ledger(database):
+    """ Create the ledger table of a database, once per process """
+    with _created_lock:
+        if database not in _created:
+            execute_and_commit_sql(database, create_ledger_sql())
+            _created.add(database)
+
+
+def file_signature(csvfile):
+    """
+    The absolute path, size and modification time of a file
+
+    Returns:
+    --------
+    (path, size, mtime): The mtime is a datetime to the second
+    """
+    stat = os.stat(csvfile)
+    return (os.path.abspath(csvfile), stat.st_size,
+            datetime.datetime.fromtimestamp(int(stat.st_mtime)))
+
+
+def file_hash(csvfile):
+    """ The SHA1 hex digest of the contents of a file """
+    digest = hashlib.sha1()
+    with open(csvfile, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BUFFER_SIZE), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_date(csvfile):
+    """ The date in the name of a file, or None if it has none """
+    match = file_date_pattern.search(os.path.basename(csvfile))
+    if match is None:
+        return None
+
+    try:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+class Ledger(object):
+    """
+    The files recorded in the ledger for a master table, read once so that
+    the files of a folder can be checked against it without a query each
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. energy_offers
+    """
+
+    def __init__(self, database, master_table):
+        super(Ledger, self).__init__()
+
+        create_ledger(database)
+        sql = """SELECT file_path, file_size, file_mtime, content_hash
+                 FROM %s WHERE master_table = %%s""" % ledger_table
+        rows = ex_sql_and_fetch(database, (sql, [master_table]))
+
+        self.signatures = set((p, s, m) for p, s, m, _ in rows)
+        self.paths = set(p for p, _, _, _ in rows)
+        self.hashes = set(h for _, _, _, h in rows)
+
+    def status(self, csvfile):
+        """
+        Whether a file needs loading
+
+        Returns:
+        --------
+        (status, content_hash): The status is loaded, new or changed, the
+                                hash is None if it was not needed
+        """
+        signature = file_signature(csvfile)
+        if signature in self.signatures:
+            return "loaded", None
+
+        content_hash = file_hash(csvfile)
+        if content_hash in self.hashes:
+            return "loaded", content_hash
+
+        return ("changed" if signature[0] in self.paths else "new",
+                content_hash)
+
+
+def record_load(conn, csvfile, content_hash, master_table, table, rows,
+                seconds):
+    """
+    Record a loaded file in the ledger, on the connection the file was
+    loaded on so that it is committed along with the rows
+    """
+    path, size, mtime = file_signature(csvfile)
+    sql = """INSERT INTO %s (file_path, file_size, file_mtime, content_hash,
+                             master_table, target_table, row_count,
+                             load_seconds)
+             VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)
+             ON CONFLICT (file_path, target_table) DO UPDATE SET
+                 file_size = EXCLUDED.file_size,
+                 file_mtime = EXCLUDED.file_mtime,
+                 content_hash = EXCLUDED.content_hash,
+                 row_count = EXCLUDED.row_count,
+                 load_seconds = EXCLUDED.load_seconds,
+                 loaded_at = now()""" % ledger_table
+    with conn.cursor() as curs:
+        curs.execute(sql, [path, size, mtime, content_hash, master_table,
+                           table, rows, seconds])
+
+
+def pending_files(database, master_table, csvfiles):
+    """
+    The files which have not been loaded, or have changed since
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. energy_offers
+    csvfiles: The files to check
+
+    Returns:
+    --------
+    DataFrame: One row per pending file with its path, the date in its name
+               and whether it is new or changed, in date order
+    """
+    ledger = Ledger(database, master_table)
+    pending = []
+    for csvfile in csvfiles:
+        status, _ = ledger.status(csvfile)
+        if status != "loaded":
+            pending.append((csvfile, file_date(csvfile), status))
+
+    df = pd.DataFrame(pending, columns=["csvfile", "trading_date", "status"])
+    return df.sort_values(["trading_date", "csvfile"]).reset_index(drop=True)
+
+
+def ledger_entries(database, master_table=None):
+    """ The ledger of a database as a DataFrame, optionally of one master
+    table, the most recent loads first
+    """
+    create_ledger(database)
+    sql = "SELECT * FROM %s" % ledger_table
+    params = []
+    if master_table:
+        sql += " WHERE master_table = %s"
+        params.append(master_table)
+
+    return query_to_df(database, (sql + " ORDER BY loaded_at DESC", params),
+                       fetch_method="read_sql")
+
+
+if __name__ == '__main__':
+    pass
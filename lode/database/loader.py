@@ -0,0 +1,560 @@
+"""
+Bulk loading of many CSV files, e.g. a historic backfill of daily WITS
+offer files, into the year shards of a master table.
+
+The files are grouped by the shard they load into and loaded by a pool of
+worker threads, each checking out its own pooled connection for the COPY of
+a file. The number of files loaded into the same shard at once is limited
+so that concurrent COPYs do not contend for the one table and its indexes.
+The column names of each shard are looked up once rather than per file.
+
+Files are streamed to the database with COPY FROM STDIN, so the database
+server never needs to see our filesystem. They pass through NormalisedCsv
+on the way, which converts Windows line endings, trims the trailing spaces
+from fields, e.g. "GLN0332 ", and skips the header and blank lines without
+rewriting or copying the source files.
+
+Files which overlap rows already loaded, e.g. a monthly file over daily
+ones or a revised month, are loaded with on_conflict. Each file is then
+COPYed into a staging table and merged into the shard with INSERT ... ON
+CONFLICT on the UNIQUE key of the shard, either skipping the rows already
+present ("nothing") or updating those which have been revised ("update").
+
+Every file loaded is recorded in the load ledger of the database, in the
+same transaction as its rows, and the files already in the ledger are
+skipped. An interrupted backfill therefore resumes where it stopped and a
+nightly run only loads the new or changed files, see lode.database.ledger.
+
+    python -m lode.database.loader --database offer_database \\
+        --table energy_offers /path/to/Energy_Offers
+"""
+
+import os
+import re
+import csv
+import glob
+import time
+import argparse
+import threading
+import collections
+from cStringIO import StringIO
+from itertools import izip_longest
+from multiprocessing.pool import ThreadPool
+
+import psycopg2 as pg2
+
+from lode.utilities.util import load_config, get_file_year_str
+from lode.database.utilities import (pooled_connection, ex_sql_and_fetch,
+                                     get_pool)
+from lode.database.cache import invalidate_shard
+from lode.database.partitions import ensure_partition
+from lode.database.rollups import (has_rollups, refresh_rollups,
+                                   last_loaded_key, loaded_date_ranges,
+                                   merge_ranges)
+from lode.database.ledger import (Ledger, create_ledger, record_load,
+                                  file_hash, pending_files)
+
+# Files loaded into the same shard at once by default
+DEFAULT_SHARD_WORKERS = 1
+
+# Bytes read from a file, and sent to the database, at a time
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Spaces and tabs at the end of each unquoted field
+trailing_space = re.compile(r"[ \t]+(?=,|$)")
+
+# How rows already present are handled when merging a file
+conflict_actions = ("nothing", "update")
+
+LoadResult = collections.namedtuple("LoadResult", ["csvfile", "table",
+                                                   "status", "rows",
+                                                   "inserted", "updated",
+                                                   "skipped", "seconds",
+                                                   "error"])
+LoadResult.__new__.__defaults__ = (0, 0, 0, 0, 0., None)
+
+# The rows of a file, how many were inserted, updated or skipped when it
+# was merged and the (first, last) trading date of the rows updated
+LoadCounts = collections.namedtuple("LoadCounts", ["rows", "inserted",
+                                                   "updated", "skipped",
+                                                   "revised"])
+
+def shard_table(database, master_table, csvfile):
+    """
+    The table a file loads into, the year shard for master tables split by
+    year, e.g. energy_offers_2014
+
+    Returns:
+    --------
+    (table, year): The table name and the year, None if not split by year
+    """
+    schema = load_config()[database]['schemas'][master_table]
+    if not schema['split_by_year']:
+        return master_table, None
+
+    year = int(get_file_year_str(csvfile))
+    return "%s_%s" % (master_table, year), year
+
+
+def load_columns(database, table):
+    """ The columns of a table which are loaded from the files, in table
+    order, the serial key is filled by the database
+    """
+    sql = """SELECT column_name FROM information_schema.columns
+             WHERE table_schema='public' AND table_name='%s'
+             ORDER BY ordinal_position""" % table
+    return [c for (c,) in ex_sql_and_fetch(database, sql) if "key" not in c]
+
+
+def unique_keys(database, table):
+    """ The columns of the UNIQUE key of a table, which merged files are
+    matched against the existing rows on
+    """
+    sql = """SELECT i.indexrelid, a.attname FROM pg_index i
+             JOIN pg_attribute a ON a.attrelid = i.indrelid
+                                AND a.attnum = ANY(i.indkey)
+             WHERE i.indrelid = %s::regclass AND i.indisunique
+                   AND NOT i.indisprimary
+             ORDER BY i.indexrelid, array_position(i.indkey::int2[],
+                                                   a.attnum)"""
+    rows = ex_sql_and_fetch(database, (sql, [table]))
+    if not rows:
+        raise ValueError("%s has no UNIQUE key to merge on" % table)
+
+    return [column for index, column in rows if index == rows[0][0]]
+
+
+def has_header(csvfile, columns):
+    """ Whether the first line of a file is a header naming the columns """
+    with open(csvfile, 'rb') as f:
+        return columns[0].lower() in f.readline().lower()
+
+
+def copy_sql(table, columns):
+    """ The COPY statement loading CSV data sent by the client """
+    return "COPY %s(%s) FROM STDIN WITH CSV;" % (table, ",".join(columns))
+
+
+def normalise_line(line):
+    """ A CSV line with a Unix line ending and no trailing spaces on its
+    fields, blank lines are removed altogether
+    """
+    line = line.rstrip("\r\n")
+    if '"' in line:
+        # Quoted fields may hold commas, so split them properly
+        fields = [field.rstrip(" \t") for field in csv.reader([line]).next()]
+        out = StringIO()
+        csv.writer(out, lineterminator="\n").writerow(fields)
+        return out.getvalue()
+
+    line = trailing_space.sub("", line)
+    return line + "\n" if line.strip(",") else ""
+
+
+class NormalisedCsv(object):
+    """
+    A read only, file like view of a CSV file which normalises the lines as
+    they are read, see normalise_line, for streaming to COPY FROM STDIN.
+    Only a buffer of lines is held in memory at a time.
+
+    Parameters:
+    -----------
+    f: The open CSV file
+    skip_header: Whether to drop the first line
+    buffer_size: Roughly how many bytes of lines to read at a time
+    """
+
+    def __init__(self, f, skip_header=False, buffer_size=COPY_BUFFER_SIZE):
+        super(NormalisedCsv, self).__init__()
+
+        self.f = f
+        self.skip_header = skip_header
+        self.buffer_size = buffer_size
+        self._buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            lines = self.f.readlines(self.buffer_size)
+            if not lines:
+                break
+
+            if self.skip_header:
+                lines, self.skip_header = lines[1:], False
+
+            self._buffer += "".join(normalise_line(l) for l in lines)
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def copy_csv(conn, table, columns, csvfile):
+    """
+    Stream a CSV file into a table with COPY FROM STDIN, the transaction is
+    left for the caller to commit
+
+    Parameters:
+    -----------
+    conn: The connection to load on
+    table: The table to load into, e.g. energy_offers_2014
+    columns: The table columns in the order of the file
+    csvfile: The CSV file, with or without a header
+
+    Returns:
+    --------
+    rows: The number of rows loaded
+    """
+    header = has_header(csvfile, columns)
+    with conn.cursor() as curs, open(csvfile, 'rb') as f:
+        # The files hold New Zealand, day first, dates
+        curs.execute("SET LOCAL DateStyle TO 'ISO, DMY'")
+        curs.copy_expert(copy_sql(table, columns),
+                         NormalisedCsv(f, skip_header=header),
+                         size=COPY_BUFFER_SIZE)
+        return curs.rowcount
+
+
+def staging_sql(table, staging, columns):
+    """ SQL to create the staging table of a load, with the types of the
+    loaded columns of the table. It is a temporary table so it is never
+    written to the WAL, is private to the connection loading the file and
+    is dropped once the load commits.
+    """
+    return ("CREATE TEMPORARY TABLE %s ON COMMIT DROP AS "
+            "SELECT %s FROM %s WITH NO DATA" % (staging, ", ".join(columns),
+                                                 table))
+
+
+def merge_sql(table, staging, columns, keys, on_conflict="nothing"):
+    """
+    SQL to merge a staging table into a table, returning the number of
+    rows inserted and updated and the range of trading dates updated
+
+    Parameters:
+    -----------
+    table: The table merged into, e.g. energy_offers_2014
+    staging: The staging table holding the file
+    columns: The loaded columns
+    keys: The columns of the UNIQUE key of the table
+    on_conflict: "nothing" to skip the rows already present, "update" to
+                 overwrite those which differ
+
+    Returns:
+    --------
+    SQL: The INSERT ... ON CONFLICT statement
+    """
+    if on_conflict not in conflict_actions:
+        raise ValueError("on_conflict must be one of %s" % ", ".join(
+            conflict_actions))
+
+    selection = ", ".join(columns)
+    key_list = ", ".join(keys)
+    source = "SELECT %s FROM %s" % (selection, staging)
+    action = "DO NOTHING"
+
+    updated = [c for c in columns if c not in keys]
+    if on_conflict == "update" and updated:
+        # A row may only be updated once, the last in the file wins
+        source = ("SELECT DISTINCT ON (%s) %s FROM %s "
+                  "ORDER BY %s, ctid DESC" % (key_list, selection, staging,
+                                              key_list))
+        action = "DO UPDATE SET %s WHERE (%s) IS DISTINCT FROM (%s)" % (
+            ", ".join("%s = EXCLUDED.%s" % (c, c) for c in updated),
+            ", ".join("target.%s" % c for c in updated),
+            ", ".join("EXCLUDED.%s" % c for c in updated))
+
+    # Inserted rows have no deleting transaction, updated rows do
+    dates = "trading_date" if "trading_date" in columns else "NULL::date"
+    return """WITH merged AS (
+                  INSERT INTO %s AS target (%s) %s
+                  ON CONFLICT (%s) %s
+                  RETURNING xmax = 0 AS inserted, %s AS trading_date)
+              SELECT count(*) FILTER (WHERE inserted),
+                     count(*) FILTER (WHERE NOT inserted),
+                     min(trading_date) FILTER (WHERE NOT inserted),
+                     max(trading_date) FILTER (WHERE NOT inserted)
+              FROM merged""" % (table, selection, source, key_list, action,
+                                dates)
+
+
+def merge_csv(conn, table, columns, keys, csvfile, on_conflict="nothing"):
+    """
+    Stream a CSV file into a staging table and merge it into a table, the
+    transaction is left for the caller to commit
+
+    Parameters:
+    -----------
+    conn: The connection to load on
+    table: The table to merge into, e.g. energy_offers_2014
+    columns: The table columns in the order of the file
+    keys: The columns of the UNIQUE key of the table
+    csvfile: The CSV file, with or without a header
+    on_conflict: "nothing" or "update", see merge_sql
+
+    Returns:
+    --------
+    LoadCounts: The rows in the file and how many were inserted, updated
+                and skipped
+    """
+    staging = "lode_staging_%s" % table
+    with conn.cursor() as curs:
+        curs.execute(staging_sql(table, staging, columns))
+
+    rows = copy_csv(conn, staging, columns, csvfile)
+    with conn.cursor() as curs:
+        curs.execute(merge_sql(table, staging, columns, keys, on_conflict))
+        inserted, updated, first, last = curs.fetchone()
+
+    return LoadCounts(rows, inserted, updated, rows - inserted - updated,
+                      (first, last) if updated else None)
+
+
+def interleave(groups):
+    """ Order the files of each shard round robin across the shards so the
+    workers spread over the shards rather than queueing on one
+    """
+    return [f for files in izip_longest(*groups) for f in files
+            if f is not None]
+
+
+def load_file(database, master_table, table, columns, csvfile,
+              content_hash=None, keys=None, on_conflict=None):
+    """
+    COPY a single CSV file into a table on a pooled connection and record
+    it in the load ledger, both are committed together
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. energy_offers
+    table: The table to load into, e.g. energy_offers_2014
+    columns: The table columns in the order of the file
+    csvfile: The CSV file
+    content_hash: The hash of the file if it is already known
+    keys: The UNIQUE key of the table, needed to merge
+    on_conflict: Merge the file through a staging table, "nothing" skips
+                 the rows already present and "update" overwrites them,
+                 None to COPY straight into the table
+
+    Returns:
+    --------
+    LoadCounts: The rows in the file and how many were inserted, updated
+                and skipped
+    """
+    begin = time.time()
+    content_hash = content_hash or file_hash(csvfile)
+    with pooled_connection(database) as conn:
+        if on_conflict:
+            counts = merge_csv(conn, table, columns, keys, csvfile,
+                               on_conflict)
+        else:
+            rows = copy_csv(conn, table, columns, csvfile)
+            counts = LoadCounts(rows, rows, 0, 0, None)
+
+        record_load(conn, csvfile, content_hash, master_table, table,
+                    counts.rows, time.time() - begin)
+    return counts
+
+
+def load_files(database, master_table, csvfiles, workers=None,
+               shard_workers=DEFAULT_SHARD_WORKERS, resume=True,
+               update_rollups=True, on_conflict=None):
+    """
+    Load many CSV files into the shards of a master table concurrently
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. energy_offers
+    csvfiles: The CSV files to load
+    workers: Number of files loaded at once, defaults to the size of the
+             connection pool
+    shard_workers: Number of files loaded into the same shard at once
+    resume: Skip the files recorded in the load ledger, unless they have
+            changed since
+    update_rollups: Refresh the rollups for the dates loaded, once all of
+                    the files are loaded
+    on_conflict: Merge each file through a staging table rather than
+                 failing on rows which are already loaded, "nothing" skips
+                 them and "update" overwrites those which were revised
+
+    Returns:
+    --------
+    results: A LoadResult for each file, in the order they finished, with a
+             status of loaded, skipped or failed and the rows inserted,
+             updated and skipped
+    """
+    if on_conflict is not None and on_conflict not in conflict_actions:
+        raise ValueError("on_conflict must be one of %s" % ", ".join(
+            conflict_actions))
+
+    create_ledger(database)
+    ledger = Ledger(database, master_table) if resume else None
+    partitioned = load_config()[database]['schemas'][master_table].get(
+        "partitioned")
+
+    results = []
+    shards = collections.OrderedDict()
+    hashes = {}
+    for csvfile in sorted(csvfiles):
+        if ledger is not None:
+            status, hashes[csvfile] = ledger.status(csvfile)
+            if status == "loaded":
+                results.append(LoadResult(csvfile, None, "skipped"))
+                continue
+
+        try:
+            table, year = shard_table(database, master_table, csvfile)
+        except (ValueError, IndexError):
+            results.append(LoadResult(csvfile, None, "failed",
+                                      error="No year in the file name"))
+            print_result(results[-1])
+            continue
+        shards.setdefault((table, year), []).append(csvfile)
+
+    # Everything done once per shard, before and after its files
+    columns, keys, limits, last_keys = {}, {}, {}, {}
+    rollups = has_rollups(database, master_table)
+    key_column = "%s_key" % master_table
+    for table, year in shards:
+        if partitioned:
+            ensure_partition(database, master_table, year)
+        columns[table] = load_columns(database, table)
+        if on_conflict:
+            keys[table] = unique_keys(database, table)
+        limits[table] = threading.BoundedSemaphore(shard_workers)
+        if rollups:
+            last_keys[table] = last_loaded_key(database, table, key_column)
+
+    tables = dict((f, t) for (t, _), files in shards.items() for f in files)
+    revised = []
+
+    def load(csvfile):
+        table = tables[csvfile]
+        with limits[table]:
+            begin = time.time()
+            try:
+                counts = load_file(database, master_table, table,
+                                   columns[table], csvfile,
+                                   hashes.get(csvfile), keys.get(table),
+                                   on_conflict)
+            except (pg2.Error, IOError) as e:
+                counts, error = None, str(e).strip()
+            else:
+                error = None
+
+        if error:
+            result = LoadResult(csvfile, table, "failed",
+                                seconds=time.time() - begin, error=error)
+        else:
+            result = LoadResult(csvfile, table, "loaded", counts.rows,
+                                counts.inserted, counts.updated,
+                                counts.skipped, time.time() - begin)
+            if counts.revised:
+                revised.append(counts.revised)
+
+        print_result(result)
+        return result
+
+    if workers is None:
+        workers = get_pool(database).maxconn
+    workers = max(1, min(workers, len(tables)))
+
+    pool = ThreadPool(workers)
+    try:
+        results.extend(pool.imap_unordered(load,
+                                           interleave(shards.values())))
+    finally:
+        pool.close()
+        pool.join()
+
+    # Cached query results for the shards loaded are now out of date
+    loaded = [(table, year) for table, year in shards
+              if any(r.table == table and r.status == "loaded"
+                     for r in results)]
+    for table, year in loaded:
+        invalidate_shard(database, master_table, year)
+
+    if rollups and update_rollups:
+        # The new rows have larger keys, the updated rows keep theirs
+        ranges = [r for table, _ in loaded
+                  for r in loaded_date_ranges(database, table, key_column,
+                                              last_keys[table])]
+        # Each run of dates is refreshed alone, not the span between them
+        for begin, end in merge_ranges([r for r in ranges + revised if r]):
+            refresh_rollups(database, master_table, begin, end)
+
+    return results
+
+
+def load_folder(database, master_table, folder, **kwargs):
+    """ Load every CSV file in a folder, see load_files """
+    return load_files(database, master_table,
+                      glob.glob(os.path.join(folder, "*.csv")), **kwargs)
+
+
+def print_result(result):
+    if result.status == "failed":
+        print "Failed to load %s: %s" % (result.csvfile, result.error)
+    else:
+        merged = ""
+        if result.updated or result.skipped:
+            merged = " (%s inserted, %s updated, %s skipped)" % (
+                result.inserted, result.updated, result.skipped)
+        print "Loaded %s into %s, %s rows%s in %.1fs" % (
+            result.csvfile, result.table, result.rows, merged,
+            result.seconds)
+
+
+def summarise(results):
+    """ Count the files of each status and the rows inserted, updated and
+    skipped
+    """
+    counts = collections.Counter(r.status for r in results)
+    files = ", ".join("%s %s" % (counts[s], s)
+                      for s in ("loaded", "skipped", "failed"))
+    return "%s files; %s rows inserted, %s updated, %s skipped" % (
+        files, sum(r.inserted for r in results),
+        sum(r.updated for r in results), sum(r.skipped for r in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load a folder of CSV files into a master table")
+    parser.add_argument("folder")
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--table", required=True,
+                        help="The master table, e.g. energy_offers")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Files loaded at once, defaults to the pool")
+    parser.add_argument("--shard-workers", type=int,
+                        default=DEFAULT_SHARD_WORKERS,
+                        help="Files loaded into the same shard at once")
+    parser.add_argument("--restart", action="store_true",
+                        help="Reload the files recorded as loaded")
+    parser.add_argument("--pending", action="store_true",
+                        help="List the files still to load and stop")
+    parser.add_argument("--on-conflict", choices=conflict_actions,
+                        help="Merge the files, skipping or updating the "
+                             "rows already loaded")
+    args = parser.parse_args()
+
+    if args.pending:
+        pending = pending_files(args.database, args.table, glob.glob(
+            os.path.join(args.folder, "*.csv")))
+        print "Pending files (%s):" % len(pending)
+        if len(pending):
+            print pending.to_string(index=False)
+        return
+
+    results = load_folder(args.database, args.table, args.folder,
+                          workers=args.workers,
+                          shard_workers=args.shard_workers,
+                          resume=not args.restart,
+                          on_conflict=args.on_conflict)
+    print summarise(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+The nodal metadata (location, island, region, generation type etc of each
+node) held in a node_metadata table so that it can be joined and grouped on
+in SQL rather than merged onto the half hourly data in pandas.
+
+The table is indexed on node and is loaded from lode/static/nodal_metadata.csv
+into each database when its tables are created. Reload it after updating
+the file with:
+
+    python -m lode.database.metadata --database nodal_database
+"""
+
+import argparse
+
+from lode.utilities.util import meta_path
+from lode.database.utilities import (execute_and_commit_sql,
+                                     pooled_connection, meta_columns)
+from lode.database.cache import invalidate_shard
+from lode.database.rollups import table_exists
+
+metadata_table = "node_metadata"
+
+
+def create_metadata_sql():
+    """ SQL to create the node_metadata table, indexed by its primary key """
+    definitions = ["%s text" % column for _, column in meta_columns]
+    definitions[0] += " PRIMARY KEY"
+
+    return "CREATE TABLE IF NOT EXISTS %s\n(\n%s\n);" % (
+        metadata_table, ",\n".join(definitions))
+
+
+def load_node_metadata(database, csvfile=None):
+    """
+    Create the node_metadata table if needed and replace its contents with
+    the metadata file
+
+    Parameters:
+    -----------
+    database: The database key
+    csvfile: The metadata file, defaults to the one shipped with lode
+    """
+    csvfile = csvfile or meta_path
+    execute_and_commit_sql(database, create_metadata_sql())
+
+    columns = ", ".join(column for _, column in meta_columns)
+    with pooled_connection(database) as conn:
+        with conn.cursor() as curs, open(csvfile, 'rb') as f:
+            curs.execute("TRUNCATE %s" % metadata_table)
+            curs.copy_expert("COPY %s (%s) FROM STDIN WITH CSV HEADER" % (
+                metadata_table, columns), f)
+            curs.execute("ANALYZE %s" % metadata_table)
+
+    print "Loaded node metadata into %s" % database
+    invalidate_shard(database, metadata_table)
+
+
+def has_metadata(database):
+    """ Whether the node_metadata table has been loaded in a database """
+    return table_exists(database, metadata_table)
+
+
+def meta_keys(meta_group):
+    """
+    The node_metadata columns for a grouping, either the metadata file
+    headers, e.g. "Region", or the column names themselves. Other columns,
+    e.g. Trading_period, are passed through lower cased.
+
+    Parameters:
+    -----------
+    meta_group: A column name or list of column names
+
+    Returns:
+    --------
+    keys: List of column names
+    """
+    if isinstance(meta_group, basestring):
+        meta_group = [meta_group]
+
+    names = dict(meta_columns)
+    return [names.get(k, k).lower() for k in meta_group]
+
+
+def join_metadata(query):
+    """
+    Wrap a shard query so that every row has the metadata of its node, a
+    LEFT JOIN so that nodes without metadata are kept.
+
+    Parameters:
+    -----------
+    query: The shard query, an SQL string or (sql, params) pair, it must
+           return the node column
+
+    Returns:
+    --------
+    SQL: The joined query, of the same kind as the query passed
+    """
+    params = None
+    if not isinstance(query, basestring):
+        query, params = query
+
+    columns = ", ".join("m.%s" % column for _, column in meta_columns[1:])
+    sql = """SELECT shard.*, %s
+             FROM (%s) AS shard
+             LEFT JOIN %s AS m ON m.node = shard.node;""" % (
+        columns, query.strip().rstrip(';'), metadata_table)
+
+    return sql if params is None else (sql, params)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load the nodal metadata into the node_metadata table")
+    parser.add_argument("--database", default="nodal_database")
+    parser.add_argument("--csvfile", default=None,
+                        help="Metadata file, defaults to the shipped one")
+    args = parser.parse_args()
+
+    load_node_metadata(args.database, args.csvfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Support for storing the yearly tables as partitions of a single Postgres
+range partitioned master table rather than as independent tables.
+
+A master table is partitioned if its schema in the configuration file has
+"partitioned" set to true, with the partitions split on the column given
+by "partition_column" (defaulting to Trading_date). Queries are then run
+against the master table in a single statement and Postgres prunes the
+partitions which are not needed.
+"""
+
+import re
+
+from lode.utilities.util import load_config
+from lode.database.schemas import schema_path
+from lode.database.utilities import (execute_and_commit_sql,
+                                     ex_sql_and_fetch)
+
+
+def is_partitioned(database, master_table):
+    """
+    Check the configuration to see whether a master table is partitioned
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. nodal_prices
+
+    Returns:
+    --------
+    Boolean: True if the master table is range partitioned
+    """
+    schemas = load_config()[database]['schemas']
+    return bool(schemas.get(master_table, {}).get("partitioned", False))
+
+
+def partition_column(database, master_table):
+    """ The column a master table is partitioned on """
+    schema = load_config()[database]['schemas'][master_table]
+    return schema.get("partition_column", "Trading_date")
+
+
+def parent_table_sql(master_table, column, schema_sql=None):
+    """
+    Convert the yearly schema of a master table into the definition of a
+    range partitioned parent table. The serial key column can no longer be
+    the primary key as a primary key must contain the partition column.
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+    column: The date column to partition on
+    schema_sql: The yearly schema, read from static/table_schemas if None
+
+    Returns:
+    --------
+    SQL: CREATE TABLE statement for the parent table
+    """
+    if schema_sql is None:
+        with open(schema_path(master_table), 'rb') as f:
+            schema_sql = f.read()
+
+    sql = schema_sql.replace("%s_%%s" % master_table, master_table)
+    sql = re.sub(r"\s+primary key", "", sql, flags=re.IGNORECASE)
+    sql = sql.strip().rstrip(';')
+
+    return "%s PARTITION BY RANGE (%s);" % (sql, column)
+
+
+def partition_bounds(year):
+    """ The FOR VALUES clause of the partition holding a year """
+    return "FOR VALUES FROM ('%s-01-01') TO ('%s-01-01')" % (year,
+                                                             int(year) + 1)
+
+
+def create_partition_sql(master_table, year):
+    """ SQL to create the partition of a master table for a year """
+    return "CREATE TABLE IF NOT EXISTS %s_%s PARTITION OF %s %s;" % (
+        master_table, year, master_table, partition_bounds(year))
+
+
+def attach_partition_sql(master_table, year):
+    """ SQL to attach an existing yearly table as a partition in place """
+    return "ALTER TABLE %s ATTACH PARTITION %s_%s %s;" % (
+        master_table, master_table, year, partition_bounds(year))
+
+
+def create_partitioned_table(database, master_table):
+    """
+    Create the partitioned parent table and a partition for each of the
+    split years in the configuration. Existing yearly tables are attached
+    as partitions in place, so no data is copied.
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. nodal_prices
+    """
+    schema = load_config()[database]['schemas'][master_table]
+    with open(schema.get("schema_location", schema_path(master_table)),
+              'rb') as f:
+        schema_sql = f.read()
+
+    column = partition_column(database, master_table)
+    execute_and_commit_sql(database, parent_table_sql(master_table, column,
+                                                      schema_sql))
+
+    for year in schema.get("split_years", []):
+        ensure_partition(database, master_table, year)
+
+
+def ensure_partition(database, master_table, year):
+    """
+    Make sure the partition for a year exists, e.g. before loading data into
+    it. A plain yearly table left from before the master table was
+    partitioned is attached, otherwise a new partition is created.
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. nodal_prices
+    year: The year of the partition
+    """
+    table = "%s_%s" % (master_table, year)
+
+    sql = """SELECT c.relispartition FROM pg_catalog.pg_class c
+             WHERE c.relname = '%s' AND c.relkind = 'r'""" % table
+    existing = ex_sql_and_fetch(database, sql)
+
+    if not existing:
+        execute_and_commit_sql(database,
+                               create_partition_sql(master_table, year))
+    elif not existing[0][0]:
+        print "Attaching %s as a partition of %s" % (table, master_table)
+        execute_and_commit_sql(database,
+                               attach_partition_sql(master_table, year))
+
+
+if __name__ == '__main__':
+    pass
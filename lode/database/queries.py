@@ -1,14 +1,44 @@
 from lode.database.utilities import (
-        check_required_range, check_optional_range, multi_query, merge_meta)
+        check_required_range, check_optional_range, multi_query, iter_query,
+        merge_meta, combine_aggregates, compact_frame)
+from lode.database.schemas import validate_columns
+from lode.database.partitions import is_partitioned
+from lode.database.rollups import rollups_cover, rollup_sql
+from lode.database.metadata import has_metadata, join_metadata, meta_keys
+from lode.utilities.util import load_config, periods_to_timestamps
+from lode.offers import stack_bands
 import query_builders as qb
 import warnings
 
+# The master tables for each type of offer
+offer_tables = {"Energy": 'energy_offers',
+                "PLSR": 'generatorreserves_offers',
+                "IL": 'ilreserves_offers'}
+
+# Core nodes are those of some importance to the market in some way
+# E.g. major population centre, generation site, HVDC etc
+# Major nodes are the big three, Auckland, NI HVDC, SI HVDC
+# Wind is a negative load at the moment on the GXPs
+node_groups = {"Core": ("OTA2201", "BEN2201", "HAY2201", "HLY2201",
+                        "MAN2201", "BPE2201", "PEN2201", "ISL2201"),
+               "Major": ("OTA2201", "HAY2201", "BEN2201"),
+               "Wind": ("TWC2201", "WDV1101", "WWD1101", "WWD1102",
+                        "WWD1103", "TWH0331")}
+
+# Map grid locations based upon which query is being run.
+offer_grid_points = {"Energy": "grid_injection_point",
+                     "PLSR": "grid_point",
+                     "IL": "grid_exit_point"}
 
 
 def query_nodal_price(begin_date=None, end_date=None, dates=None,
                       begin_period=None, end_period=None, periods=None,
                       minimum_price=None, maximum_price=None, nodes="Major",
-                      apply_meta=False, database=None):
+                      apply_meta=False, database=None, parallel=False,
+                      max_workers=None, fetch_method="auto",
+                      cache=False, columns=None, freq=None, agg=None,
+                      group_by=None, compact=False, float32=False,
+                      use_rollups=True, timestamps=False):
     """
     Query the Nodal Price in a simplified fashion with all of the information
     held behind the scenes. This function is one of the primary interfaces
@@ -30,13 +60,39 @@ def query_nodal_price(begin_date=None, end_date=None, dates=None,
     maximum_price: Maximum price to query, e.g. use in combination with
                    minimum_price
     apply_meta: Whether to apply the associated meta information to the
-                returned dataframe
+                returned dataframe, the metadata columns are snake_case,
+                e.g. region and island_name rather than Region and
+                Island Name
     database: What database to connect to, leave None for the default setup
+    parallel: Whether to run the queries for each year concurrently
+    max_workers: Maximum number of concurrent queries if running in parallel
+    fetch_method: How to fetch each query, 'copy' is faster for large
+                  results, 'read_sql' for small ones, 'auto' to choose
+    cache: Whether to use the on disk query cache, useful when repeatedly
+           running the same query
+    columns: Optional list of the columns to return, defaults to all
+    freq: Aggregate the prices to a frequency, 'D', 'W', 'M', 'Q' or 'A'
+    agg: Aggregations of the price to compute in the database rather than
+         returning every row, any of 'mean', 'sum', 'min', 'max', 'count'
+         and 'std', e.g. freq="D", agg=["mean", "max"] for daily prices,
+         'weighted' gives the demand weighted price from the rollups
+    group_by: Columns to group the aggregations by, defaults to Node, []
+              to aggregate over every node, e.g. with freq="M"
+    compact: Return smaller column types, nodes as categoricals, dates as
+             datetime64 and trading_period as int8, see compact_frame
+    float32: Also store the prices as float32 when compact
+    use_rollups: Answer aggregations from the daily, weekly or monthly
+                 rollup tables when they are enabled, have been built over
+                 the dates queried and no period or price filters are
+                 applied, see lode.database.rollups
+    timestamps: Add a timestamp column of the start of each trading period
+                in New Zealand clock time, see periods_to_timestamps
 
     Returns:
     --------
     A DataFrame containing all of the information with the specific filters
-    applied
+    applied, if aggregating this is indexed by the date and group_by columns
+    with a column for each aggregation
 
     """
 
@@ -44,55 +100,65 @@ def query_nodal_price(begin_date=None, end_date=None, dates=None,
     if database is None:
         database = 'nodal_database'
 
-    # Core nodes are those of some importance to the market in some way
-    # E.g. major population centre, generation site, HVDC etc
-    if nodes == "Core":
-        nodes = ("OTA2201", "BEN2201", "HAY2201", "HLY2201",
-                 "MAN2201", "BPE2201", "PEN2201", "ISL2201")
-    # Major nodes are the big three, Auckland, NI HVDC, SI HVDC
-    elif nodes == "Major":
-        nodes = ("OTA2201", "HAY2201", "BEN2201")
-
-    # Check the dates
-    check_required_range(dates, begin_date, end_date)
+    # A lone period bound raises here rather than being dropped
     check_optional_range(periods, begin_period, end_period)
 
-    all_queries = qb.create_date_limited_sql("nodal_prices", dates=dates,
-                                             begin_date=begin_date,
-                                             end_date=end_date,
-                                             date_col="Trading_date")
-
-    completed_queries = []
-    for sql in all_queries:
-        if periods:
-            sql += qb.add_equality_constraint('Trading_period', periods)
-
-        if (begin_period and end_period):
-            sql += qb.add_range_constraint('Trading_period',
-                                           begin_period, end_period)
-
-        if nodes:
-            sql += qb.add_equality_constraint('Node', nodes)
-
-        if minimum_price:
-            sql += qb.add_minimum_constraint('Price', minimum_price)
-
-        if maximum_price:
-            sql += qb.add_maximum_constraint('Price', maximum_price)
-
-        # Finish modifying the SQL so add a semicolon to end it
-        sql += ';'
-
-        # Add to the completed queries
-        completed_queries.append(sql)
+    # Coarse aggregations may be answered without the half hourly data
+    completed_queries = None
+    if (agg and use_rollups and
+            not any([periods, begin_period, end_period, minimum_price,
+                     maximum_price])):
+        check_required_range(dates, begin_date, end_date)
+
+        # Dates loaded before the rollups were built are not in them
+        if rollups_cover(database, "nodal_prices", dates, begin_date,
+                         end_date):
+            query = rollup_sql("nodal_prices", as_list(agg), freq=freq,
+                               group_by=group_by, dates=dates,
+                               begin_date=begin_date, end_date=end_date,
+                               nodes=resolve_nodes(nodes),
+                               filter_threshold=filter_table_threshold())
+            completed_queries = [query] if query else None
+
+    if completed_queries is None:
+        completed_queries = nodal_price_sql(
+            begin_date=begin_date, end_date=end_date, dates=dates,
+            begin_period=begin_period, end_period=end_period,
+            periods=periods, minimum_price=minimum_price,
+            maximum_price=maximum_price, nodes=nodes, columns=columns,
+            freq=freq, agg=agg, group_by=group_by,
+            partitioned=is_partitioned(database, "nodal_prices"),
+            filter_threshold=filter_table_threshold())
+
+    # Join the metadata in the database where it has been loaded
+    meta_in_sql = apply_meta and not agg and has_metadata(database)
+    if meta_in_sql:
+        completed_queries = [join_metadata(q) for q in completed_queries]
 
     # Query using the query to dataframe method and a generator
-    prices = multi_query(database, completed_queries)
+    # The aggregated results are already small
+    prices = multi_query(database, completed_queries, parallel=parallel,
+                         max_workers=max_workers, fetch_method=fetch_method,
+                         cache=cache, compact=compact and not agg,
+                         float32=float32)
+
+    if agg:
+        return combine_aggregates(prices, aggregate_keys(freq, group_by),
+                                  'Price', as_list(agg))
 
     if apply_meta:
         warnings.warn('Metadata may be incomplete')
+
+    if apply_meta and not meta_in_sql:
         prices = merge_meta(prices, 'price')
 
+        # The outer join of the metadata upcasts the compacted columns
+        if compact:
+            prices = compact_frame(prices, float32)
+
+    if timestamps:
+        prices = add_timestamps(prices)
+
     return prices
 
 
@@ -101,7 +167,11 @@ def query_nodal_demand(begin_date=None, end_date=None, dates=None,
                        nodes=None, minimum_demand=None,
                        maximum_demand=None, apply_meta=False,
                        meta_group=None, meta_agg=None,
-                       excl_nodes=None, database=None):
+                       excl_nodes=None, database=None, parallel=False,
+                       max_workers=None, fetch_method="auto",
+                       cache=False, columns=None, freq=None, agg=None,
+                       group_by=None, compact=False, float32=False,
+                       use_rollups=True, timestamps=False):
     """
     Query the nodal demand from the database at the GXP level. This results
     in very large DataFrames as there are approximately 450 nodes to query
@@ -123,76 +193,132 @@ def query_nodal_demand(begin_date=None, end_date=None, dates=None,
     nodes: What nodes to query, defaults to all
     minimum_demand: Minimum GXP demand figure, may wish to set to 0.
     maximum_demand: Maximum GXP demand figure
-    apply_meta: Whether to add the meta information such as richer locations
-    meta_group: Whether to group the nodes by any particular reference point
-    meta_agg: Apply a meta aggregation function
+    apply_meta: Whether to add the meta information such as richer locations,
+                joined in the database when the node_metadata table has been
+                loaded, see lode.database.metadata. The metadata columns are
+                snake_case, e.g. region and island_name rather than Region
+                and Island Name
+    meta_group: Whether to group the nodes by any particular reference point,
+                e.g. ["Region", "Trading_date", "Trading_period"] for the
+                demand of each region per period, the file headers and the
+                snake_case names are both accepted
+    meta_agg: Apply a meta aggregation to the demand of each group, giving a
+              column per aggregation, e.g. "sum" or ["sum", "mean"]. Those
+              supported by agg are computed in the database
     excl_nodes: What nodes to exclude, optionally set this to "Wind"
     database: Optional, what Database to connect to, leave this Node for the
               default, useful if you have changed the database names.
+    parallel: Whether to run the queries for each year concurrently
+    max_workers: Maximum number of concurrent queries if running in parallel
+    fetch_method: How to fetch each query, 'copy' is faster for large
+                  results, 'read_sql' for small ones, 'auto' to choose
+    cache: Whether to use the on disk query cache, useful when repeatedly
+           running the same query
+    columns: Optional list of the columns to return, defaults to all
+    freq: Aggregate the demand to a frequency, 'D', 'W', 'M', 'Q' or 'A'
+    agg: Aggregations of the demand to compute in the database rather than
+         returning every row, any of 'mean', 'sum', 'min', 'max', 'count'
+         and 'std', e.g. freq="M", agg="sum" for monthly GXP totals
+    group_by: Columns to group the aggregations by, defaults to Node, use
+              Island for island totals or [] for system totals
+    compact: Return smaller column types, nodes and islands as categoricals,
+             dates as datetime64 and trading_period as int8, this cuts the
+             memory of a year of GXP demand several fold
+    float32: Also store the demand as float32 when compact
+    use_rollups: Answer aggregations from the daily, weekly or monthly
+                 rollup tables when they are enabled, have been built over
+                 the dates queried and no period or demand filters are
+                 applied, see lode.database.rollups
+    timestamps: Add a timestamp column of the start of each trading period
+                in New Zealand clock time, see periods_to_timestamps
 
     Returns:
     --------
-    DataFrame: Pandas Dataframe containing the query information
+    DataFrame: Pandas Dataframe containing the query information, if
+               aggregating this is indexed by the date and group_by columns
+               with a column for each aggregation
     """
 
     if database is None:
         database = 'nodal_database'
 
-    # Helper function for the wind nodes as wind is a negative load at the
-    # moment on the GXPs
-    if excl_nodes == "Wind":
-        excl_nodes = ("TWC2201", "WDV1101", "WWD1101", "WWD1102",
-                      "WWD1103", "TWH0331")
-
-    # Error checking on the dates and period range consistencies
-    check_required_range(dates, begin_date, end_date)
+    # A lone period bound raises here rather than being dropped
     check_optional_range(periods, begin_period, end_period)
 
-    # Set up the initial SQL queries with dates loaded in
-    all_queries = qb.create_date_limited_sql("nodal_demand", dates=dates,
-                                             begin_date=begin_date,
-                                             end_date=end_date,
-                                             date_col="Trading_date")
+    # Coarse aggregations may be answered without the half hourly data
+    completed_queries = None
+    if (agg and use_rollups and
+            not any([periods, begin_period, end_period, minimum_demand,
+                     maximum_demand])):
+        check_required_range(dates, begin_date, end_date)
+
+        # Dates loaded before the rollups were built are not in them
+        if rollups_cover(database, "nodal_demand", dates, begin_date,
+                         end_date):
+            query = rollup_sql("nodal_demand", as_list(agg), freq=freq,
+                               group_by=group_by, dates=dates,
+                               begin_date=begin_date, end_date=end_date,
+                               nodes=resolve_nodes(nodes),
+                               excl_nodes=resolve_nodes(excl_nodes),
+                               filter_threshold=filter_table_threshold())
+            completed_queries = [query] if query else None
+
+    if completed_queries is None:
+        completed_queries = nodal_demand_sql(
+            begin_date=begin_date, end_date=end_date, dates=dates,
+            begin_period=begin_period, end_period=end_period,
+            periods=periods, nodes=nodes, minimum_demand=minimum_demand,
+            maximum_demand=maximum_demand, excl_nodes=excl_nodes,
+            columns=columns, freq=freq, agg=agg, group_by=group_by,
+            partitioned=is_partitioned(database, "nodal_demand"),
+            filter_threshold=filter_table_threshold())
+
+    # Join, and group by, the metadata in the database where it is loaded
+    meta_in_sql = apply_meta and not agg and has_metadata(database)
+    meta_grouped = meta_in_sql and meta_group and is_sql_agg(meta_agg)
+    if meta_in_sql:
+        completed_queries = [join_metadata(q) for q in completed_queries]
+
+    if meta_grouped:
+        completed_queries = [qb.add_aggregation(q, 'Demand',
+                                                as_list(meta_agg),
+                                                group_by=meta_keys(meta_group))
+                             for q in completed_queries]
+
+    demand = multi_query(database, completed_queries, parallel=parallel,
+                         max_workers=max_workers, fetch_method=fetch_method,
+                         cache=cache,
+                         compact=compact and not (agg or meta_grouped),
+                         float32=float32)
+
+    if agg:
+        return combine_aggregates(demand, aggregate_keys(freq, group_by),
+                                  'Demand', as_list(agg))
 
-    completed_queries = []
-    for sql in all_queries:
-        if periods:
-            sql += qb.add_equality_constraint('Trading_period', periods)
-
-        if (begin_period and end_period):
-            sql += qb.add_range_constraint('Trading_period',
-                                           begin_period, end_period)
-
-        if nodes:
-            sql += qb.add_equality_constraint("Node", nodes)
-
-        if minimum_demand:
-            # Don't use zero values, instead use a very small float
-            if minimum_demand == 0:
-                minimum_demand = 0.0001
-            sql += qb.add_minimum_constraint("Demand", minimum_demand)
-
-        if maximum_demand:
-            sql += qb.add_maximum_constraint("Demand", maximum_demand)
+    if apply_meta:
+        warnings.warn('Metadata may be incomplete')
 
-        # Exclude certain nodes
-        if excl_nodes:
-            sql += qb.add_exclusion_constraint("Node", excl_nodes)
+    if meta_grouped:
+        return combine_aggregates(demand, meta_keys(meta_group), 'Demand',
+                                  as_list(meta_agg))
 
-        sql += ';'
-        completed_queries.append(sql)
+    if apply_meta and not meta_in_sql:
+        demand = merge_meta(demand, 'demand')
 
-    demand = multi_query(database, completed_queries)
+        # The outer join of the metadata upcasts the compacted columns
+        if compact:
+            demand = compact_frame(demand, float32)
 
-    if apply_meta:
-        warnings.warn('Metadata may be incomplete')
-        demand = merge_meta(demand, 'demand')
+    # The same columns as the aggregation in the database, one per meta_agg
+    if apply_meta and meta_group and meta_agg:
+        grouped = demand.groupby(meta_keys(meta_group))["demand"]
+        aggregate = grouped.aggregate([meta_agg] if callable(meta_agg)
+                                      else as_list(meta_agg))
 
-        if meta_group and meta_agg:
-            grouped = demand.groupby(meta_group)
-            aggregate = grouped.aggregate(meta_agg)
+        return aggregate
 
-            return aggregate
+    if timestamps:
+        demand = add_timestamps(demand)
 
     return demand
 
@@ -200,12 +326,15 @@ def query_nodal_demand(begin_date=None, end_date=None, dates=None,
 def query_offer(offer_type, dates=None, begin_date=None, end_date=None,
                 periods=None, begin_period=None, end_period=None,
                 companies=None, stations=None, nodes=None,
-                as_offerframe=True, database=None):
+                as_offerframe=True, database=None, parallel=False,
+                max_workers=None, fetch_method="auto",
+                cache=False, columns=None, compact=False, float32=False,
+                timestamps=False):
     """
 
     Master function to query the submitted Energy, Generator Reserve and IL
     offers in the NZEM. Has some basic filters as well as the ability to return
-    the
+    the offers stacked into one row per offer band, see lode.offers
 
     Parameters:
     -----------
@@ -219,79 +348,504 @@ def query_offer(offer_type, dates=None, begin_date=None, end_date=None,
     nodes: What nodes to query, defaults to all
     companies: What companies to query, e.g. MRPL, this is a four letter code
     stations: What stations to query, three letter code
-    as_offerframe: Convert the raw offer to an OfferFrame, note requires
-                   OfferFrame to be installed
+    as_offerframe: Stack the offer bands into one row per band with
+                   lode.offers.stack_bands, each shard is stacked as it
+                   arrives and the unused bands are dropped
+    database: Optional, what Database to connect to
+    parallel: Whether to run the queries for each year concurrently
+    max_workers: Maximum number of concurrent queries if running in parallel
+    fetch_method: How to fetch each query, 'copy' is faster for large
+                  results, 'read_sql' for small ones, 'auto' to choose
+    cache: Whether to use the on disk query cache, useful when repeatedly
+           running the same query
+    columns: Optional list of the columns to return, defaults to all
+    compact: Return smaller column types, companies, stations and grid points
+             as categoricals, dates as datetime64 and small integers
+             downcast
+    float32: Also store the band prices and quantities as float32 when
+             compact
+    timestamps: Add a timestamp column of the start of each trading period
+                in New Zealand clock time
 
     Returns:
     --------
-    OfferFrame or DataFrame of the offers queried
+    DataFrame of the offers queried, band level if as_offerframe
 
     """
 
     if database is None:
         database = 'offer_database'
 
-    # Create the tables
-    tables = {"Energy": 'energy_offers',
-              "PLSR": 'generatorreserves_offers',
-              "IL": 'ilreserves_offers'}
+    completed_queries = offer_sql(
+        offer_type, dates=dates, begin_date=begin_date, end_date=end_date,
+        periods=periods, begin_period=begin_period, end_period=end_period,
+        companies=companies, stations=stations, nodes=nodes, columns=columns,
+        partitioned=is_partitioned(database, offer_tables[offer_type]),
+        filter_threshold=filter_table_threshold())
+
+    # Each shard is stacked as it arrives so only one is ever held wide
+    transform = None
+    if as_offerframe:
+        def transform(df):
+            return stack_bands(df, float32=compact and float32)
+
+    offers = multi_query(database, completed_queries, parallel=parallel,
+                         max_workers=max_workers, fetch_method=fetch_method,
+                         cache=cache, compact=compact, float32=float32,
+                         transform=transform)
+
+    if timestamps:
+        offers = add_timestamps(offers)
+
+    return offers
+
+
+def iter_nodal_price(begin_date=None, end_date=None, dates=None,
+                     begin_period=None, end_period=None, periods=None,
+                     minimum_price=None, maximum_price=None, nodes="Major",
+                     apply_meta=False, database=None, chunksize=None,
+                     range_break="Month", columns=None, compact=False,
+                     float32=False, timestamps=False):
+    """
+    Stream the Nodal Prices as a sequence of smaller DataFrames rather than
+    returning a single DataFrame. This is useful for reducing large date
+    ranges on a RAM limited machine as only one chunk needs to be held in
+    memory at a time. Takes the same filters as query_nodal_price.
+
+    Parameters:
+    -----------
+    chunksize: Number of rows per DataFrame, if None a DataFrame is yielded
+               for each range_break query instead
+    range_break: Whether to split a date range into 'Month' or 'Year' queries
+    compact: Shrink the column types of each chunk, the categoricals are
+             per chunk so concatenating chunks falls back to object
+    See query_nodal_price for the remaining parameters
+
+    Returns:
+    --------
+    Generator of DataFrames containing the information with the specific
+    filters applied
+
+    """
+
+    if database is None:
+        database = 'nodal_database'
+
+    completed_queries = nodal_price_sql(
+        begin_date=begin_date, end_date=end_date, dates=dates,
+        begin_period=begin_period, end_period=end_period, periods=periods,
+        minimum_price=minimum_price, maximum_price=maximum_price, nodes=nodes,
+        range_break=range_break, columns=columns,
+        partitioned=is_partitioned(database, "nodal_prices"),
+        filter_threshold=filter_table_threshold())
+
+    meta_in_sql = apply_meta and has_metadata(database)
+    if apply_meta:
+        warnings.warn('Metadata may be incomplete')
+
+    if meta_in_sql:
+        completed_queries = [join_metadata(q) for q in completed_queries]
+
+    for prices in iter_query(database, completed_queries, chunksize):
+        if apply_meta and not meta_in_sql:
+            prices = merge_meta(prices, 'price')
+
+        if compact:
+            prices = compact_frame(prices, float32)
+
+        if timestamps:
+            prices = add_timestamps(prices)
+
+        yield prices
+
 
-    # Map grid locations based upon which query is being run.
-    grid_map = {"Energy": "grid_injection_point",
-                "PLSR": "grid_point",
-                "IL": "grid_exit_point"}
+def iter_nodal_demand(begin_date=None, end_date=None, dates=None,
+                      begin_period=None, end_period=None, periods=None,
+                      nodes=None, minimum_demand=None, maximum_demand=None,
+                      apply_meta=False, excl_nodes=None, database=None,
+                      chunksize=None, range_break="Month", columns=None,
+                      compact=False, float32=False, timestamps=False):
+    """
+    Stream the nodal demand as a sequence of smaller DataFrames rather than
+    returning a single DataFrame, a year of GXP demand is often around 1GB
+    in memory. Takes the same filters as query_nodal_demand.
+
+    Parameters:
+    -----------
+    chunksize: Number of rows per DataFrame, if None a DataFrame is yielded
+               for each range_break query instead
+    range_break: Whether to split a date range into 'Month' or 'Year' queries
+    compact: Shrink the column types of each chunk, the categoricals are
+             per chunk so concatenating chunks falls back to object
+    See query_nodal_demand for the remaining parameters
 
+    Returns:
+    --------
+    Generator of DataFrames containing the query information
+    """
+
+    if database is None:
+        database = 'nodal_database'
+
+    completed_queries = nodal_demand_sql(
+        begin_date=begin_date, end_date=end_date, dates=dates,
+        begin_period=begin_period, end_period=end_period, periods=periods,
+        nodes=nodes, minimum_demand=minimum_demand,
+        maximum_demand=maximum_demand, excl_nodes=excl_nodes,
+        range_break=range_break, columns=columns,
+        partitioned=is_partitioned(database, "nodal_demand"),
+        filter_threshold=filter_table_threshold())
+
+    meta_in_sql = apply_meta and has_metadata(database)
+    if apply_meta:
+        warnings.warn('Metadata may be incomplete')
+
+    if meta_in_sql:
+        completed_queries = [join_metadata(q) for q in completed_queries]
+
+    for demand in iter_query(database, completed_queries, chunksize):
+        if apply_meta and not meta_in_sql:
+            demand = merge_meta(demand, 'demand')
+
+        if compact:
+            demand = compact_frame(demand, float32)
+
+        if timestamps:
+            demand = add_timestamps(demand)
+
+        yield demand
+
+
+def iter_offer(offer_type, dates=None, begin_date=None, end_date=None,
+               periods=None, begin_period=None, end_period=None,
+               companies=None, stations=None, nodes=None, database=None,
+               chunksize=None, range_break="Month", columns=None,
+               compact=False, float32=False, timestamps=False,
+               as_offerframe=False):
+    """
+    Stream the submitted Energy, Generator Reserve and IL offers as a
+    sequence of smaller DataFrames rather than returning a single DataFrame.
+    Takes the same filters as query_offer.
+
+    Parameters:
+    -----------
+    chunksize: Number of rows per DataFrame, if None a DataFrame is yielded
+               for each range_break query instead
+    range_break: Whether to split a date range into 'Month' or 'Year' queries
+    compact: Shrink the column types of each chunk, the categoricals are
+             per chunk so concatenating chunks falls back to object
+    as_offerframe: Stack the bands of each chunk into one row per band,
+                   see lode.offers.stack_bands
+    See query_offer for the remaining parameters
+
+    Returns:
+    --------
+    Generator of DataFrames of the offers queried
+
+    """
+
+    if database is None:
+        database = 'offer_database'
+
+    completed_queries = offer_sql(
+        offer_type, dates=dates, begin_date=begin_date, end_date=end_date,
+        periods=periods, begin_period=begin_period, end_period=end_period,
+        companies=companies, stations=stations, nodes=nodes,
+        range_break=range_break, columns=columns,
+        partitioned=is_partitioned(database, offer_tables[offer_type]),
+        filter_threshold=filter_table_threshold())
+
+    for offers in iter_query(database, completed_queries, chunksize):
+        if compact:
+            offers = compact_frame(offers, float32)
+
+        if as_offerframe:
+            offers = stack_bands(offers, float32=compact and float32)
+
+        if timestamps:
+            offers = add_timestamps(offers)
+
+        yield offers
+
+
+def nodal_price_sql(begin_date=None, end_date=None, dates=None,
+                    begin_period=None, end_period=None, periods=None,
+                    minimum_price=None, maximum_price=None, nodes="Major",
+                    range_break="Year", columns=None, freq=None, agg=None,
+                    group_by=None, partitioned=False,
+                    filter_threshold=qb.DEFAULT_FILTER_TABLE_THRESHOLD):
+    """
+    Construct the SQL queries, one per table shard, for a Nodal Price query.
+    See query_nodal_price for the filters which may be applied. If the master
+    table is partitioned a single query against it is built instead.
+
+    Returns:
+    --------
+    completed_queries: List of (sql, params) queries, see
+                       query_builders.add_constraints
+    """
+
+    nodes = resolve_nodes(nodes)
+
+    # Check the dates
     check_required_range(dates, begin_date, end_date)
     check_optional_range(periods, begin_period, end_period)
 
-    # Create the queries
-    all_queries = qb.create_date_limited_sql(tables[offer_type], dates=dates,
-                                            begin_date=begin_date,
-                                            end_date=end_date)
+    # An empty group_by aggregates over every node, e.g. system totals
+    if group_by is None:
+        group_by = ["Node"]
+
+    if agg:
+        validate_columns("nodal_prices", group_by)
+
+    all_queries = qb.create_date_limited_sql("nodal_prices", dates=dates,
+                                             begin_date=begin_date,
+                                             end_date=end_date,
+                                             date_col="Trading_date",
+                                             range_break=range_break,
+                                             columns=columns,
+                                             partitioned=partitioned)
+
+    completed_queries = []
+    for query in all_queries:
+        constraints = []
+        if periods:
+            constraints.append(qb.add_equality_constraint(
+                'Trading_period', as_periods(periods)))
 
+        if (begin_period and end_period):
+            constraints.append(qb.add_range_constraint(
+                'Trading_period', begin_period, end_period))
+
+        if nodes:
+            constraints.append(qb.add_equality_constraint(
+                'Node', nodes, threshold=filter_threshold))
+
+        if minimum_price:
+            constraints.append(qb.add_minimum_constraint('Price',
+                                                         minimum_price))
+
+        if maximum_price:
+            constraints.append(qb.add_maximum_constraint('Price',
+                                                         maximum_price))
+
+        sql, params = qb.add_constraints(query, constraints)
+
+        if agg:
+            sql, params = qb.add_aggregation(
+                (sql, params), 'Price', as_list(agg), freq=freq,
+                group_by=group_by, date_col="Trading_date")
+
+        # Finish modifying the SQL so add a semicolon to end it
+        sql += ';'
+
+        # Add to the completed queries
+        completed_queries.append((sql, params))
+
+    return completed_queries
 
 
+def nodal_demand_sql(begin_date=None, end_date=None, dates=None,
+                     begin_period=None, end_period=None, periods=None,
+                     nodes=None, minimum_demand=None, maximum_demand=None,
+                     excl_nodes=None, range_break="Year", columns=None,
+                     freq=None, agg=None, group_by=None, partitioned=False,
+                     filter_threshold=qb.DEFAULT_FILTER_TABLE_THRESHOLD):
+    """
+    Construct the SQL queries, one per table shard, for a nodal demand query.
+    See query_nodal_demand for the filters which may be applied. If the
+    master table is partitioned a single query against it is built instead.
+
+    Returns:
+    --------
+    completed_queries: List of (sql, params) queries, see
+                       query_builders.add_constraints
+    """
+
+    excl_nodes = resolve_nodes(excl_nodes)
+
+    # Error checking on the dates and period range consistencies
+    check_required_range(dates, begin_date, end_date)
+    check_optional_range(periods, begin_period, end_period)
+
+    # An empty group_by aggregates over every node, e.g. system totals
+    if group_by is None:
+        group_by = ["Node"]
+
+    if agg:
+        validate_columns("nodal_demand", group_by)
+
+    # Set up the initial SQL queries with dates loaded in
+    all_queries = qb.create_date_limited_sql("nodal_demand", dates=dates,
+                                             begin_date=begin_date,
+                                             end_date=end_date,
+                                             date_col="Trading_date",
+                                             range_break=range_break,
+                                             columns=columns,
+                                             partitioned=partitioned)
+
+    completed_queries = []
+    for query in all_queries:
+        constraints = []
+        if periods:
+            constraints.append(qb.add_equality_constraint(
+                'Trading_period', as_periods(periods)))
+
+        if (begin_period and end_period):
+            constraints.append(qb.add_range_constraint(
+                'Trading_period', begin_period, end_period))
+
+        if nodes:
+            constraints.append(qb.add_equality_constraint(
+                "Node", nodes, threshold=filter_threshold))
+
+        if minimum_demand:
+            # Don't use zero values, instead use a very small float
+            if minimum_demand == 0:
+                minimum_demand = 0.0001
+            constraints.append(qb.add_minimum_constraint("Demand",
+                                                         minimum_demand))
+
+        if maximum_demand:
+            constraints.append(qb.add_maximum_constraint("Demand",
+                                                         maximum_demand))
+
+        # Exclude certain nodes
+        if excl_nodes:
+            constraints.append(qb.add_exclusion_constraint(
+                "Node", excl_nodes, threshold=filter_threshold))
+
+        sql, params = qb.add_constraints(query, constraints)
+
+        if agg:
+            sql, params = qb.add_aggregation(
+                (sql, params), 'Demand', as_list(agg), freq=freq,
+                group_by=group_by, date_col="Trading_date")
+
+        sql += ';'
+        completed_queries.append((sql, params))
+
+    return completed_queries
+
+
+def offer_sql(offer_type, dates=None, begin_date=None, end_date=None,
+              periods=None, begin_period=None, end_period=None,
+              companies=None, stations=None, nodes=None, range_break="Year",
+              columns=None, partitioned=False,
+              filter_threshold=qb.DEFAULT_FILTER_TABLE_THRESHOLD):
+    """
+    Construct the SQL queries, one per table shard, for an offer query.
+    See query_offer for the filters which may be applied. If the master
+    table is partitioned a single query against it is built instead.
+
+    Returns:
+    --------
+    completed_queries: List of (sql, params) queries, see
+                       query_builders.add_constraints
+    """
+
+    check_required_range(dates, begin_date, end_date)
+    check_optional_range(periods, begin_period, end_period)
+
+    # Create the queries
+    all_queries = qb.create_date_limited_sql(offer_tables[offer_type],
+                                             dates=dates,
+                                             begin_date=begin_date,
+                                             end_date=end_date,
+                                             range_break=range_break,
+                                             columns=columns,
+                                             partitioned=partitioned)
+
     # Add all of the other constraints:
     completed_queries = []
-    for sql in all_queries:
+    for query in all_queries:
+        constraints = []
 
         if periods:
-            sql += qb.add_equality_constraint('trading_period', periods)
+            constraints.append(qb.add_equality_constraint(
+                'trading_period', as_periods(periods)))
 
         elif (begin_period and end_period):
-            sql += qb.add_range_constraint('trading_period',
-                                           begin_period, end_period)
+            constraints.append(qb.add_range_constraint(
+                'trading_period', begin_period, end_period))
 
         if companies:
-            sql += qb.add_equality_constraint('company', companies)
+            constraints.append(qb.add_equality_constraint(
+                'company', companies, threshold=filter_threshold))
 
         if stations:
-            sql += qb.add_equality_constraint('station', stations)
+            constraints.append(qb.add_equality_constraint(
+                'station', stations, threshold=filter_threshold))
 
         if nodes:
-            sql += qb.add_equality_constraint(grid_map[offer_type], nodes)
+            constraints.append(qb.add_equality_constraint(
+                offer_grid_points[offer_type], nodes,
+                threshold=filter_threshold))
 
         # Once all constraints have been added end the SQL statement
-        sql += ';'
-        completed_queries.append(sql)
+        sql, params = qb.add_constraints(query, constraints)
+        completed_queries.append((sql + ';', params))
 
-    offers = multi_query(database, completed_queries)
+    return completed_queries
+
+
+def filter_table_threshold():
+    """ Lists of more filter values than this are joined against a
+    FilterTable, set by the "filter_table_threshold" key of the config
+    """
+    return load_config().get("filter_table_threshold",
+                             qb.DEFAULT_FILTER_TABLE_THRESHOLD)
 
-    # Optional to return it as an OfferFrame
-    if as_offerframe:
-        try:
-            from OfferPandas import Frame
-        except ImportError:
-            raise ImportError('OfferPandas has not been installed')
 
-        warnings.warn(
-            'Metadata may be incomplete or erroneous use at your own risk')
+def aggregate_keys(freq=None, group_by=None):
+    """ The columns an aggregated nodal price or demand query is grouped by
+    """
+    keys = ["Trading_date"] if freq else []
+    return keys + list(["Node"] if group_by is None else group_by)
 
-        df = Frame(offers)
-        return df.modify_frame()
 
-    return offers
+def add_timestamps(df):
+    """ Add a timestamp column from the trading_date and trading_period
+    columns, these must have been queried
+    """
+    if not {"trading_date", "trading_period"}.issubset(df.columns):
+        raise ValueError("Timestamps need the trading_date and "
+                         "trading_period columns")
+
+    df["timestamp"] = periods_to_timestamps(df["trading_date"].values,
+                                            df["trading_period"].values)
+    return df
+
+
+def resolve_nodes(nodes):
+    """ Expand a named group of nodes, e.g. "Core", to the node codes """
+    if isinstance(nodes, basestring):
+        return node_groups.get(nodes, nodes)
+    return nodes
+
+
+def as_periods(periods):
+    """ Trading periods as ints, so a list binds as an integer array """
+    if hasattr(periods, '__iter__'):
+        return [int(p) for p in periods]
+    return int(periods)
+
+
+def is_sql_agg(agg):
+    """ Whether an aggregation can be computed with add_aggregation rather
+    than being a pandas function or mapping
+    """
+    if isinstance(agg, basestring):
+        agg = [agg]
+    return (isinstance(agg, (list, tuple)) and bool(agg) and
+            all(a in qb.aggregate_partials for a in agg))
+
 
+def as_list(x):
+    """ Allow a single string to be passed where a list is expected """
+    if isinstance(x, basestring):
+        return [x]
+    return list(x)
 
 
 if __name__ == '__main__':
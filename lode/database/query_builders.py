@@ -1,13 +1,17 @@
 from collections import defaultdict
 import pandas as pd
 import datetime
-from lode.utilities.util import parse_date
+import hashlib
+import numbers
+from lode.utilities.util import parse_date, parse_dates
+from lode.database.schemas import validate_columns
 from itertools import izip
 
 
 def create_date_limited_sql(master_table, dates=None,
                             begin_date=None, end_date=None,
-                            date_col="trading_date", range_break="Year"):
+                            date_col="trading_date", range_break="Year",
+                            columns=None, partitioned=False):
     """
     This is the initialisation function which takes into account the separation
     of the tables on a year by year basis in the Database (due to memory
@@ -26,32 +30,48 @@ def create_date_limited_sql(master_table, dates=None,
     date_col: What column the dates are contained in
     range_break: A modification for performance purposes, default set to Year
                  but setting to 'Month' may result in reduced memory usage.
+    columns: Optional list of columns to return, defaults to all of them.
+             These are checked against the table schema before any query is
+             run and a ValueError raised for unknown columns.
+    partitioned: Whether the master table is a range partitioned table, in
+                 which case the master table is queried directly and a
+                 'Year' range break results in a single query.
 
     Returns:
     --------
-    all_queries: A list of SQL queries contained as strings
+    all_queries: A list of (sql, params) queries, the dates are bound as
+                 parameters, see add_constraints
     """
 
+    if columns:
+        validate_columns(master_table, columns)
+
     all_queries = []
     # If passing a selection of date objects
     if dates:
         if hasattr(dates, '__iter__'):
-            return list(singular_sql_dates(master_table, dates, date_col))
+            return list(singular_sql_dates(master_table, dates, date_col,
+                                           columns=columns,
+                                           partitioned=partitioned))
 
         else:
             dt = parse_date(dates)
-            return ["""SELECT * FROM %s_%s WHERE %s='%s'""" % (
-                master_table, dt.year, date_col, dt.strftime('%d-%m-%Y'))]
+            return [("""SELECT %s FROM %s WHERE %s = %%s""" % (
+                select_columns(columns),
+                shard_table(master_table, dt.year, partitioned), date_col),
+                [dt.date()])]
 
     # Work with Date Ranges
     else:
         if range_break == "Year":
             return list(yearly_sql_dates(begin_date, end_date, master_table,
-                                         date_col))
+                                         date_col, columns=columns,
+                                         partitioned=partitioned))
 
         elif range_break == "Month":
             return list(monthly_sql_dates(begin_date, end_date, master_table,
-                                          date_col))
+                                          date_col, columns=columns,
+                                          partitioned=partitioned))
 
         else:
             raise ValueError("""Range Breaks for %s have not been
@@ -60,7 +80,8 @@ def create_date_limited_sql(master_table, dates=None,
     return all_queries
 
 
-def singular_sql_dates(master_table, dates, date_col):
+def singular_sql_dates(master_table, dates, date_col, columns=None,
+                       partitioned=False):
     """
     For a list of dates this will create a series of SQL queries with the
     basic format SELECT * FROM table where dates in date_col. It has a little
@@ -78,41 +99,98 @@ def singular_sql_dates(master_table, dates, date_col):
            and objects to construct the SQL queries for. These may be in any
            order for any number of dates
     date_col: The column name for the dates in the SQL database
+    columns: Optional list of the columns to select, defaults to all
+    partitioned: Whether to query a partitioned master table in one query
 
     Returns:
     --------
     SQL: This is a generator expression where each iteration is a separate
-         SQL query for each year with all of the dates from that year contained
-         as a selection query
+         (sql, params) query for each year with all of the dates from that
+         year contained as a selection query
 
     """
 
-    dts = [parse_date(x) for x in dates]
+    dts = parse_dates(dates)
 
     # Map the specific dates to the specific years isomg a default dict
     years_dict = defaultdict(list)
     for dt in dts:
-        years_dict[dt.year].append(dt)
+        years_dict[None if partitioned else dt.year].append(dt)
 
     # Iterate through each of the years and add the trading dates belonging
     # to each query to a specific query, yield this SQL string as a generator
-    for year in years_dict:
-        # Set up a custom string and then place it inside brackets for
-        # Use in the query
-        strings = join_date_strings(years_dict[year])
-        date_string = "('%s')" % strings
-
+    # Sorting means the same set of dates always gives the same queries
+    for year in sorted(years_dict):
         # The base query string to use
-        query_string = """ SELECT * FROM %s_%s WHERE %s in %s"""
+        query_string = """ SELECT %s FROM %s WHERE %s"""
 
         # Substitute the values into the string
-        SQL = query_string % (master_table, year, date_col, date_string)
+        constraint, params = date_list_constraint(date_col, years_dict[year])
+        SQL = query_string % (select_columns(columns),
+                              shard_table(master_table, year), constraint)
+
+        yield SQL, params
+
+
+def date_ranges(dates):
+    """
+    Collapse dates into runs of consecutive days
+
+    Parameters:
+    -----------
+    dates: Iterable of datetime objects, in any order with duplicates
+
+    Returns:
+    --------
+    list: Sorted (first, last) tuples of each run of consecutive days
+    """
+    ranges = []
+    for dt in sorted(set(x.date() for x in dates)):
+        if ranges and (dt - ranges[-1][1]).days == 1:
+            ranges[-1] = (ranges[-1][0], dt)
+        else:
+            ranges.append((dt, dt))
+
+    return ranges
+
+
+def date_list_constraint(date_col, dates, min_range_days=3):
+    """
+    The WHERE condition selecting a list of dates. Runs of consecutive days
+    become BETWEEN ranges, which scan the date index once per run, and the
+    remaining dates are bound as a single array for = ANY.
+
+    Parameters:
+    -----------
+    date_col: The column containing the trading dates
+    dates: Iterable of datetime objects
+    min_range_days: Runs of at least this many days use BETWEEN
+
+    Returns:
+    --------
+    SQL: The condition, in brackets if it has several parts
+    params: List of the dates bound to the condition
+    """
+    conditions, params, listed = [], [], []
+    for first, last in date_ranges(dates):
+        if (last - first).days + 1 >= min_range_days:
+            conditions.append("%s BETWEEN %%s AND %%s" % date_col)
+            params.extend([first, last])
+        else:
+            listed.extend(first + datetime.timedelta(days=i)
+                          for i in range((last - first).days + 1))
+
+    if listed:
+        conditions.append("%s = ANY(%%s)" % date_col)
+        params.append(listed)
 
-        yield SQL
+    if len(conditions) == 1:
+        return conditions[0], params
+    return "(%s)" % " OR ".join(conditions), params
 
 
-def yearly_sql_dates(begin_date, end_date, mtable, date_col,
-                     df="%d-%m-%Y"):
+def yearly_sql_dates(begin_date, end_date, mtable, date_col, columns=None,
+                     partitioned=False):
     """
     Create full year SQL dates which ar every useful if a range goes over
     the yearly amount. For example, if the requested date range is
@@ -133,31 +211,36 @@ def yearly_sql_dates(begin_date, end_date, mtable, date_col,
     end_date: String or datetime object of the last date to consider
     mtable: What table to query (master)
     date_col: The column containing the trading dates
-    df: The date format to use if needed
+    columns: Optional list of the columns to select, defaults to all
+    partitioned: Whether to query a partitioned master table in one query
 
     Returns:
     --------
-    query_string: A string containing the appropriate date SQL query as a base
+    query: An (sql, params) pair of the appropriate date SQL query as a base
 
     """
     # Parse the dates as they're probably strings
-    begin_date = parse_date(begin_date)
-    end_date = parse_date(end_date)
+    begin_date = parse_date(begin_date).date()
+    end_date = parse_date(end_date).date()
+
+    select = select_columns(columns)
+    query_string = """SELECT %s FROM %s_%s WHERE %s BETWEEN %%s AND %%s"""
 
-    # Set up dummy strings
-    jan1, dec31 = "01-01-%s", "31-01-%s"
-    query_string = """SELECT * FROM %s_%s WHERE %s BETWEEN '%s' AND '%s'"""
+    # Partitioned tables are pruned by Postgres so a single query suffices
+    if partitioned:
+        yield ("""SELECT %s FROM %s WHERE %s BETWEEN %%s AND %%s""" % (
+            select, mtable, date_col), [begin_date, end_date])
 
-    if begin_date.year == end_date.year:
-        fd, ld = begin_date.strftime(df), end_date.strftime(df)
-        yield query_string % (mtable, begin_date.year, date_col, fd, ld)
+    elif begin_date.year == end_date.year:
+        yield (query_string % (select, mtable, begin_date.year, date_col),
+               [begin_date, end_date])
 
     else:
 
         # Return the first string
         # From the beginning date to the 31st of December
-        fd, ld = begin_date.strftime(df), dec31 % begin_date.year
-        yield query_string % (mtable, begin_date.year, date_col, fd, ld)
+        yield (query_string % (select, mtable, begin_date.year, date_col),
+               [begin_date, datetime.date(begin_date.year, 12, 31)])
 
         # Yield the intermediate dates if any
         # For example, if we are "12/12/2013" and "02/04/2015" we would
@@ -165,17 +248,19 @@ def yearly_sql_dates(begin_date, end_date, mtable, date_col,
         years = range(begin_date.year + 1, end_date.year)
         if len(years) > 0:
             for year in years:
-                fd, ld = jan1 % year, dec31 % year
-                yield query_string % (mtable, year, date_col, fd, ld)
+                yield (query_string % (select, mtable, year, date_col),
+                       [datetime.date(year, 1, 1),
+                        datetime.date(year, 12, 31)])
 
         # Yield the last date
         # This is from the 1st of January of that year to the ending date
         if end_date.year != begin_date.year:
-            fd, ld = jan1 % end_date.year, end_date.strftime(df)
-            yield query_string % (mtable, end_date.year, date_col, fd, ld)
+            yield (query_string % (select, mtable, end_date.year, date_col),
+                   [datetime.date(end_date.year, 1, 1), end_date])
 
 
-def monthly_sql_dates(begin_date, end_date, mtable, date_col, df='%d-%m-%Y'):
+def monthly_sql_dates(begin_date, end_date, mtable, date_col, columns=None,
+                      partitioned=False):
     """
     Returns queries which have been isolated on a per month basis which can
     then be fed into a DataFrame.
@@ -193,14 +278,16 @@ def monthly_sql_dates(begin_date, end_date, mtable, date_col, df='%d-%m-%Y'):
     end_date: The last date as either a datetime object or string
     mtable: The master table to query from
     date_col: What column contains date information
-    df: What date format to use
+    columns: Optional list of the columns to select, defaults to all
+    partitioned: Whether the master table is partitioned
 
     Returns:
     --------
-    query_string: The SQL query which we may then modify
+    query: The (sql, params) query which we may then modify
 
     """
-    query_string = """SELECT * FROM %s_%s WHERE %s BETWEEN '%s' AND '%s'"""
+    select = select_columns(columns)
+    query_string = """SELECT %s FROM %s WHERE %s BETWEEN %%s AND %%s"""
 
     # Parse the dates as they're probably strings
     begin_date = parse_date(begin_date)
@@ -211,7 +298,7 @@ def monthly_sql_dates(begin_date, end_date, mtable, date_col, df='%d-%m-%Y'):
     month_range_p1 = [x + datetime.timedelta(days=1) for x in
                       month_range]
 
-    if month_range[-1] == end_date:
+    if month_range and month_range[-1] == end_date:
         end_dates = month_range
     else:
         end_dates = month_range + [end_date]
@@ -221,9 +308,115 @@ def monthly_sql_dates(begin_date, end_date, mtable, date_col, df='%d-%m-%Y'):
     begin_dates = [begin_date] + month_range_p1
 
     for s, e in izip(begin_dates, end_dates):
-        beg, end = s.strftime(df), e.strftime(df)
+        yield (query_string % (select,
+                               shard_table(mtable, s.year, partitioned),
+                               date_col), [s.date(), e.date()])
+
+
+def shard_table(master_table, year=None, partitioned=False):
+    """
+    The table to query for a year of data, either the yearly table or the
+    master table itself if it is partitioned (or year is None)
+    """
+    if partitioned or year is None:
+        return master_table
+
+    return "%s_%s" % (master_table, year)
+
+
+def select_columns(columns=None):
+    """
+    Create the column list of a SELECT statement, all columns if None
+    """
+    if not columns:
+        return "*"
+
+    return ", ".join(columns)
+
+
+def add_aggregation(sql, value_col, agg, freq=None, group_by=None,
+                    date_col="trading_date"):
+    """
+    Wrap a shard query so that it returns the partial aggregates of a column
+    grouped by a date frequency and/or other columns rather than every row.
+    The partial aggregates (count, sum, sum of squares, min and max) are
+    chosen so that the results from several shards may be combined exactly
+    afterwards with combine_aggregates, e.g. a week which spans two years.
+
+    Parameters:
+    -----------
+    sql: The shard query to aggregate, an SQL string or (sql, params) pair,
+         a trailing semicolon is permitted
+    value_col: The column to aggregate, e.g. Price
+    agg: A list of aggregations, any of 'mean', 'sum', 'min', 'max',
+         'count' and 'std'
+    freq: Pandas style frequency to truncate the dates to, 'D', 'W', 'M',
+          'Q' or 'A', None to not group by date
+    group_by: Optional list of further columns to group by, e.g. Node
+    date_col: The column containing the dates
+
+    Returns:
+    --------
+    SQL: The aggregated query, of the same kind as the query passed
+    """
+
+    if freq is not None and freq not in freq_fields:
+        raise ValueError("Frequency %s is not one of %s" % (
+            freq, ", ".join(sorted(freq_fields))))
+
+    unknown = [a for a in agg if a not in aggregate_partials]
+    if unknown:
+        raise ValueError("Aggregations %s are not supported, use %s" % (
+            ", ".join(unknown), ", ".join(sorted(aggregate_partials))))
+
+    keys = []
+    if freq is not None:
+        keys.append("date_trunc('%s', %s)::date AS %s" % (freq_fields[freq],
+                                                          date_col, date_col))
+    keys.extend(group_by or [])
+
+    if not keys:
+        raise ValueError("Must aggregate by a frequency or group of columns")
+
+    partials = sorted(set(p for a in agg for p in aggregate_partials[a]))
+    selection = keys + ["%s AS %s__%s" % (partial_sql[p].format(value_col),
+                                          value_col, p) for p in partials]
+    positions = ", ".join(str(i + 1) for i in range(len(keys)))
+
+    params = None
+    if not isinstance(sql, basestring):
+        sql, params = sql
+
+    aggregated = """SELECT %s FROM (%s) AS shard GROUP BY %s""" % (
+        ", ".join(selection), sql.strip().rstrip(';'), positions)
 
-        yield query_string % (mtable, s.year, date_col, beg, end)
+    if params is None:
+        return aggregated
+    return aggregated, params
+
+
+# Pandas style frequencies and the Postgres date_trunc field they map to
+freq_fields = {"D": "day", "W": "week", "M": "month", "Q": "quarter",
+               "A": "year"}
+
+# The partial aggregates which must be computed on each shard in order to
+# compute each of the final aggregations
+aggregate_partials = {"count": ("count",),
+                      "sum": ("sum",),
+                      "mean": ("sum", "count"),
+                      "min": ("min",),
+                      "max": ("max",),
+                      "std": ("sum", "count", "sumsq")}
+
+partial_sql = {"count": "count({0})",
+               "sum": "sum({0})",
+               "sumsq": "sum({0} * {0})",
+               "min": "min({0})",
+               "max": "max({0})"}
+
+# Lists of filter values longer than this are joined against a temporary
+# table rather than bound as an array, see FilterTable
+DEFAULT_FILTER_TABLE_THRESHOLD = 100
 
 
 def join_date_strings(dates, separator="','", df="%d-%m-%Y"):
@@ -235,52 +428,134 @@ def join_date_strings(dates, separator="','", df="%d-%m-%Y"):
     return separator.join([x.strftime(df) for x in dates])
 
 
-def add_equality_constraint(column, values):
+def add_constraints(query, constraints):
+    """
+    Append constraints to a query, binding their values as parameters
+    rather than splicing them into the SQL text. The SQL of a query then
+    only depends on the table and the shape of its filters, so that the
+    statement may be prepared once and its plan reused, see
+    lode.database.utilities.query_to_df
+
+    Parameters:
+    -----------
+    query: An (sql, params) pair, e.g. from create_date_limited_sql
+    constraints: List of (clause, params) pairs from the add_*_constraint
+                 functions
+
+    Returns:
+    --------
+    query: The (sql, params) pair with the constraints added
+    """
+    sql, params = query
+    params = list(params)
+    for clause, values in constraints:
+        sql += clause
+        params.extend(values)
+
+    return sql, params
+
+
+def add_equality_constraint(column, values,
+                            threshold=DEFAULT_FILTER_TABLE_THRESHOLD):
 
     if not hasattr(values, '__iter__'):
         return add_single_selection_constraint(column, values)
     else:
-        return add_multiple_selection_constraint(column, values)
+        return add_multiple_selection_constraint(column, values, threshold)
 
 
-def add_exclusion_constraint(column, values):
+def add_exclusion_constraint(column, values,
+                             threshold=DEFAULT_FILTER_TABLE_THRESHOLD):
 
     if not hasattr(values, '__iter__'):
         return add_single_exclusion_constraint(column, values)
     else:
-        return add_multiple_exclusion_constraint(column, values)
+        return add_multiple_exclusion_constraint(column, values, threshold)
 
 
 def add_minimum_constraint(column, value):
-    return """ AND %s >= '%s'""" % (column, value)
+    return """ AND %s >= %%s""" % column, [value]
 
 
 def add_maximum_constraint(column, value):
-    return """ AND %s <= '%s'""" % (column, value)
+    return """ AND %s <= %%s""" % column, [value]
 
 
 def add_range_constraint(column, begin, end):
-    return """ AND %s BETWEEN '%s' AND '%s'""" % (column, begin, end)
+    return """ AND %s BETWEEN %%s AND %%s""" % column, [begin, end]
 
 
 def add_single_selection_constraint(column, value):
-    return """ AND %s='%s'""" % (column, value)
+    return """ AND %s = %%s""" % column, [value]
+
 
+def add_multiple_selection_constraint(
+        column, values, threshold=DEFAULT_FILTER_TABLE_THRESHOLD):
+    """ Lists of more than threshold values are joined against a
+    FilterTable rather than bound as an array
+    """
+    values = list(values)
+    if len(values) > threshold:
+        return (""" AND %s IN (SELECT value FROM %%s)""" % column,
+                [FilterTable(values)])
 
-def add_multiple_selection_constraint(column, values):
-    joined = "','".join(values)
-    jvalues = "('%s')" % joined
-    return """ AND %s IN %s""" % (column, jvalues)
+    # A single array parameter whatever the number of values
+    return """ AND %s = ANY(%%s)""" % column, [values]
 
 
 def add_single_exclusion_constraint(column, value):
-    return """ AND %s!='%s'""" % (column, value)
+    return """ AND %s != %%s""" % column, [value]
+
+
+def add_multiple_exclusion_constraint(
+        column, values, threshold=DEFAULT_FILTER_TABLE_THRESHOLD):
+    values = list(values)
+    if len(values) > threshold:
+        return (""" AND NOT EXISTS (SELECT 1 FROM %%s AS f """
+                """WHERE f.value = %s)""" % column, [FilterTable(values)])
+
+    return """ AND %s != ALL(%%s)""" % column, [values]
+
+
+class FilterTable(object):
+    """
+    A large set of filter values, e.g. several hundred GXPs, which is
+    uploaded with COPY into a temporary table on the connection running the
+    query and joined against, rather than bound as an array. It is passed
+    as a query parameter in place of the table name, the table is created
+    and its name put into the SQL when the query is run, see
+    lode.database.utilities.attach_filter_tables
+
+    Parameters:
+    -----------
+    values: The filter values, integers or strings
+    """
+
+    def __init__(self, values):
+        super(FilterTable, self).__init__()
+
+        self.values = sorted(set(values))
+        if all(isinstance(v, numbers.Integral) for v in self.values):
+            self.sql_type = "bigint"
+        else:
+            self.sql_type = "text"
+
+        # Named after the values so a table is only uploaded once
+        digest = hashlib.sha1("%s:%s" % (self.sql_type, "\n".join(
+            "%s" % v for v in self.values))).hexdigest()[:16]
+        self.name = "lode_filter_%s" % digest
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "FilterTable(%s, %s values)" % (self.name, len(self.values))
 
+    def __eq__(self, other):
+        return isinstance(other, FilterTable) and self.name == other.name
 
-def add_multiple_exclusion_constraint(column, values):
-    joined = "','".join(values)
-    jvalues = "('%s')" % joined
-    return """ AND %s NOT IN %s""" % (column, jvalues)
+    def __ne__(self, other):
+        return not self == other
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,491 @@
+"""
+Daily, weekly and monthly rollups of the nodal prices and demand so that
+coarse views never need to read the half hourly data.
+
+Each rollup table, e.g. nodal_prices_daily, holds one row per period and
+node with the partial aggregates of the value (count, sum, sum of squares,
+min and max). These combine exactly into the mean, standard deviation etc.
+over any coarser period, in the same way as the per shard partials of
+query_builders.add_aggregation. The price rollups also hold the demand
+weighted sum of the price so that the load weighted average price can be
+computed where the demand for the node has been loaded.
+
+Rollups are enabled for a master table by setting "rollups": true in its
+schema in the configuration file. They are refreshed for only the dates
+touched whenever a file is loaded, the weekly and monthly rollups being
+built from the daily one.
+
+Every refresh records the dates it covered in lode_rollup_coverage. The
+queries only answer from the rollups when the dates asked for have been
+rolled up, so data loaded before the rollups were enabled is read from the
+half hourly tables until build_rollups has been run.
+"""
+
+import datetime
+import pandas as pd
+
+from lode.utilities.util import load_config, parse_date, parse_dates
+from lode.database.utilities import execute_and_commit_sql, ex_sql_and_fetch
+from lode.database.cache import invalidate_shard
+from lode.database.partitions import is_partitioned
+from lode.database import query_builders as qb
+
+# The value rolled up for each master table and the columns it is kept per,
+# the prices are also weighted by the demand at the same node and period
+rollup_specs = {"nodal_prices": {"value": "Price",
+                                 "keys": (("Node", "varchar(7)"),),
+                                 "weight": ("nodal_demand", "Demand")},
+                "nodal_demand": {"value": "Demand",
+                                 "keys": (("Node", "varchar(7)"),
+                                          ("Island", "varchar(2)"))}}
+
+# Rollup granularities and the Postgres date_trunc field of each
+granularities = (("daily", "day"), ("weekly", "week"), ("monthly", "month"))
+
+# Frequencies which can be answered from each rollup, None is no frequency
+rollup_freqs = {"daily": (None, "D", "W", "M", "Q", "A"),
+                "weekly": (None, "W"),
+                "monthly": (None, "M", "Q", "A")}
+
+# The partials stored in the rollups, and how partials are combined
+rollup_partials = ("count", "sum", "sumsq", "min", "max")
+weight_partials = ("wsum", "weight")
+combine_sql = {"count": "sum", "sum": "sum", "sumsq": "sum", "min": "min",
+               "max": "max", "wsum": "sum", "weight": "sum"}
+
+# The load weighted average is only available from the rollups
+weighted_partials = {"weighted": weight_partials}
+
+# The date ranges each master table has been rolled up over
+coverage_table = "lode_rollup_coverage"
+
+
+def has_rollups(database, master_table):
+    """ Whether rollups are enabled for a master table in the config """
+    schemas = load_config()[database]['schemas']
+    return (master_table in rollup_specs and
+            bool(schemas.get(master_table, {}).get("rollups", False)))
+
+
+def create_coverage_sql():
+    """ SQL to create the table recording the dates rolled up """
+    return """CREATE TABLE IF NOT EXISTS %s
+(
+master_table text,
+begin_date date,
+end_date date
+);""" % coverage_table
+
+
+def merge_ranges(ranges):
+    """ Merge (begin, end) date ranges which overlap or are adjacent into
+    the fewest ranges covering the same dates, in date order
+    """
+    merged = []
+    for begin, end in sorted(ranges):
+        if merged and begin <= merged[-1][1] + datetime.timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def rollup_coverage(database, master_table):
+    """ The merged date ranges the rollups of a master table cover """
+    if not (table_exists(database, coverage_table) and
+            table_exists(database, rollup_table(master_table, "daily"))):
+        return []
+
+    sql = "SELECT begin_date, end_date FROM %s WHERE master_table = %%s" % (
+        coverage_table)
+    return merge_ranges(ex_sql_and_fetch(database, (sql, [master_table])))
+
+
+def rollups_cover(database, master_table, dates=None, begin_date=None,
+                  end_date=None):
+    """
+    Whether the rollups of a master table are enabled and have been built
+    over every date of a query, otherwise it must read the half hourly data
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. nodal_prices
+    dates: Specific dates queried
+    begin_date: Beginning of a date range queried
+    end_date: End of a date range queried
+
+    Returns:
+    --------
+    Boolean: True if the rollups can answer the query
+    """
+    if not has_rollups(database, master_table):
+        return False
+
+    if dates:
+        if isinstance(dates, basestring):
+            dates = [dates]
+        wanted = [(d.date(), d.date()) for d in parse_dates(dates)]
+    else:
+        wanted = [(parse_date(begin_date).date(), parse_date(end_date).date())]
+
+    ranges = rollup_coverage(database, master_table)
+    return all(any(begin <= b and e <= end for begin, end in ranges)
+               for b, e in wanted)
+
+
+def rollup_table(master_table, granularity):
+    """ The name of a rollup table, e.g. nodal_prices_daily """
+    return "%s_%s" % (master_table, granularity)
+
+
+def partial_columns(master_table):
+    """ The partial aggregate columns held by the rollups of a table """
+    spec = rollup_specs[master_table]
+    partials = rollup_partials
+    if spec.get("weight"):
+        partials += weight_partials
+
+    return ["%s__%s" % (spec["value"], p) for p in partials]
+
+
+def create_rollup_sql(master_table, granularity):
+    """
+    SQL to create a rollup table
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+    granularity: daily, weekly or monthly
+
+    Returns:
+    --------
+    SQL: CREATE TABLE statement
+    """
+    spec = rollup_specs[master_table]
+    keys = ["Trading_date"] + [k for k, _ in spec["keys"]]
+
+    definitions = ["Trading_date date"]
+    definitions += ["%s %s" % key for key in spec["keys"]]
+    definitions += ["%s %s" % (c, "bigint" if c.endswith("__count")
+                               else "double precision")
+                    for c in partial_columns(master_table)]
+    definitions.append("UNIQUE(%s)" % ", ".join(keys))
+
+    return "CREATE TABLE IF NOT EXISTS %s\n(\n%s\n);" % (
+        rollup_table(master_table, granularity), ",\n".join(definitions))
+
+
+def create_rollup_tables(database, master_table):
+    """ Create the daily, weekly and monthly rollups of a master table """
+    for granularity, _ in granularities:
+        execute_and_commit_sql(database,
+                               create_rollup_sql(master_table, granularity))
+    execute_and_commit_sql(database, create_coverage_sql())
+
+
+def daily_rollup_sql(master_table, year, begin_date, end_date,
+                     partitioned=False, weighted=False):
+    """
+    SQL to recompute the daily rollup of one year between two dates
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+    year: The year of the table shard to read from
+    begin_date: First date to recompute, datetime
+    end_date: Last date to recompute, datetime
+    partitioned: Whether the master table is partitioned
+    weighted: Whether the demand table of the same year exists to weight
+              the values by
+
+    Returns:
+    --------
+    SQL: DELETE and INSERT statements
+    """
+    spec = rollup_specs[master_table]
+    value = "v.%s" % spec["value"]
+    keys = [k for k, _ in spec["keys"]]
+    table = rollup_table(master_table, "daily")
+    begin, end = begin_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+    selection = ["v.Trading_date"] + ["v.%s" % k for k in keys]
+    selection += [qb.partial_sql[p].format(value) for p in rollup_partials]
+
+    source = "%s AS v" % qb.shard_table(master_table, year, partitioned)
+    if spec.get("weight") and weighted:
+        weight_table, weight = spec["weight"]
+        source += (" LEFT JOIN %s AS w ON (w.Trading_date = v.Trading_date "
+                   "AND w.Trading_period = v.Trading_period "
+                   "AND w.Node = v.Node)" % qb.shard_table(
+                       weight_table, year, partitioned))
+        selection += ["sum(%s * w.%s)" % (value, weight),
+                      "sum(CASE WHEN %s IS NOT NULL THEN w.%s END)" % (
+                          value, weight)]
+    elif spec.get("weight"):
+        selection += ["NULL::double precision"] * len(weight_partials)
+
+    columns = ["Trading_date"] + keys + partial_columns(master_table)
+    positions = ", ".join(str(i + 1) for i in range(len(keys) + 1))
+
+    return ("DELETE FROM {table} WHERE Trading_date BETWEEN '{begin}' AND "
+            "'{end}'; INSERT INTO {table} ({columns}) SELECT {selection} "
+            "FROM {source} WHERE v.Trading_date BETWEEN '{begin}' AND "
+            "'{end}' GROUP BY {positions};").format(
+                table=table, begin=begin, end=end,
+                columns=", ".join(columns), selection=", ".join(selection),
+                source=source, positions=positions)
+
+
+def coarse_rollup_sql(master_table, granularity, begin_date, end_date):
+    """
+    SQL to recompute the weekly or monthly rollup over the whole weeks or
+    months containing two dates, from the daily rollup
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+    granularity: weekly or monthly
+    begin_date: First date which changed, datetime
+    end_date: Last date which changed, datetime
+
+    Returns:
+    --------
+    SQL: DELETE and INSERT statements
+    """
+    spec = rollup_specs[master_table]
+    keys = [k for k, _ in spec["keys"]]
+    field = dict(granularities)[granularity]
+    begin, end = period_bounds(granularity, begin_date, end_date)
+    partials = partial_columns(master_table)
+
+    selection = ["date_trunc('%s', Trading_date)::date" % field] + keys
+    selection += ["%s(%s)" % (combine_sql[c.split("__")[1]], c)
+                  for c in partials]
+    positions = ", ".join(str(i + 1) for i in range(len(keys) + 1))
+
+    return ("DELETE FROM {table} WHERE Trading_date BETWEEN '{begin}' AND "
+            "'{end}'; INSERT INTO {table} ({columns}) SELECT {selection} "
+            "FROM {daily} WHERE Trading_date BETWEEN '{begin}' AND '{end}' "
+            "GROUP BY {positions};").format(
+                table=rollup_table(master_table, granularity),
+                daily=rollup_table(master_table, "daily"),
+                begin=begin.strftime("%Y-%m-%d"),
+                end=end.strftime("%Y-%m-%d"),
+                columns=", ".join(["Trading_date"] + keys + partials),
+                selection=", ".join(selection), positions=positions)
+
+
+def period_bounds(granularity, begin_date, end_date):
+    """ Widen a date range out to the whole weeks or months it touches """
+    if granularity == "weekly":
+        begin = begin_date - datetime.timedelta(days=begin_date.weekday())
+        end = end_date + datetime.timedelta(days=6 - end_date.weekday())
+    elif granularity == "monthly":
+        begin = begin_date.replace(day=1)
+        end = (pd.Timestamp(end_date) + pd.offsets.MonthEnd(0)).to_pydatetime()
+    else:
+        begin, end = begin_date, end_date
+
+    return begin, end
+
+
+def refresh_rollups(database, master_table, begin_date, end_date):
+    """
+    Recompute the rollups of a master table for the dates touched by a
+    load, along with the rollups of any table weighted by it, e.g. the
+    demand weighted prices when demand is loaded.
+
+    Parameters:
+    -----------
+    database: The database key
+    master_table: The root table name, e.g. nodal_prices
+    begin_date: First date loaded
+    end_date: Last date loaded
+    """
+    begin_date = parse_date(begin_date)
+    end_date = parse_date(end_date)
+    partitioned = is_partitioned(database, master_table)
+
+    statements = []
+    for year in range(begin_date.year, end_date.year + 1):
+        weight = rollup_specs[master_table].get("weight")
+        weighted = weight and table_exists(
+            database, qb.shard_table(weight[0], year, partitioned))
+
+        statements.append(daily_rollup_sql(
+            master_table, year, max(begin_date, datetime.datetime(year, 1, 1)),
+            min(end_date, datetime.datetime(year, 12, 31)),
+            partitioned=partitioned, weighted=weighted))
+
+    for granularity in ("weekly", "monthly"):
+        statements.append(coarse_rollup_sql(master_table, granularity,
+                                            begin_date, end_date))
+
+    # Recorded with the refresh so the coverage never runs ahead of it
+    statements.append(create_coverage_sql())
+    statements.append("INSERT INTO %s VALUES ('%s', '%s', '%s');" % (
+        coverage_table, master_table, begin_date.date(), end_date.date()))
+
+    # A single transaction so readers never see a partial refresh
+    execute_and_commit_sql(database, "\n".join(statements))
+    print "Refreshed %s rollups from %s to %s" % (
+        master_table, begin_date.date(), end_date.date())
+
+    for granularity, _ in granularities:
+        invalidate_shard(database, rollup_table(master_table, granularity))
+
+    for table, spec in rollup_specs.items():
+        if (spec.get("weight", (None,))[0] == master_table and
+                has_rollups(database, table) and
+                table_exists(database, rollup_table(table, "daily"))):
+            refresh_rollups(database, table, begin_date, end_date)
+
+
+def build_rollups(database, master_table):
+    """ Create and fully rebuild the rollups of a master table """
+    create_rollup_tables(database, master_table)
+
+    years = load_config()[database]['schemas'][master_table]["split_years"]
+    refresh_rollups(database, master_table,
+                    datetime.datetime(min(years), 1, 1),
+                    datetime.datetime(max(years), 12, 31))
+
+
+def table_exists(database, table):
+    """ Whether a table exists in a database """
+    sql = "SELECT to_regclass('%s') IS NOT NULL" % table
+    return ex_sql_and_fetch(database, sql)[0][0]
+
+
+def last_loaded_key(database, table, key_column):
+    """ The largest serial key in a table, recorded before a load """
+    sql = "SELECT COALESCE(max(%s), 0) FROM %s" % (key_column, table)
+    return ex_sql_and_fetch(database, sql)[0][0]
+
+
+def loaded_date_ranges(database, table, key_column, after_key):
+    """
+    The runs of consecutive trading dates of the rows added to a table by
+    a load, e.g. the files for January and December of the same year give
+    two ranges rather than the whole year
+
+    Parameters:
+    -----------
+    database: The database key
+    table: The table loaded, e.g. nodal_prices_2014
+    key_column: The serial key of the table
+    after_key: The largest key before the load, see last_loaded_key
+
+    Returns:
+    --------
+    ranges: List of (begin, end) dates, empty if no rows were added
+    """
+    sql = """SELECT min(day), max(day) FROM (
+                 SELECT day, day - (row_number() OVER (ORDER BY day))::int
+                        AS run
+                 FROM (SELECT DISTINCT Trading_date AS day FROM %s
+                       WHERE %s > %s) AS loaded) AS days
+             GROUP BY run ORDER BY 1""" % (table, key_column, after_key)
+    return [tuple(r) for r in ex_sql_and_fetch(database, sql)]
+
+
+def rollup_granularity(freq, begin_date=None, end_date=None):
+    """
+    The coarsest rollup which can answer a frequency over a date range, the
+    range must cover whole weeks or months to use those rollups
+    """
+    if begin_date is not None and end_date is not None:
+        for granularity in ("monthly", "weekly"):
+            bounds = period_bounds(granularity, begin_date, end_date)
+            if (freq in rollup_freqs[granularity] and
+                    bounds == (begin_date, end_date)):
+                return granularity
+
+    return "daily"
+
+
+def rollup_sql(master_table, agg, freq=None, group_by=None, dates=None,
+               begin_date=None, end_date=None, nodes=None, excl_nodes=None,
+               filter_threshold=qb.DEFAULT_FILTER_TABLE_THRESHOLD):
+    """
+    Build a query answering an aggregation from the rollups, the result has
+    the same partial aggregate columns as the queries built with
+    query_builders.add_aggregation so it is combined by combine_aggregates.
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+    agg: List of aggregations, as for add_aggregation plus "weighted" for
+         the load weighted average
+    freq: Frequency to aggregate to, e.g. 'D', 'W' or 'M'
+    group_by: Columns to group by, defaults to Node, [] for every node
+    dates: Specific dates to aggregate over
+    begin_date: Beginning of a date range
+    end_date: End of a date range
+    nodes: Nodes to include
+    excl_nodes: Nodes to exclude
+    filter_threshold: Node lists longer than this are joined against a
+                      FilterTable
+
+    Returns:
+    --------
+    query: The (sql, params) query, or None if the rollups cannot answer
+           it, e.g. when grouping by a column they are not kept per
+    """
+    spec = rollup_specs[master_table]
+    if group_by is None:
+        group_by = ["Node"]
+    known = [k.lower() for k, _ in spec["keys"]]
+    supported = dict(qb.aggregate_partials)
+    if spec.get("weight"):
+        supported.update(weighted_partials)
+
+    if (freq not in rollup_freqs["daily"] or
+            any(g.lower() not in known for g in group_by) or
+            any(a not in supported for a in agg)):
+        return None
+
+    if dates:
+        if isinstance(dates, basestring):
+            dates = [dates]
+        granularity = "daily"
+        constraint, params = qb.date_list_constraint("Trading_date",
+                                                     parse_dates(dates))
+    else:
+        begin_date, end_date = parse_date(begin_date), parse_date(end_date)
+        granularity = rollup_granularity(freq, begin_date, end_date)
+        constraint = "Trading_date BETWEEN %s AND %s"
+        params = [begin_date.date(), end_date.date()]
+
+    constraints = []
+    if nodes:
+        constraints.append(qb.add_equality_constraint(
+            "Node", nodes, threshold=filter_threshold))
+    if excl_nodes:
+        constraints.append(qb.add_exclusion_constraint(
+            "Node", excl_nodes, threshold=filter_threshold))
+    sql, params = qb.add_constraints(
+        ("SELECT * FROM %s WHERE %s" % (
+            rollup_table(master_table, granularity), constraint), params),
+        constraints)
+
+    keys = []
+    if freq is not None:
+        keys.append("date_trunc('%s', Trading_date)::date AS Trading_date" %
+                    qb.freq_fields[freq])
+    keys.extend(group_by)
+    if not keys:
+        return None
+
+    partials = sorted(set(p for a in agg for p in supported[a]))
+    selection = keys + ["%s(%s__%s) AS %s__%s" % (
+        combine_sql[p], spec["value"], p, spec["value"], p) for p in partials]
+    positions = ", ".join(str(i + 1) for i in range(len(keys)))
+
+    return "SELECT %s FROM (%s) AS rollup GROUP BY %s" % (
+        ", ".join(selection), sql, positions), params
+
+
+if __name__ == '__main__':
+    pass
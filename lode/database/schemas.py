@@ -0,0 +1,86 @@
+"""
+Helpers for reading the table definitions held in static/table_schemas so
+that queries can be checked against the tables before they are run.
+"""
+
+import os
+import re
+
+from lode.utilities.util import module_path
+
+schema_folder = os.path.join(module_path, "static/table_schemas")
+
+# Lines within a CREATE TABLE statement which are constraints not columns
+constraint_keywords = ("unique", "primary", "constraint", "foreign", "check")
+
+
+def schema_path(master_table):
+    """
+    Return the location of the schema file for a master table
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+
+    Returns:
+    --------
+    path: Full path to the .sql schema file
+    """
+    return os.path.join(schema_folder, "%s.sql" % master_table)
+
+
+def schema_columns(master_table):
+    """
+    Parse the column names of a master table from its schema file
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+
+    Returns:
+    --------
+    columns: List of the column names, lower case, in table order
+    """
+    path = schema_path(master_table)
+    if not os.path.exists(path):
+        raise ValueError("No schema exists for the table %s" % master_table)
+
+    with open(path, 'rb') as f:
+        sql = f.read()
+
+    # Some of the schemas have yet to be written
+    if '(' not in sql:
+        return []
+
+    # Everything between the outermost brackets of the CREATE TABLE
+    body = sql[sql.index('(') + 1:sql.rindex(')')]
+
+    columns = []
+    for line in body.split('\n'):
+        match = re.match(r"\s*(\w+)\s+\w+", line)
+        if match and match.group(1).lower() not in constraint_keywords:
+            columns.append(match.group(1).lower())
+
+    return columns
+
+
+def validate_columns(master_table, columns):
+    """
+    Ensure that all of the columns requested exist in a master table, raises
+    a ValueError naming the unknown columns if they do not.
+
+    Parameters:
+    -----------
+    master_table: The root table name, e.g. nodal_prices
+    columns: Iterable of column names, case insensitive
+    """
+    known = schema_columns(master_table)
+    unknown = [c for c in columns if c.lower() not in known]
+
+    if unknown:
+        raise ValueError("Columns %s do not exist in %s, choose from %s" % (
+            ", ".join(unknown), master_table, ", ".join(known)))
+
+
+if __name__ == '__main__':
+    pass
@@ -1,7 +1,60 @@
+import os
+import hashlib
+import datetime
+import itertools
+import threading
+import simplejson
+from cStringIO import StringIO
+from contextlib import contextmanager
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
 import psycopg2 as pg2
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN, connection
+from psycopg2.pool import ThreadedConnectionPool
 from lode.utilities.util import load_config, meta_path
+from lode.database.cache import QueryCache
+from lode.database.query_builders import FilterTable
 import pandas.io.sql as psql
 import pandas as pd
+import numpy as np
+
+# Process wide connection pools, one per database key, guarded by a lock so
+# that concurrent first use from several threads only creates a single pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Default pool sizes if they are not set in the configuration file
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 8
+
+# Planner row estimate above which query_to_df switches to COPY by default
+DEFAULT_COPY_THRESHOLD = 100000
+
+# The NULL marker written by COPY, distinct from an empty string
+COPY_NULL = "\\N"
+
+# Unique names for the server side cursors used when streaming results
+_cursor_ids = itertools.count()
+
+# Columns of short, heavily repeated values held as categoricals when compact
+compact_categories = ("node", "company", "station", "grid_injection_point",
+                      "grid_point", "grid_exit_point", "island", "time")
+
+# The columns of the nodal metadata file and of the node_metadata table
+meta_columns = (("Node", "node"),
+                ("Is Injection", "is_injection"),
+                ("Is Hvdc", "is_hvdc"),
+                ("Bus Id", "bus_id"),
+                ("Location Name", "location_name"),
+                ("Load Area", "load_area"),
+                ("Island Name", "island_name"),
+                ("Region", "region"),
+                ("Generation Type", "generation_type"),
+                ("Company Name", "company_name"))
+
+# The metadata file, read on first use
+_meta_frames = {}
 
 
 def list_databases():
@@ -21,7 +74,9 @@ def list_databases():
     """
     config = load_config()
 
-    databases = [x for x in config.keys() if "schemas" in config[x]]
+    # Settings such as query_cache_max_bytes are not dicts
+    databases = [x for x in config.keys()
+                 if isinstance(config[x], dict) and "schemas" in config[x]]
     return databases
 
 
@@ -155,6 +210,164 @@ def return_connection(db_key):
                                                           host)
 
 
+class PreparingConnection(connection):
+    """
+    A psycopg2 connection which remembers the names of the statements which
+    have been prepared, and the filter tables which have been uploaded, on
+    its session, see prepared_statement and attach_filter_tables
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.filter_tables = set()
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """
+    A thread safe psycopg2 connection pool which waits for a connection to
+    be returned when all of them have been checked out, rather than raising
+    a PoolError as the psycopg2 pools do. Connections are health checked on
+    checkout and broken ones are discarded and replaced transparently.
+
+    Parameters:
+    -----------
+    minconn: Number of connections to open up front and keep open
+    maxconn: Maximum number of connections which may be checked out at once
+    ping: Whether to run a round trip "SELECT 1" on checkout in addition to
+          the (free) check of the connection state
+    *args, **kwargs: Passed through to psycopg2.connect
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.ping = kwargs.pop('ping', False)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        ThreadedConnectionPool.__init__(self, minconn, maxconn,
+                                        *args, **kwargs)
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            conn = ThreadedConnectionPool.getconn(self, key)
+            if not self._healthy(conn):
+                # Throw the dead connection away and open a fresh one
+                ThreadedConnectionPool.putconn(self, conn, close=True)
+                conn = ThreadedConnectionPool.getconn(self, key)
+        except Exception:
+            self._slots.release()
+            raise
+
+        return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            if not conn.closed and not close:
+                # Never hand out a connection with a dangling transaction
+                try:
+                    conn.rollback()
+                except (pg2.OperationalError, pg2.InterfaceError):
+                    close = True
+            ThreadedConnectionPool.putconn(self, conn, key,
+                                           close=close or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+
+        if conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        if self.ping:
+            try:
+                with conn.cursor() as curs:
+                    curs.execute("SELECT 1")
+                conn.rollback()
+            except (pg2.OperationalError, pg2.InterfaceError):
+                return False
+
+        return True
+
+
+def get_pool(db):
+    """
+    Return the process wide connection pool for a database, creating it on
+    first use. Pool sizes are read from the "pool_min_size" (connections
+    kept open between queries) and "pool_max_size" (connections open at
+    once) keys of the database configuration and a "SELECT 1" health check
+    on checkout may be enabled with "pool_ping".
+
+    Pools are not shared across processes, a forked child will create its
+    own pool rather than reusing the sockets of its parent.
+
+    Parameters:
+    -----------
+    db: String with the database key name
+
+    Returns:
+    --------
+    pool: BlockingConnectionPool for the database
+    """
+
+    key = (db, os.getpid())
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+
+    with _pools_lock:
+        if key not in _pools:
+            db_config = load_config()[db]
+            _pools[key] = BlockingConnectionPool(
+                db_config.get("pool_min_size", DEFAULT_POOL_MIN),
+                db_config.get("pool_max_size", DEFAULT_POOL_MAX),
+                return_connection(db),
+                ping=db_config.get("pool_ping", False),
+                connection_factory=PreparingConnection)
+
+        return _pools[key]
+
+
+def close_pools():
+    """
+    Close every connection held by the connection pools of this process,
+    e.g. after changing the configuration file. The pools will be recreated
+    the next time a query is run.
+    """
+
+    with _pools_lock:
+        for key in _pools.keys():
+            if key[1] == os.getpid():
+                _pools[key].closeall()
+            del _pools[key]
+
+
+@contextmanager
+def pooled_connection(db):
+    """
+    Check a connection out of the pool for a database for the duration of a
+    with block. As with a plain psycopg2 connection the transaction is
+    committed if the block succeeds and rolled back otherwise, after which
+    the connection is returned to the pool rather than closed.
+
+    Parameters:
+    -----------
+    db: String with the database key name
+
+    Returns:
+    --------
+    conn: A psycopg2 connection
+    """
+
+    pool = get_pool(db)
+    conn = pool.getconn()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.putconn(conn)
+
+
 def ex_sql_and_fetch(db, sql, result_num=None):
     """
     Execute an SQL query and return the results, optionally only
@@ -163,7 +376,7 @@ def ex_sql_and_fetch(db, sql, result_num=None):
     Parameters:
     -----------
     db: Database to connect to (string)
-    sql: SQL statement to execute
+    sql: SQL statement to execute, or an (sql, params) pair
     result_num: Optional, number of results to fetch, defaults to all
 
     Returns:
@@ -171,10 +384,10 @@ def ex_sql_and_fetch(db, sql, result_num=None):
     records: The Database SQL query results
 
     """
-    conn_string = return_connection(db)
-    with pg2.connect(conn_string) as conn:
+    sql, params = split_query(sql)
+    with pooled_connection(db) as conn:
         with conn.cursor() as curs:
-            curs.execute(sql)
+            curs.execute(sql, params)
             if type(result_num) is int:
                 records = curs.fetchmany(result_num)
             else:
@@ -195,8 +408,7 @@ def execute_and_commit_sql(db, sql):
     sql: What SQL query to execute
 
     """
-    conn_string = return_connection(db)
-    with pg2.connect(conn_string) as conn:
+    with pooled_connection(db) as conn:
         with conn.cursor() as curs:
             curs.execute(sql)
             conn.commit()
@@ -212,40 +424,572 @@ def get_column_names(db, table):
     return ex_sql_and_fetch(db, sql)[::-1]
 
 
-def query_to_df(db, sql):
+def query_to_df(db, sql, fetch_method="auto"):
     """
-    Query a particular database using a predefined SQL string
+    Query a particular database using a predefined SQL string or an
+    (sql, params) pair with bind parameters, e.g. from the query builders
+
+    Results may be fetched either through pandas read_sql, which is quick
+    for small results, or by streaming the result out of the database with
+    COPY and parsing it with the pandas CSV parser, which is considerably
+    faster for large results. By default the planner row estimate of the
+    query is compared to the "copy_row_threshold" configuration key (or
+    DEFAULT_COPY_THRESHOLD) to decide between them. Both return the same
+    DataFrame.
+
+    Queries with parameters are run as server side prepared statements,
+    so repeating a query with the same shape but different values skips
+    the parse and plan. This may be turned off with the "prepare_statements"
+    configuration key, e.g. when connecting through pgbouncer.
 
     Parameters:
     -----------
     db: String with the name of the database
-    sql: The SQL to be run
+    sql: The SQL to be run, or an (sql, params) pair
+    fetch_method: One of 'auto', 'copy' or 'read_sql'
 
     Returns:
     --------
     DataFrame: Object containing the results of the query
     """
-    conn_string = return_connection(db)
-    with pg2.connect(conn_string) as conn:
-        return psql.read_sql(sql, conn)
+    if fetch_method not in ("auto", "copy", "read_sql"):
+        raise ValueError("Fetch method %s is not one of 'auto', 'copy' or "
+                         "'read_sql'" % fetch_method)
+
+    sql, params = split_query(sql)
+    db_config = load_config()[db]
 
+    with pooled_connection(db) as conn:
+        sql, params = attach_filter_tables(conn, sql, params)
+        statement = (sql, params)
+        if params and db_config.get("prepare_statements", True):
+            statement = prepared_statement(conn, sql, params)
 
-def multi_query(db, queries):
+        if fetch_method == "auto":
+            threshold = db_config.get("copy_row_threshold",
+                                      DEFAULT_COPY_THRESHOLD)
+            if estimate_rows(conn, *statement) >= threshold:
+                fetch_method = "copy"
+
+        # COPY cannot run a prepared statement so the values are inlined
+        if fetch_method == "copy":
+            return copy_to_df(conn, sql, params)
+
+        return psql.read_sql(statement[0], conn, params=statement[1])
+
+
+def split_query(query):
+    """
+    The SQL and parameters of a query, which is either an SQL string or an
+    (sql, params) pair. The parameters are None if there are none.
+    """
+    if isinstance(query, basestring):
+        return query, None
+
+    sql, params = query
+    return sql, list(params) or None
+
+
+def attach_filter_tables(conn, sql, params):
+    """
+    Upload the FilterTable parameters of a query into temporary tables on a
+    connection, once per connection, and put the table names into the SQL
+    in place of their placeholders.
+
+    Parameters:
+    -----------
+    conn: An open psycopg2 connection, usually a PreparingConnection
+    sql: The SQL with %s placeholders for the parameters
+    params: List of the parameter values, or None
+
+    Returns:
+    --------
+    sql: The SQL naming the filter tables
+    params: The remaining parameters, or None if there are none
+    """
+    if not params or not any(isinstance(p, FilterTable) for p in params):
+        return sql, params
+
+    parts = sql.split("%s")
+    joined, remaining = [parts[0]], []
+    for param, part in izip(params, parts[1:]):
+        if isinstance(param, FilterTable):
+            create_filter_table(conn, param)
+            joined.append(param.name)
+        else:
+            joined.append("%s")
+            remaining.append(param)
+        joined.append(part)
+
+    return "".join(joined), remaining or None
+
+
+def create_filter_table(conn, table):
+    """
+    Create and fill the temporary table of a FilterTable with COPY, unless
+    it already exists on the session of the connection. The table is
+    committed straight away so that it outlives a failed query.
+    """
+    created = getattr(conn, "filter_tables", None)
+    if created is not None and table.name in created:
+        return
+
+    rows = "".join("%s\n" % copy_escape(v) for v in table.values)
+    with conn.cursor() as curs:
+        curs.execute("CREATE TEMPORARY TABLE IF NOT EXISTS %s "
+                     "(value %s PRIMARY KEY)" % (table.name, table.sql_type))
+        curs.execute("TRUNCATE %s" % table.name)
+        curs.copy_expert("COPY %s (value) FROM STDIN" % table.name,
+                         StringIO(rows))
+        # Temporary tables are never analysed automatically
+        curs.execute("ANALYZE %s" % table.name)
+    conn.commit()
+
+    if created is not None:
+        created.add(table.name)
+
+
+def copy_escape(value):
+    """ Escape a value for the COPY text format """
+    return ("%s" % value).replace("\\", "\\\\").replace(
+        "\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def prepared_statement(conn, sql, params):
+    """
+    Prepare a parameterised query on the session of a connection the first
+    time it is seen, the statement is named after its SQL so every query of
+    the same shape shares it.
+
+    Parameters:
+    -----------
+    conn: A connection from the pool, a PreparingConnection
+    sql: The SQL with %s placeholders for the parameters
+    params: List of the parameter values
+
+    Returns:
+    --------
+    statement: The (sql, params) pair executing the prepared statement, or
+               the query itself if the connection cannot track statements
+    """
+    prepared = getattr(conn, "prepared", None)
+    if prepared is None:
+        return sql, params
+
+    name = "lode_%s" % hashlib.sha1(sql).hexdigest()[:16]
+    if name not in prepared:
+        with conn.cursor() as curs:
+            curs.execute("PREPARE %s AS %s" % (
+                name, numbered_placeholders(sql).strip().rstrip(';')))
+        # Prepared statements last for the session, even on rollback
+        prepared.add(name)
+
+    return ("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params))),
+            params)
+
+
+def numbered_placeholders(sql):
+    """ Replace the %s placeholders of psycopg2 with $1, $2, ... """
+    parts = sql.split("%s")
+    numbered = [parts[0]]
+    for i, part in enumerate(parts[1:]):
+        numbered.append("$%s%s" % (i + 1, part))
+
+    return "".join(numbered).replace("%%", "%")
+
+
+def estimate_rows(conn, sql, params=None):
+    """
+    Return the planner estimate of the number of rows a query will return,
+    this is cheap as the query is planned but not run.
+
+    Parameters:
+    -----------
+    conn: An open psycopg2 connection
+    sql: The SQL query to estimate, may be an EXECUTE of a prepared statement
+    params: Optional parameters of the query
+
+    Returns:
+    --------
+    rows: Estimated number of rows as an int
+    """
+    with conn.cursor() as curs:
+        curs.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = curs.fetchone()[0]
+
+    # Older psycopg2 versions do not decode the json column
+    if isinstance(plan, basestring):
+        plan = simplejson.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def copy_to_df(conn, sql, params=None):
+    """
+    Run a query through COPY ... TO STDOUT and parse the CSV stream straight
+    into a DataFrame. Column types are taken from the query description so
+    that the result matches that of pandas read_sql, e.g. dates are returned
+    as datetime.date objects and text columns are never coerced to numbers.
+
+    Parameters:
+    -----------
+    conn: An open psycopg2 connection
+    sql: The SQL query to run, a trailing semicolon is permitted
+    params: Optional parameters of the query, COPY does not take bind
+            parameters so these are quoted into the SQL by psycopg2
+
+    Returns:
+    --------
+    DataFrame: Object containing the results of the query
+    """
+    with conn.cursor() as curs:
+        if params:
+            sql = curs.mogrify(sql, params)
+        sql = sql.strip().rstrip(';')
+
+        # Dates must be written out in a format we know how to parse
+        curs.execute("SET LOCAL DateStyle = 'ISO'")
+
+        # Plan the query without returning any rows to get the column types
+        curs.execute("SELECT * FROM (%s) AS lode_copy LIMIT 0" % sql)
+        columns = [c[0] for c in curs.description]
+        types = [c[1] for c in curs.description]
+
+        buf = StringIO()
+        curs.copy_expert("COPY (%s) TO STDOUT WITH CSV NULL '%s'"
+                         % (sql, COPY_NULL), buf)
+
+    buf.seek(0)
+    return parse_copy_csv(buf, columns, types)
+
+
+def parse_copy_csv(buf, columns, types):
+    """
+    Parse the CSV output of COPY ... TO STDOUT into a DataFrame
+
+    Parameters:
+    -----------
+    buf: File like object holding the output, written with NULL as \\N so
+         that nulls can be told apart from empty strings
+    columns: The column names
+    types: The Postgres type OID of each column, see cursor.description
+
+    Returns:
+    --------
+    DataFrame: The rows with the column types read_sql would give
+    """
+    # An empty result has no lines for the parser to read
+    if not buf.read(1):
+        return pd.DataFrame(columns=columns)
+
+    buf.seek(0)
+    dtypes = {}
+    for col, oid in izip(columns, types):
+        if oid in _COPY_FLOAT_TYPES:
+            dtypes[col] = float
+        elif oid in _COPY_TEXT_TYPES or oid in _COPY_CONVERTERS:
+            dtypes[col] = object
+
+    df = pd.read_csv(buf, header=None, names=columns, dtype=dtypes,
+                     keep_default_na=False, na_values=[COPY_NULL],
+                     float_precision='round_trip')
+
+    for col, oid in izip(columns, types):
+        if oid in _COPY_CONVERTERS:
+            df[col] = _convert_non_null(df[col], _COPY_CONVERTERS[oid])
+        elif oid in _COPY_TEXT_TYPES or df[col].isnull().all():
+            # read_sql leaves nulls as None in text and all null columns
+            df[col] = _convert_non_null(df[col], lambda x: x)
+
+    return df
+
+
+def _convert_non_null(s, func):
+    """ Apply a converter to the non null values of a column, leaving None
+    for the nulls as read_sql would
+    """
+    mask = s.notnull()
+    if mask.all():
+        return func(s)
+
+    result = pd.Series([None] * len(s), index=s.index, dtype=object)
+    if mask.any():
+        result[mask] = func(s[mask])
+    return result
+
+
+def _by_unique(func):
+    """ Columns such as dates repeat the same few values many times over, so
+    convert each distinct value once and broadcast the results back
+    """
+    def converter(s):
+        codes, uniques = pd.factorize(s)
+        converted = np.asarray(func(pd.Series(uniques)), dtype=object)
+        return pd.Series(converted.take(codes), index=s.index)
+    return converter
+
+
+@_by_unique
+def _to_date(s):
+    return pd.to_datetime(s, format="%Y-%m-%d").dt.date
+
+
+@_by_unique
+def _to_time(s):
+    return pd.to_datetime(s).dt.time
+
+
+def _to_bool(s):
+    return s.map({'t': True, 'f': False})
+
+
+# Postgres type OIDs which need special treatment when parsing COPY output
+_COPY_TEXT_TYPES = (18, 25, 1042, 1043)
+_COPY_FLOAT_TYPES = (700, 701, 1700)
+_COPY_CONVERTERS = {16: _to_bool,
+                    1082: _to_date,
+                    1083: _to_time,
+                    1114: pd.to_datetime}
+
+
+def multi_query(db, queries, parallel=False, max_workers=None,
+                fetch_method="auto", cache=False, compact=False,
+                float32=False, transform=None):
     """
     Run multiple SQL queries on the same database and concatenate the results
     together into the same DataFrame
 
+    The queries may optionally be run concurrently on a bounded pool of
+    worker threads, each of which checks out its own pooled connection. The
+    results are always concatenated in the order the queries were passed
+    and an error in any one query is raised once all of them have stopped.
+
     Parameters:
     -----------
     db: The Database to run the queries on (string)
-    queries: Iterable object containing the SQL queries as strings
+    queries: Iterable object containing the SQL queries as strings or
+             (sql, params) pairs
+    parallel: Whether to run the queries concurrently
+    max_workers: Maximum number of queries to run at once when running in
+                 parallel, defaults to the size of the connection pool
+    fetch_method: How to fetch the results, see query_to_df
+    cache: Whether to read and store the result in the on disk query cache
+    compact: Whether to shrink each shard with compact_frame as it arrives,
+             the categoricals share one set of categories across the shards
+    float32: Whether to also store the floating point columns as float32
+    transform: Optional function applied to each shard as it arrives, after
+               compacting, e.g. lode.offers.stack_bands
 
     Returns:
     --------
     DataFrame: Pandas DataFrame containing the information concatenated
                together
     """
-    return pd.concat((query_to_df(db, q) for q in queries), ignore_index=True)
+    queries = list(queries)
+
+    if cache:
+        # The full precision result is cached so it can serve either mode
+        query_cache = QueryCache()
+        df = query_cache.get(db, queries)
+        if df is None:
+            df = multi_query(db, queries, parallel=parallel,
+                             max_workers=max_workers,
+                             fetch_method=fetch_method)
+            query_cache.put(db, queries, df)
+        if compact:
+            df = compact_frame(df, float32)
+        return transform(df) if transform else df
+
+    def fetch(sql):
+        df = query_to_df(db, sql, fetch_method)
+        if compact:
+            df = compact_frame(df, float32)
+        return transform(df) if transform else df
+
+    if not parallel:
+        return concat_frames(share_categories([fetch(q) for q in queries]))
+
+    if max_workers is None:
+        max_workers = get_pool(db).maxconn
+    workers = max(1, min(max_workers, len(queries)))
+
+    pool = ThreadPool(workers)
+    try:
+        # map keeps the results in query order and re-raises any error
+        frames = pool.map(fetch, queries)
+    finally:
+        pool.close()
+        pool.join()
+
+    return concat_frames(share_categories(frames))
+
+
+def concat_frames(frames):
+    """
+    Concatenate the per shard DataFrames together. Shards which returned no
+    rows are dropped first as their untyped (object) columns would otherwise
+    upcast the columns of the whole result.
+    """
+    non_empty = [df for df in frames if len(df)]
+    return pd.concat(non_empty or frames[:1], ignore_index=True)
+
+
+def compact_frame(df, float32=False):
+    """
+    Shrink a query result in place: the code columns such as node and
+    company become categoricals, date columns become datetime64, integer
+    columns are downcast to the smallest type holding their values, e.g.
+    int8 for trading_period, and optionally floats are stored as float32.
+
+    Parameters:
+    -----------
+    df: The DataFrame to compact
+    float32: Whether to store the floating point columns, e.g. prices, as
+             float32, this keeps around seven significant figures
+
+    Returns:
+    --------
+    DataFrame: The same DataFrame with the smaller column types
+    """
+    for column in df.columns:
+        series = df[column]
+        if column.lower() in compact_categories:
+            df[column] = series.astype("category")
+
+        elif series.dtype == object and is_date_series(series):
+            df[column] = pd.to_datetime(series)
+
+        elif series.dtype.kind in 'iu':
+            df[column] = pd.to_numeric(series, downcast="integer")
+
+        elif float32 and series.dtype.kind == 'f':
+            df[column] = series.astype(np.float32)
+
+    return df
+
+
+def is_date_series(series):
+    """ Whether an object column holds datetime.date values """
+    valid = series.dropna()
+    return len(valid) > 0 and isinstance(valid.iloc[0], datetime.date)
+
+
+def share_categories(frames):
+    """
+    Give each categorical column the same (sorted) set of categories in
+    every shard, otherwise concatenating the shards falls back to object.
+    """
+    columns = set(c for df in frames for c in df.columns
+                  if str(df[c].dtype) == "category")
+
+    for column in columns:
+        categories = sorted(set(v for df in frames if column in df
+                                for v in categories_of(df[column])))
+        for df in frames:
+            if column in df:
+                series = df[column].astype("category")
+                df[column] = series.cat.set_categories(categories)
+
+    return frames
+
+
+def categories_of(series):
+    """ The categories of a categorical column, or its unique values """
+    if str(series.dtype) == "category":
+        return series.cat.categories
+    return series.dropna().unique()
+
+
+def iter_query(db, queries, chunksize=None):
+    """
+    Run multiple SQL queries on the same database and yield the results as a
+    series of DataFrames instead of concatenating them together. The rows
+    are read through a server side (named) cursor so that only a single
+    chunk is held in memory at any one time.
+
+    Parameters:
+    -----------
+    db: The Database to run the queries on (string)
+    queries: Iterable object containing the SQL queries as strings or
+             (sql, params) pairs
+    chunksize: Maximum number of rows in each DataFrame, if None then one
+               DataFrame is yielded per query
+
+    Returns:
+    --------
+    Generator of Pandas DataFrames in query order
+    """
+
+    for query in queries:
+        sql, params = split_query(query)
+        with pooled_connection(db) as conn:
+            sql, params = attach_filter_tables(conn, sql, params)
+            with conn.cursor(name="lode_iter_%s" % next(_cursor_ids)) as curs:
+                if chunksize:
+                    curs.itersize = chunksize
+                curs.execute(sql, params)
+
+                while True:
+                    if chunksize:
+                        records = curs.fetchmany(chunksize)
+                    else:
+                        records = curs.fetchall()
+
+                    # The description is only filled once rows are fetched
+                    columns = [c[0] for c in curs.description]
+                    if records or not chunksize:
+                        yield pd.DataFrame.from_records(records,
+                                                        columns=columns,
+                                                        coerce_float=True)
+
+                    if not chunksize or len(records) < chunksize:
+                        break
+
+
+def combine_aggregates(partials, keys, value_col, agg):
+    """
+    Combine the partial aggregates returned by queries built with
+    query_builders.add_aggregation on a number of shards into the final
+    aggregations, e.g. the mean is the total sum over the total count.
+
+    Parameters:
+    -----------
+    partials: DataFrame of the concatenated partial aggregates
+    keys: List of the columns which the results were grouped by
+    value_col: The column which was aggregated
+    agg: List of aggregations which were requested
+
+    Returns:
+    --------
+    DataFrame: Indexed by the keys with a column for each aggregation
+    """
+    value_col = value_col.lower()
+    keys = [k.lower() for k in keys]
+
+    combine = {"count": "sum", "sum": "sum", "sumsq": "sum",
+               "min": "min", "max": "max", "wsum": "sum", "weight": "sum"}
+    columns = [c for c in partials.columns if c.startswith(value_col + "__")]
+    how = dict((c, combine[c.split("__")[1]]) for c in columns)
+
+    totals = partials.groupby(keys).agg(how)
+
+    def total(partial):
+        return totals["%s__%s" % (value_col, partial)]
+
+    result = pd.DataFrame(index=totals.index)
+    for a in agg:
+        if a == "mean":
+            result[a] = total("sum") / total("count")
+        elif a == "std":
+            n = total("count")
+            variance = (total("sumsq") - total("sum") ** 2 / n) / (n - 1)
+            result[a] = np.sqrt(variance.clip(lower=0))
+        elif a == "weighted":
+            result[a] = total("wsum") / total("weight")
+        else:
+            result[a] = total(a)
+
+    return result
 
 
 def list_all_tables(db):
@@ -270,11 +1014,29 @@ def list_all_tables(db):
     return relevant
 
 
+def read_meta():
+    """
+    The nodal metadata file as a DataFrame with the node_metadata column
+    names, it is only read from disk once
+    """
+    if meta_path not in _meta_frames:
+        meta_info = pd.read_csv(meta_path, dtype=object)
+        _meta_frames[meta_path] = meta_info.rename(columns=dict(meta_columns))
+
+    return _meta_frames[meta_path]
+
+
 def merge_meta(df, col='demand'):
     """
     Apply meta information to a specific dataframe and remove all periods where
     no existing data was present before hand in a specific column. An outer
-    join is used as the meta data may be incomplete.
+    join is used as the meta data may be incomplete. Queries join the
+    node_metadata table in SQL instead where it has been loaded, see
+    lode.database.metadata
+
+    The metadata columns are snake_case, as in the node_metadata table,
+    e.g. region and island_name rather than the Region and Island Name
+    headers of the metadata file, see meta_columns
 
     Parameters:
     -----------
@@ -285,10 +1047,8 @@ def merge_meta(df, col='demand'):
     --------
     DataFrame: The existing df with meta information applied where possible.
     """
-    meta_info = pd.read_csv(meta_path)
-    df = df.merge(meta_info, left_on="node", right_on="Node",
-                  how='outer')
-    return df.ix[df[col].dropna().index]
+    df = df.merge(read_meta(), on="node", how='outer')
+    return df.loc[df[col].dropna().index]
 
 
 def drop_table(database, table):
@@ -0,0 +1,326 @@
+"""
+Band level offers: the Band1..Band5 columns of the energy offers, and the
+Band1..Band3 columns of the reserve offers, stacked into one row per offer
+band with NumPy reshapes rather than row by row.
+
+Each band of an offer becomes a row holding the other offer columns (company,
+station, trading_date etc) along with:
+
+    band: The band number, 1 to 5
+    price: The band price, $/MWh
+    quantity: The band power for energy offers, the band max for reserves
+    percent: The PLSR percentage, generator reserve offers only
+    product: Energy, PLSR, TWDSR or IL, reserve offers only
+    reserve_type: FIR (6 second) or SIR (60 second), reserve offers only
+
+Stacking is row independent so it may be run on each shard, or each chunk
+of a stream, as it arrives, see query_offer and iter_offer.
+
+The bands of every trading period are also built into aggregate supply
+curves (merit orders) at once with supply_curves, which answers questions
+such as the price at a quantity for thousands of periods with a single
+searchsorted.
+"""
+
+import re
+import collections
+import numpy as np
+import pandas as pd
+
+# Matches the band columns of each offer table, e.g. band1_power,
+# band2_plsr_6s_max and band3_60s_price
+band_pattern = re.compile(r"^band(\d+)_(?:(plsr|twdsr)_)?(?:(6s|60s)_)?"
+                          r"(power|price|max|percent)$", re.IGNORECASE)
+
+# The band level column each band field is stacked into
+band_fields = {"power": "quantity", "max": "quantity", "price": "price",
+               "percent": "percent"}
+
+reserve_types = {"6s": "FIR", "60s": "SIR"}
+products = ("Energy", "PLSR", "TWDSR", "IL")
+
+BandSlot = collections.namedtuple("BandSlot", ["band", "product",
+                                               "reserve_type", "columns"])
+
+
+def band_slots(columns):
+    """
+    Group the band columns of an offer table into the bands they describe
+
+    Parameters:
+    -----------
+    columns: The column names of the offers
+
+    Returns:
+    --------
+    slots: List of BandSlots, in column order, each with a dict mapping
+           price, quantity and percent to the column holding it
+    """
+    slots = collections.OrderedDict()
+    for column in columns:
+        match = band_pattern.match(column)
+        if not match:
+            continue
+
+        band, product, reserve, field = match.groups()
+        if product:
+            product = product.upper()
+        else:
+            product = "IL" if reserve else "Energy"
+
+        reserve_type = reserve_types.get(reserve and reserve.lower())
+        key = (int(band), product, reserve_type)
+        slots.setdefault(key, {})[band_fields[field.lower()]] = column
+
+    return [BandSlot(band, product, reserve_type, fields)
+            for (band, product, reserve_type), fields in slots.items()]
+
+
+def stack_bands(offers, drop_empty=True, float32=False):
+    """
+    Stack the offer bands into one row per band
+
+    Parameters:
+    -----------
+    offers: DataFrame of energy or reserve offers as queried, with the band
+            columns in the wide layout of the offer tables
+    drop_empty: Whether to drop the bands offering no quantity, the unused
+                bands are most of the energy offers
+    float32: Store the band prices and quantities as float32
+
+    Returns:
+    --------
+    DataFrame: The band level offers, one row per band with band, price and
+               quantity columns in place of the band columns
+    """
+    slots = band_slots(offers.columns)
+    if not slots:
+        raise ValueError("The offers have no band columns to stack, query "
+                         "them with their Band columns")
+
+    band_columns = set(c for slot in slots for c in slot.columns.values())
+    keys = [c for c in offers.columns if c not in band_columns]
+    dtype = np.float32 if float32 else np.float64
+
+    rows, width = len(offers), len(slots)
+
+    def field(name):
+        # Row major (offer, band) array flattened so each offer's bands are
+        # adjacent
+        values = np.full((rows, width), np.nan, dtype=dtype)
+        for i, slot in enumerate(slots):
+            if name in slot.columns:
+                values[:, i] = offers[slot.columns[name]].values
+        return values.ravel()
+
+    quantity = field("quantity")
+    offer_index = np.repeat(np.arange(rows), width)
+    slot_index = np.tile(np.arange(width), rows)
+
+    selected = slice(None)
+    if drop_empty:
+        selected = np.flatnonzero(quantity > 0)
+        offer_index = offer_index[selected]
+        slot_index = slot_index[selected]
+
+    stacked = offers[keys].take(offer_index)
+    stacked.reset_index(drop=True, inplace=True)
+
+    stacked["band"] = np.array([s.band for s in slots],
+                               dtype=np.int8)[slot_index]
+
+    if any(s.product != "Energy" for s in slots):
+        stacked["product"] = pd.Categorical.from_codes(
+            np.array([products.index(s.product) for s in slots])[slot_index],
+            products)
+        stacked["reserve_type"] = pd.Categorical.from_codes(
+            np.array([("FIR", "SIR").index(s.reserve_type)
+                      if s.reserve_type else -1
+                      for s in slots])[slot_index], ("FIR", "SIR"))
+
+    stacked["price"] = field("price")[selected]
+    stacked["quantity"] = quantity[selected]
+    if any("percent" in s.columns for s in slots):
+        stacked["percent"] = field("percent")[selected]
+
+    return stacked
+
+
+class SupplyCurves(object):
+    """
+    The aggregate supply curves of a number of trading periods, held as one
+    array of bands sorted by curve and then by price with the cumulative
+    quantity offered along each curve.
+
+    Parameters:
+    -----------
+    bands: Band level offers, see stack_bands
+    keys: The columns identifying each curve
+    """
+
+    def __init__(self, bands, keys=("trading_date", "trading_period")):
+        super(SupplyCurves, self).__init__()
+
+        self.keys = list(keys)
+        grouped = bands.groupby(self.keys, sort=True)
+        codes = grouped.ngroup().values
+        self.index = grouped.size().index
+
+        order = np.lexsort((bands["price"].values, codes))
+        self.bands = bands.take(order).reset_index(drop=True)
+        self.codes = codes[order]
+
+        self.bands["cumulative_quantity"] = pd.Series(
+            self.bands["quantity"].values.astype(np.float64)).groupby(
+                self.codes).cumsum().values
+
+        self.starts = np.searchsorted(self.codes, np.arange(len(self.index)))
+        self.ends = np.append(self.starts[1:], len(self.codes))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def totals(self):
+        """ The total quantity offered on each curve """
+        return pd.Series(self._at(self.ends - 1, "cumulative_quantity",
+                                  self.ends > self.starts), index=self.index)
+
+    def price_at(self, quantity):
+        """
+        The price of the band which clears a quantity on each curve, NaN
+        where more than the total offered is asked for
+
+        Parameters:
+        -----------
+        quantity: The quantity, MW, a scalar, an array with one value per
+                  curve or a Series indexed like the curves, e.g. demand
+
+        Returns:
+        --------
+        Series: The price indexed by the curve keys
+        """
+        position, cleared = self._clearing_band(quantity)
+        return pd.Series(self._at(position, "price", cleared),
+                         index=self.index)
+
+    def quantity_at(self, price):
+        """
+        The total quantity offered at or below a price on each curve
+
+        Parameters:
+        -----------
+        price: The price, $/MWh, a scalar, an array with one value per curve
+               or a Series indexed like the curves
+
+        Returns:
+        --------
+        Series: The quantity indexed by the curve keys
+        """
+        price = self._per_curve(price)
+        position = self._search("price", price, side="right")
+        offered = (position > self.starts) & ~np.isnan(price)
+        quantity = self._at(position - 1, "cumulative_quantity", offered)
+        quantity[~offered & ~np.isnan(price)] = 0.
+        return pd.Series(quantity, index=self.index)
+
+    def marginal_offers(self, quantity):
+        """
+        The marginal, price setting, band of each curve when a quantity is
+        cleared, e.g. its station and company
+
+        Parameters:
+        -----------
+        quantity: The cleared quantity, MW, a scalar, an array with one value
+                  per curve or a Series indexed like the curves
+
+        Returns:
+        --------
+        DataFrame: The marginal band of each curve indexed by the curve
+                   keys, curves which cannot clear the quantity are omitted
+        """
+        position, cleared = self._clearing_band(quantity)
+        marginal = self.bands.take(position[cleared])
+        marginal = marginal.drop(self.keys, axis=1)
+        marginal.index = self.index[cleared]
+        return marginal
+
+    def _clearing_band(self, quantity):
+        """ The first band on each curve reaching the quantity, and whether
+        the curve reaches it at all
+        """
+        quantity = self._per_curve(quantity)
+        position = self._search("cumulative_quantity", quantity, side="left")
+        return position, (position < self.ends) & ~np.isnan(quantity)
+
+    def _search(self, column, targets, side):
+        """ searchsorted of one target per curve within each curve. The
+        targets are sorted in among the bands by curve and then value, so
+        each lands within its own curve whatever its size, e.g. infinite
+        """
+        values = self.bands[column].values.astype(np.float64)
+        curves = np.arange(len(self))
+
+        # Ties sort the target before equal bands for left, after for right
+        band_tie, target_tie = (1, 0) if side == "left" else (0, 1)
+        order = np.lexsort((
+            np.append(np.full(len(values), band_tie, dtype=np.int8),
+                      np.full(len(self), target_tie, dtype=np.int8)),
+            np.append(values, targets),
+            np.append(self.codes, curves)))
+
+        # Each curve has one target so those of the earlier curves precede
+        # it, the rest of its rank is the bands before it
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        position = rank[len(values):] - curves
+
+        # Targets which are NaN sort after everything
+        return np.where(np.isnan(targets), self.ends, position)
+
+    def _at(self, position, column, valid):
+        values = np.full(len(self), np.nan)
+        values[valid] = self.bands[column].values[position[valid]]
+        return values
+
+    def _per_curve(self, x):
+        if isinstance(x, pd.Series):
+            return x.reindex(self.index).values.astype(np.float64)
+
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim == 0:
+            return np.full(len(self), x)
+
+        if len(x) != len(self):
+            raise ValueError("Expected one value for each of the %s curves"
+                             % len(self))
+        return x
+
+
+def supply_curves(offers, keys=("trading_date", "trading_period")):
+    """
+    Build the aggregate supply curve of every trading period in a set of
+    offers at once
+
+    Parameters:
+    -----------
+    offers: The offers as returned by query_offer, either the wide offers
+            (as_offerframe=False) or the band level offers
+    keys: The columns identifying each curve, add product and reserve_type
+          for reserve offers
+
+    Returns:
+    --------
+    SupplyCurves: The curves, which answer price_at, quantity_at and
+                  marginal_offers for every curve at once
+    """
+    if "band" in offers.columns:
+        bands = offers[offers["quantity"] > 0]
+    else:
+        bands = stack_bands(offers)
+
+    return SupplyCurves(bands, keys=keys)
+
+
+if __name__ == '__main__':
+    pass
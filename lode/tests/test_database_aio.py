@@ -0,0 +1,32 @@
+from lode.database.aio import gather
+from concurrent.futures import Future
+from nose.tools import assert_raises
+
+
+def test_gather():
+
+    first, second = Future(), Future()
+    combined = gather([first, second], sum)
+
+    second.set_result(2)
+    assert not combined.done()
+
+    first.set_result(1)
+    assert combined.result() == 3
+
+    assert gather([]).result() == []
+
+
+def test_gather_error():
+
+    first, second = Future(), Future()
+    combined = gather([first, second])
+
+    first.set_exception(ValueError("Bad shard"))
+    second.set_result(2)
+
+    assert_raises(ValueError, combined.result)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,63 @@
+from lode.database.cache import QueryCache
+import pandas as pd
+import tempfile
+import shutil
+
+
+def test_cache_key():
+    cache = QueryCache(folder=tempfile.mkdtemp(), max_bytes=2 ** 20)
+
+    q1 = "SELECT * FROM nodal_prices_2013"
+    q2 = "SELECT * FROM nodal_prices_2014"
+
+    # The order of the shard queries does not matter
+    assert cache.key('db', [q1, q2]) == cache.key('db', [q2, q1])
+    assert cache.key('db', [q1, q2]) != cache.key('other', [q1, q2])
+    assert cache.key('db', [q1]) != cache.key('db', [q1, q2])
+
+    shutil.rmtree(cache.folder)
+
+
+def test_cache_invalidate():
+    cache = QueryCache(folder=tempfile.mkdtemp(), max_bytes=2 ** 20)
+    df = pd.DataFrame({"node": ["OTA2201", "HAY2201"], "price": [1.5, 2.5]})
+
+    q1 = "SELECT * FROM nodal_prices_2013 WHERE node='OTA2201'"
+    q2 = "SELECT * FROM nodal_prices_2014 WHERE node='OTA2201'"
+
+    cache.put('db', [q1], df)
+    cache.put('db', [q2], df)
+    assert cache.get('db', [q1]).equals(df)
+
+    # Loading data into a different database or year leaves it alone
+    cache.invalidate('other', 'nodal_prices', 2013)
+    cache.invalidate('db', 'nodal_prices', 2015)
+    assert cache.get('db', [q1]) is not None
+
+    cache.invalidate('db', 'nodal_prices', 2013)
+    assert cache.get('db', [q1]) is None
+    assert cache.get('db', [q2]) is not None
+
+    shutil.rmtree(cache.folder)
+
+
+def test_cache_eviction():
+    cache = QueryCache(folder=tempfile.mkdtemp(), max_bytes=2 ** 20)
+    df = pd.DataFrame({"node": ["OTA2201"] * 100, "price": range(100)})
+
+    queries = ["SELECT * FROM nodal_prices_%s" % y for y in range(2010, 2014)]
+    cache.put('db', [queries[0]], df)
+    size = cache._read_index().values()[0]["size"]
+
+    # Room for three results, touching the first makes the second the oldest
+    cache.max_bytes = 3 * size
+    cache.put('db', [queries[1]], df)
+    cache.put('db', [queries[2]], df)
+    cache.get('db', [queries[0]])
+    cache.put('db', [queries[3]], df)
+
+    assert cache.get('db', [queries[0]]) is not None
+    assert cache.get('db', [queries[1]]) is None
+    assert cache.get('db', [queries[3]]) is not None
+
+    shutil.rmtree(cache.folder)
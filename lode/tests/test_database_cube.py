@@ -0,0 +1,59 @@
+from lode.database.cube import (PriceCube, as_slice, select_nodes,
+                                write_manifest)
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+def test_as_slice():
+
+    assert as_slice([3, 4, 5]) == slice(3, 6)
+    assert as_slice([3, 5]) == [3, 5]
+
+
+def test_select_nodes():
+
+    block = np.arange(24, dtype=float).reshape(2, 3, 4)
+
+    view = select_nodes(block, [1, 2])
+    assert np.may_share_memory(view, block)
+    assert (view == block[:, :, 1:3]).all()
+
+    filled = select_nodes(block, [3, None])
+    assert (filled[:, :, 0] == block[:, :, 3]).all()
+    assert np.isnan(filled[:, :, 1]).all()
+
+
+def test_price_cube_slice():
+
+    folder = tempfile.mkdtemp()
+    try:
+        dates = pd.date_range("2014-01-01", "2014-12-31").values
+        values = np.full((len(dates), 50, 2), np.nan)
+        values[:, :48, :] = 50.0
+        values[31, 9, 1] = 120.0
+
+        np.save(os.path.join(folder, "prices_2014_1.npy"), values)
+        write_manifest(folder, 2014, "prices_2014_1.npy", dates,
+                       ["BEN2201", "HAY2201"])
+
+        cube = PriceCube(folder)
+        assert cube.years == [2014]
+
+        block = cube.slice(["HAY2201"], "01/02/2014", "03/02/2014",
+                           begin_period=10, end_period=12)
+        assert block.values.shape == (3, 3, 1)
+        assert block.values[0, 0, 0] == 120.0
+        assert list(block.periods) == [10, 11, 12]
+
+        whole = cube.slice(begin_date="01/02/2014", end_date="01/02/2014")
+        assert whole.mask.sum() == 2 * 2
+        assert len(whole.to_frame()) == 48 * 2
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,31 @@
+from lode.database.indexes import index_name, create_index_sql
+from nose.tools import assert_raises
+
+
+def test_index_name():
+
+    assert index_name("nodal_prices_2014", ["Node", "Trading_date"]) == \
+        "nodal_prices_2014_node_trading_date_btree_idx"
+
+    long_name = index_name("generatorreserves_offers_2014",
+                           ["Grid_point", "Trading_date", "Trading_period"])
+    assert len(long_name) <= 63
+    assert long_name.startswith("generatorreserves_offers_2014_")
+    assert long_name != index_name("generatorreserves_offers_2014",
+                                   ["Grid_point", "Trading_date"])
+
+
+def test_create_index_sql():
+
+    sql = create_index_sql("nodal_prices_2014", ["Trading_date"], "brin")
+    assert sql == ("CREATE INDEX IF NOT EXISTS "
+                   "nodal_prices_2014_trading_date_brin_idx ON "
+                   "nodal_prices_2014 USING brin (Trading_date);")
+
+    assert_raises(ValueError, create_index_sql, "nodal_prices_2014",
+                  ["Node"], "bitmap")
+    assert_raises(ValueError, create_index_sql, "nodal_prices_2014", [])
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,39 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from datetime import date
+
+from lode.database.ledger import (create_ledger_sql, file_date, file_hash,
+                                  file_signature)
+
+
+def test_create_ledger_sql():
+
+    sql = create_ledger_sql()
+    assert sql.startswith("CREATE TABLE IF NOT EXISTS lode_load_ledger")
+    assert "content_hash varchar(40)" in sql
+    assert "UNIQUE(file_path, target_table)" in sql
+
+
+def test_file_date():
+
+    assert file_date("/data/20140813_Offers.csv") == date(2014, 8, 13)
+    assert file_date("/data/2014/Final_pricing_201408.csv") is None
+    assert file_date("/data/offers99999999.csv") is None
+
+
+def test_file_signature():
+
+    folder = tempfile.mkdtemp()
+    try:
+        csvfile = os.path.join(folder, "20140813_Offers.csv")
+        with open(csvfile, 'wb') as f:
+            f.write("Company,Station\nALNT,GLN\n")
+
+        path, size, mtime = file_signature(csvfile)
+        assert path == csvfile and size == 25 and mtime.microsecond == 0
+        assert file_hash(csvfile) == hashlib.sha1(
+            "Company,Station\nALNT,GLN\n").hexdigest()
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_raises
+
+from lode.database.loader import (copy_sql, has_header, interleave,
+                                  merge_sql, normalise_line, NormalisedCsv)
+from lode.utilities.util import module_path
+
+
+def test_copy_sql():
+
+    assert copy_sql("energy_offers_2014", ["company", "station"]) == (
+        "COPY energy_offers_2014(company,station) FROM STDIN WITH CSV;")
+
+
+def test_merge_sql():
+
+    columns = ["station", "trading_date", "price"]
+    keys = ["station", "trading_date"]
+
+    sql = merge_sql("energy_offers_2014", "staging", columns, keys)
+    assert "ON CONFLICT (station, trading_date) DO NOTHING" in sql
+    assert "SELECT station, trading_date, price FROM staging" in sql
+
+    sql = merge_sql("energy_offers_2014", "staging", columns, keys,
+                    on_conflict="update")
+    assert "DISTINCT ON (station, trading_date)" in sql
+    assert ("DO UPDATE SET price = EXCLUDED.price "
+            "WHERE (target.price) IS DISTINCT FROM (EXCLUDED.price)") in sql
+
+    # Nothing to update when every column is part of the key
+    sql = merge_sql("energy_offers_2014", "staging", keys, keys, "update")
+    assert "DO NOTHING" in sql
+
+    assert_raises(ValueError, merge_sql, "energy_offers_2014", "staging",
+                  columns, keys, "replace")
+
+
+def test_normalise_line():
+
+    assert normalise_line("ALNT,GLN0332 ,GLN\t,0\r\n") == \
+        "ALNT,GLN0332,GLN,0\n"
+    assert normalise_line('ALNT,"Glenbrook, Auckland ",0 \r\n') == \
+        'ALNT,"Glenbrook, Auckland",0\n'
+    assert normalise_line(" ,,\r\n") == ""
+
+
+def test_normalised_csv():
+
+    csvfile = os.path.join(module_path, 'tests/data/offers20140813.csv')
+    with open(csvfile, 'rb') as f:
+        reader = NormalisedCsv(f, skip_header=True, buffer_size=1000)
+        chunks = iter(lambda: reader.read(100), "")
+        data = "".join(chunks)
+
+    lines = data.split("\n")
+    assert len(lines) == 4033 and lines[-1] == ""
+    assert lines[0].startswith("ALNT,GLN0332,GLN,0,13/08/2014,1,")
+    assert "\r" not in data and " ," not in data
+
+
+def test_interleave():
+
+    assert interleave([["a1", "a2", "a3"], ["b1"], ["c1", "c2"]]) == [
+        "a1", "b1", "c1", "a2", "c2", "a3"]
+
+
+def test_has_header():
+
+    folder = tempfile.mkdtemp()
+    try:
+        csvfile = os.path.join(folder, "20140813_Offers.csv")
+        with open(csvfile, 'wb') as f:
+            f.write("Company,Station\nALNT,GLN\n")
+        assert has_header(csvfile, ["company", "station"])
+        assert not has_header(csvfile, ["unit"])
+    finally:
+        shutil.rmtree(folder)
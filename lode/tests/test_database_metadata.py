@@ -0,0 +1,34 @@
+from lode.database.metadata import (create_metadata_sql, join_metadata,
+                                    meta_keys)
+from lode.database.cache import shard_pattern
+
+
+def test_create_metadata_sql():
+
+    sql = create_metadata_sql()
+    assert sql.startswith("CREATE TABLE IF NOT EXISTS node_metadata")
+    assert "node text PRIMARY KEY" in sql
+    assert "island_name text" in sql
+
+
+def test_meta_keys():
+
+    assert meta_keys("Region") == ["region"]
+    assert meta_keys(["Island Name", "Trading_period"]) == ["island_name",
+                                                            "trading_period"]
+    assert meta_keys(["load_area"]) == ["load_area"]
+
+
+def test_join_metadata():
+
+    sql, params = join_metadata(("SELECT * FROM nodal_demand_2014 WHERE "
+                                 "trading_date = %s;", ["2014-08-13"]))
+    assert params == ["2014-08-13"]
+    assert "FROM (SELECT * FROM nodal_demand_2014 WHERE trading_date = %s)" \
+        in sql
+    assert "LEFT JOIN node_metadata AS m ON m.node = shard.node" in sql
+    assert "m.region" in sql and "m.node" not in sql.split("FROM")[0]
+
+    # The cache records the metadata table so a reload invalidates it
+    assert sorted(shard_pattern.findall(sql)) == [("nodal_demand", "2014"),
+                                                  ("node_metadata", "")]
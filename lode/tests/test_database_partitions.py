@@ -0,0 +1,50 @@
+from datetime import date
+from lode.database.partitions import (parent_table_sql, create_partition_sql,
+                                      attach_partition_sql)
+from lode.database.query_builders import create_date_limited_sql
+
+
+def test_parent_table_sql():
+
+    schema = ("CREATE TABLE IF NOT EXISTS nodal_prices_%s\n(\n"
+              "nodal_prices_key serial primary key,\nTrading_date date,\n"
+              "Price double precision\n);\n")
+
+    sql = parent_table_sql("nodal_prices", "Trading_date", schema)
+    assert sql == ("CREATE TABLE IF NOT EXISTS nodal_prices\n(\n"
+                   "nodal_prices_key serial,\nTrading_date date,\n"
+                   "Price double precision\n) "
+                   "PARTITION BY RANGE (Trading_date);")
+
+
+def test_partition_sql():
+
+    assert create_partition_sql("nodal_prices", 2014) == (
+        "CREATE TABLE IF NOT EXISTS nodal_prices_2014 PARTITION OF "
+        "nodal_prices FOR VALUES FROM ('2014-01-01') TO ('2015-01-01');")
+
+    assert attach_partition_sql("nodal_prices", "2014") == (
+        "ALTER TABLE nodal_prices ATTACH PARTITION nodal_prices_2014 "
+        "FOR VALUES FROM ('2014-01-01') TO ('2015-01-01');")
+
+
+def test_partitioned_date_limited_sql():
+
+    ranged = create_date_limited_sql("nodal_prices", begin_date="20/12/2013",
+                                     end_date="10/01/2015",
+                                     date_col="Trading_date",
+                                     partitioned=True)
+    assert ranged == [("SELECT * FROM nodal_prices WHERE Trading_date "
+                       "BETWEEN %s AND %s", [date(2013, 12, 20),
+                                             date(2015, 1, 10)])]
+
+    singular = create_date_limited_sql("nodal_prices",
+                                       dates=["20/12/2013", "10/01/2015"],
+                                       date_col="Trading_date",
+                                       partitioned=True)
+    assert len(singular) == 1
+    assert "FROM nodal_prices WHERE" in singular[0][0]
+
+
+if __name__ == '__main__':
+    pass
@@ -1,6 +1,6 @@
 from lode.database.query_builders import *
 from nose.tools import assert_raises
-from datetime import datetime
+from datetime import datetime, date, timedelta
 
 
 def test_join_date_strings():
@@ -30,9 +30,9 @@ def test_add_maximum_constraint():
     r2 = add_maximum_constraint(c1, v2)  # Test Int
     r3 = add_maximum_constraint(c1, v3)  # Test Float\
 
-    assert r1 == """ AND Randomstring <= '123'"""
-    assert r2 == """ AND Randomstring <= '123'"""
-    assert r3 == """ AND Randomstring <= '124.57'"""
+    assert r1 == (""" AND Randomstring <= %s""", ["123"])
+    assert r2 == (""" AND Randomstring <= %s""", [123])
+    assert r3 == (""" AND Randomstring <= %s""", [124.57])
 
 
 def test_add_minimum_constraint():
@@ -45,9 +45,9 @@ def test_add_minimum_constraint():
     r2 = add_minimum_constraint(c1, v2)  # Test Int
     r3 = add_minimum_constraint(c1, v3)  # Test Float\
 
-    assert r1 == """ AND Randomstring >= '123'"""
-    assert r2 == """ AND Randomstring >= '123'"""
-    assert r3 == """ AND Randomstring >= '124.57'"""
+    assert r1 == (""" AND Randomstring >= %s""", ["123"])
+    assert r2 == (""" AND Randomstring >= %s""", [123])
+    assert r3 == (""" AND Randomstring >= %s""", [124.57])
 
 
 def test_add_range_constraint():
@@ -60,9 +60,9 @@ def test_add_range_constraint():
     r2 = add_range_constraint(colname, b2, e2)  # Int
     r3 = add_range_constraint(colname, b3, e3)  # Float
 
-    assert r1 == """ AND TestCol BETWEEN '37' AND '47'"""
-    assert r2 == """ AND TestCol BETWEEN '28' AND '33'"""
-    assert r3 == """ AND TestCol BETWEEN '125.44' AND '189.76'"""
+    assert r1 == (""" AND TestCol BETWEEN %s AND %s""", ["37", "47"])
+    assert r2 == (""" AND TestCol BETWEEN %s AND %s""", [28, 33])
+    assert r3 == (""" AND TestCol BETWEEN %s AND %s""", [125.44, 189.76])
 
 
 def test_add_single_selection_constraint():
@@ -77,10 +77,10 @@ def test_add_single_selection_constraint():
     r3 = add_single_selection_constraint(colname, v3)  # Int
     r4 = add_single_selection_constraint(colname, v4)  # Float
 
-    assert r1 == """ AND RandomCol='Hammer'"""
-    assert r2 == """ AND RandomCol='47'"""
-    assert r3 == """ AND RandomCol='389'"""
-    assert r4 == """ AND RandomCol='128.1231'"""
+    assert r1 == (""" AND RandomCol = %s""", ["Hammer"])
+    assert r2 == (""" AND RandomCol = %s""", ["47"])
+    assert r3 == (""" AND RandomCol = %s""", [389])
+    assert r4 == (""" AND RandomCol = %s""", [128.1231])
 
 
 def test_add_single_exclusion_constraint():
@@ -95,10 +95,10 @@ def test_add_single_exclusion_constraint():
     r3 = add_single_exclusion_constraint(colname, v3)  # Int
     r4 = add_single_exclusion_constraint(colname, v4)  # Float
 
-    assert r1 == """ AND RandomCol!='Hammer'"""
-    assert r2 == """ AND RandomCol!='47'"""
-    assert r3 == """ AND RandomCol!='389'"""
-    assert r4 == """ AND RandomCol!='128.1231'"""
+    assert r1 == (""" AND RandomCol != %s""", ["Hammer"])
+    assert r2 == (""" AND RandomCol != %s""", ["47"])
+    assert r3 == (""" AND RandomCol != %s""", [389])
+    assert r4 == (""" AND RandomCol != %s""", [128.1231])
 
 
 def test_add_multiple_selection_constraint():
@@ -109,14 +109,147 @@ def test_add_multiple_selection_constraint():
     v3 = ["Sample1", "Sample2", "Sample3"]
     v4 = 467
 
+    # The values are bound as a single typed array
+    r1 = add_multiple_selection_constraint(colname, v1)
+    r2 = add_multiple_selection_constraint(colname, v2)
     r3 = add_multiple_selection_constraint(colname, v3)
 
-    assert r3 == """ AND TestCol IN ('Sample1','Sample2','Sample3')"""
+    assert r1 == (""" AND TestCol = ANY(%s)""", [[123, 147, 158]])
+    assert r2 == (""" AND TestCol = ANY(%s)""", [[123, 146, 1231]])
+    assert r3 == (""" AND TestCol = ANY(%s)""",
+                  [["Sample1", "Sample2", "Sample3"]])
 
-    assert_raises(TypeError, add_multiple_selection_constraint, colname, v1)
-    assert_raises(TypeError, add_multiple_selection_constraint, colname, v2)
     assert_raises(TypeError, add_multiple_selection_constraint, colname, v4)
 
+    r4 = add_multiple_exclusion_constraint(colname, v3)
+    assert r4 == (""" AND TestCol != ALL(%s)""",
+                  [["Sample1", "Sample2", "Sample3"]])
+
+
+def test_filter_table_constraint():
+
+    gxps = ["GXP%04d" % i for i in range(500)]
+
+    # Large filter sets are joined against a temporary table
+    r1 = add_multiple_selection_constraint("Node", gxps)
+    assert r1 == (""" AND Node IN (SELECT value FROM %s)""",
+                  [FilterTable(gxps)])
+
+    r2 = add_multiple_exclusion_constraint("Node", gxps)
+    assert r2[0] == (""" AND NOT EXISTS (SELECT 1 FROM %s AS f """
+                     """WHERE f.value = Node)""")
+
+    # Named after the values, whatever their order
+    table = r1[1][0]
+    assert table.name == FilterTable(reversed(gxps)).name
+    assert table.name != FilterTable(gxps[1:]).name
+    assert table.sql_type == "text"
+    assert FilterTable(range(200)).sql_type == "bigint"
+
+    # The threshold is passed in, the config is not read
+    r3 = add_multiple_selection_constraint("Node", gxps[:3], threshold=2)
+    assert r3[1] == [FilterTable(gxps[:3])]
+    assert add_multiple_selection_constraint("Node", gxps,
+                                             threshold=500)[1] == [gxps]
+
+
+def test_add_constraints():
+
+    query = ("SELECT * FROM nodal_prices_2014 WHERE Trading_date = %s",
+             [date(2014, 8, 13)])
+
+    r1 = add_constraints(query, [add_equality_constraint("Node", "OTA2201"),
+                                 add_range_constraint("Trading_period", 1,
+                                                      10)])
+    assert r1 == ("SELECT * FROM nodal_prices_2014 WHERE Trading_date = %s "
+                  "AND Node = %s AND Trading_period BETWEEN %s AND %s",
+                  [date(2014, 8, 13), "OTA2201", 1, 10])
+
+    # The original query is left untouched
+    assert query[1] == [date(2014, 8, 13)]
+
+
+def test_select_columns():
+
+    assert select_columns() == "*"
+    assert select_columns(["band1_price", "band1_power"]) == \
+        "band1_price, band1_power"
+
+
+def test_create_date_limited_sql_columns():
+
+    r1 = create_date_limited_sql("energy_offers", dates="13/08/2014",
+                                 columns=["Company", "band1_price"])
+    assert r1 == [("SELECT Company, band1_price FROM energy_offers_2014 "
+                   "WHERE trading_date = %s", [date(2014, 8, 13)])]
+
+    r2 = create_date_limited_sql("nodal_prices", begin_date="01/12/2013",
+                                 end_date="31/01/2014",
+                                 date_col="Trading_date", columns=["price"])
+    assert r2 == [("SELECT price FROM nodal_prices_2013 WHERE Trading_date "
+                   "BETWEEN %s AND %s", [date(2013, 12, 1),
+                                         date(2013, 12, 31)]),
+                  ("SELECT price FROM nodal_prices_2014 WHERE Trading_date "
+                   "BETWEEN %s AND %s", [date(2014, 1, 1),
+                                         date(2014, 1, 31)])]
+
+    assert_raises(ValueError, create_date_limited_sql, "energy_offers",
+                  dates="13/08/2014", columns=["band6_price"])
+
+
+def test_add_aggregation():
+
+    sql = "SELECT * FROM nodal_prices_2014 WHERE Node='OTA2201';"
+
+    r1 = add_aggregation(sql, "Price", ["mean"], freq="D", group_by=["Node"],
+                         date_col="Trading_date")
+    assert r1 == ("SELECT date_trunc('day', Trading_date)::date AS "
+                  "Trading_date, Node, count(Price) AS Price__count, "
+                  "sum(Price) AS Price__sum FROM (SELECT * FROM "
+                  "nodal_prices_2014 WHERE Node='OTA2201') AS shard "
+                  "GROUP BY 1, 2")
+
+    r2 = add_aggregation(sql, "Price", ["max"], group_by=["Node"])
+    assert r2 == ("SELECT Node, max(Price) AS Price__max FROM (SELECT * FROM "
+                  "nodal_prices_2014 WHERE Node='OTA2201') AS shard "
+                  "GROUP BY 1")
+
+    assert_raises(ValueError, add_aggregation, sql, "Price", ["mean"],
+                  freq="Fortnight")
+    assert_raises(ValueError, add_aggregation, sql, "Price", ["median"],
+                  freq="D")
+    assert_raises(ValueError, add_aggregation, sql, "Price", ["mean"])
+
+    # The parameters of a query are carried through
+    r3 = add_aggregation(("SELECT * FROM nodal_prices_2014 WHERE Node = %s",
+                          ["OTA2201"]), "Price", ["max"], group_by=["Node"])
+    assert r3 == ("SELECT Node, max(Price) AS Price__max FROM (SELECT * FROM "
+                  "nodal_prices_2014 WHERE Node = %s) AS shard GROUP BY 1",
+                  ["OTA2201"])
+
+
+def test_date_list_constraint():
+
+    days = [datetime(2014, 1, d) for d in (1, 2, 3, 4, 9, 7, 2)]
+    r1 = date_list_constraint("trading_date", days)
+    assert r1 == ("(trading_date BETWEEN %s AND %s OR "
+                  "trading_date = ANY(%s))",
+                  [date(2014, 1, 1), date(2014, 1, 4),
+                   [date(2014, 1, 7), date(2014, 1, 9)]])
+
+    # Sparse dates are bound as a single array however many there are
+    sparse = [datetime(2014, 1, 1) + timedelta(days=2 * i)
+              for i in range(20)]
+    r2 = date_list_constraint("trading_date", sparse)
+    assert r2[0] == "trading_date = ANY(%s)"
+    assert len(r2[1][0]) == 20
+
+    r3 = singular_sql_dates("nodal_prices", ["01/01/2014", "02/01/2014",
+                                             "03/01/2014"], "trading_date")
+    assert list(r3) == [(" SELECT * FROM nodal_prices_2014 WHERE "
+                         "trading_date BETWEEN %s AND %s",
+                         [date(2014, 1, 1), date(2014, 1, 3)])]
+
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,81 @@
+from lode.database.rollups import (create_rollup_sql, merge_ranges,
+                                   period_bounds, rollup_granularity,
+                                   rollup_sql)
+from datetime import datetime, date
+
+
+def test_create_rollup_sql():
+
+    sql = create_rollup_sql("nodal_demand", "daily")
+    assert sql.startswith("CREATE TABLE IF NOT EXISTS nodal_demand_daily")
+    assert "Demand__count bigint" in sql
+    assert "Demand__wsum" not in sql
+    assert "UNIQUE(Trading_date, Node, Island)" in sql
+
+    assert "Price__wsum double precision" in create_rollup_sql(
+        "nodal_prices", "monthly")
+
+
+def test_period_bounds():
+
+    begin, end = datetime(2014, 1, 15), datetime(2014, 2, 3)
+
+    assert period_bounds("weekly", begin, end) == (datetime(2014, 1, 13),
+                                                   datetime(2014, 2, 9))
+    assert period_bounds("monthly", begin, end) == (datetime(2014, 1, 1),
+                                                    datetime(2014, 2, 28))
+    assert period_bounds("daily", begin, end) == (begin, end)
+
+
+def test_merge_ranges():
+
+    ranges = [(date(2014, 3, 1), date(2014, 3, 31)),
+              (date(2014, 1, 1), date(2014, 1, 31)),
+              (date(2014, 2, 1), date(2014, 2, 10)),
+              (date(2014, 1, 5), date(2014, 1, 6))]
+    assert merge_ranges(ranges) == [(date(2014, 1, 1), date(2014, 2, 10)),
+                                    (date(2014, 3, 1), date(2014, 3, 31))]
+    assert merge_ranges([]) == []
+
+
+def test_rollup_granularity():
+
+    months = (datetime(2014, 1, 1), datetime(2014, 3, 31))
+    weeks = (datetime(2014, 1, 13), datetime(2014, 1, 26))
+
+    assert rollup_granularity("M", *months) == "monthly"
+    assert rollup_granularity("D", *months) == "daily"
+    assert rollup_granularity("W", *weeks) == "weekly"
+    assert rollup_granularity("M", *weeks) == "daily"
+    assert rollup_granularity("M") == "daily"
+
+
+def test_rollup_sql():
+
+    sql = rollup_sql("nodal_prices", ["mean"], freq="M",
+                     begin_date="01/01/2014", end_date="31/03/2014",
+                     nodes=["OTA2201"])
+    assert sql == ("SELECT date_trunc('month', Trading_date)::date AS "
+                   "Trading_date, Node, sum(Price__count) AS Price__count, "
+                   "sum(Price__sum) AS Price__sum FROM (SELECT * FROM "
+                   "nodal_prices_monthly WHERE Trading_date BETWEEN %s AND "
+                   "%s AND Node = ANY(%s)) AS rollup GROUP BY 1, 2",
+                   [date(2014, 1, 1), date(2014, 3, 31), ["OTA2201"]])
+
+    # Columns and aggregations the rollups do not hold fall back to the
+    # half hourly data
+    assert rollup_sql("nodal_prices", ["mean"], group_by=["Trading_period"],
+                      dates="13/08/2014") is None
+    assert rollup_sql("nodal_demand", ["weighted"], freq="D",
+                      dates="13/08/2014") is None
+
+    # An empty group_by totals every node
+    sql, _ = rollup_sql("nodal_demand", ["sum"], freq="M", group_by=[],
+                        begin_date="01/01/2014", end_date="31/03/2014")
+    assert sql.startswith("SELECT date_trunc('month', Trading_date)::date "
+                          "AS Trading_date, sum(Demand__sum)")
+    assert sql.endswith("GROUP BY 1")
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,21 @@
+from lode.database.schemas import schema_columns, validate_columns
+from nose.tools import assert_raises
+
+
+def test_schema_columns():
+
+    columns = schema_columns("nodal_prices")
+    assert columns == ["nodal_prices_key", "trading_date", "trading_period",
+                       "node", "price"]
+
+    offer_columns = schema_columns("energy_offers")
+    assert len(offer_columns) == 22
+    assert "unique" not in offer_columns
+
+    assert_raises(ValueError, schema_columns, "not_a_table")
+
+
+def test_validate_columns():
+
+    validate_columns("nodal_demand", ["Node", "demand"])
+    assert_raises(ValueError, validate_columns, "nodal_demand", ["price"])
@@ -0,0 +1,83 @@
+import datetime
+from cStringIO import StringIO
+import numpy as np
+import pandas as pd
+
+from lode.database.utilities import (list_databases, parse_copy_csv,
+                                     compact_frame, share_categories,
+                                     split_query, numbered_placeholders)
+
+
+def test_list_databases():
+
+    # Numeric settings at the top level of the config are not databases
+    databases = list_databases()
+    assert 'offer_database' in databases
+    assert 'query_cache_max_bytes' not in databases
+
+
+def test_parse_copy_csv():
+
+    buf = StringIO('OTA2201,2014-08-13,1,65.5,t,\\N\n'
+                   'BEN2201,2014-08-14,2,\\N,f,""\n'
+                   '\\N,\\N,3,1e-05,\\N,"a,b"\n')
+    columns = ["node", "trading_date", "trading_period", "price", "flag",
+               "note"]
+    types = [1043, 1082, 23, 701, 16, 25]
+
+    df = parse_copy_csv(buf, columns, types)
+    assert list(df.columns) == columns
+    assert list(df.node) == ["OTA2201", "BEN2201", None]
+    assert list(df.trading_date) == [datetime.date(2014, 8, 13),
+                                     datetime.date(2014, 8, 14), None]
+    assert list(df.trading_period) == [1, 2, 3]
+    assert df.price[0] == 65.5 and df.price[2] == 1e-05
+    assert df.price.isnull()[1]
+    assert list(df.flag) == [True, False, None]
+
+    # Empty strings are not nulls
+    assert list(df.note) == [None, "", "a,b"]
+
+
+def test_parse_copy_csv_empty():
+
+    df = parse_copy_csv(StringIO(""), ["node"], [1043])
+    assert list(df.columns) == ["node"] and len(df) == 0
+
+
+def test_compact_frame():
+
+    df = pd.DataFrame({"trading_date": [datetime.date(2014, 8, 13)] * 3,
+                       "trading_period": [1, 2, 48],
+                       "node": ["OTA2201", "BEN2201", "OTA2201"],
+                       "price": [65.5, 70.25, 81.0]})
+
+    compact = compact_frame(df.copy())
+    assert str(compact.node.dtype) == "category"
+    assert compact.trading_period.dtype == np.int8
+    assert compact.trading_date.dtype == "datetime64[ns]"
+    assert compact.price.dtype == np.float64
+
+    assert compact_frame(df.copy(), float32=True).price.dtype == np.float32
+
+
+def test_share_categories():
+
+    first = compact_frame(pd.DataFrame({"node": ["OTA2201", "BEN2201"]}))
+    second = compact_frame(pd.DataFrame({"node": ["HAY2201"]}))
+
+    joined = pd.concat(share_categories([first, second]), ignore_index=True)
+    assert str(joined.node.dtype) == "category"
+    assert list(joined.node.cat.categories) == ["BEN2201", "HAY2201",
+                                                "OTA2201"]
+
+
+def test_split_query():
+
+    assert split_query("SELECT 1") == ("SELECT 1", None)
+    assert split_query(("SELECT %s", (1,))) == ("SELECT %s", [1])
+    assert split_query(("SELECT 1", [])) == ("SELECT 1", None)
+
+    sql = "SELECT * FROM t WHERE a = %s AND b LIKE 'x%%' AND c = ANY(%s);"
+    assert numbered_placeholders(sql) == ("SELECT * FROM t WHERE a = $1 AND "
+                                          "b LIKE 'x%' AND c = ANY($2);")
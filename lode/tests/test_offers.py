@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+from lode.offers import band_slots, stack_bands, supply_curves
+
+
+def energy_offers():
+    offers = pd.DataFrame({"station": ["GLN", "HLY"],
+                           "trading_period": [1, 1]})
+    for band in range(1, 6):
+        offers["band%s_power" % band] = [55. if band == 1 else 0.,
+                                         10. * band]
+        offers["band%s_price" % band] = [0., 20. * band]
+    return offers
+
+
+def test_band_slots():
+
+    slots = band_slots(["company", "band1_plsr_6s_price",
+                        "band1_plsr_6s_max", "band1_plsr_6s_percent",
+                        "band1_twdsr_60s_max", "band2_6s_price"])
+    assert [(s.band, s.product, s.reserve_type) for s in slots] == [
+        (1, "PLSR", "FIR"), (1, "TWDSR", "SIR"), (2, "IL", "FIR")]
+    assert slots[0].columns == {"price": "band1_plsr_6s_price",
+                                "quantity": "band1_plsr_6s_max",
+                                "percent": "band1_plsr_6s_percent"}
+
+    assert [s.product for s in band_slots(["Band1_Power"])] == ["Energy"]
+
+
+def test_stack_energy_bands():
+
+    stacked = stack_bands(energy_offers())
+    assert list(stacked.columns) == ["station", "trading_period", "band",
+                                     "price", "quantity"]
+
+    # The unused bands of the first offer are dropped
+    assert list(stacked["station"]) == ["GLN"] + ["HLY"] * 5
+    assert list(stacked["band"]) == [1, 1, 2, 3, 4, 5]
+    assert list(stacked["quantity"]) == [55., 10., 20., 30., 40., 50.]
+    assert list(stacked["price"]) == [0., 20., 40., 60., 80., 100.]
+
+    assert len(stack_bands(energy_offers(), drop_empty=False)) == 10
+    assert stack_bands(energy_offers(),
+                       float32=True)["price"].dtype == np.float32
+
+
+def test_stack_reserve_bands():
+
+    offers = pd.DataFrame({"company": ["MRPL"],
+                           "band1_plsr_6s_price": [1.],
+                           "band1_plsr_6s_max": [5.],
+                           "band1_plsr_6s_percent": [10.],
+                           "band1_twdsr_60s_price": [2.],
+                           "band1_twdsr_60s_max": [6.]})
+
+    stacked = stack_bands(offers)
+    assert list(stacked["product"]) == ["PLSR", "TWDSR"]
+    assert list(stacked["reserve_type"]) == ["FIR", "SIR"]
+    assert list(stacked["quantity"]) == [5., 6.]
+    assert stacked["percent"][0] == 10. and np.isnan(stacked["percent"][1])
+
+
+def test_supply_curves():
+
+    offers = energy_offers()
+    offers = pd.concat([offers, offers.assign(trading_period=2)],
+                       ignore_index=True)
+    offers.loc[offers["trading_period"] == 2, "band1_price"] += 500.
+
+    curves = supply_curves(offers, keys=["trading_period"])
+    assert len(curves) == 2
+    assert list(curves.totals) == [205., 205.]
+
+    # Period 1 merit order: GLN 55 @ 0, HLY 10 @ 20, 20 @ 40, 30 @ 60 ...
+    # Period 2: HLY 20 @ 40, 30 @ 60, 40 @ 80, 50 @ 100, GLN 55 @ 500 ...
+    assert list(curves.price_at([55., 55.])) == [0., 80.]
+    assert list(curves.price_at(pd.Series([65., 140.], index=[1, 2]))) \
+        == [20., 100.]
+    assert np.isnan(curves.price_at(206.)).all()
+
+    assert list(curves.quantity_at(20.)) == [65., 0.]
+    assert list(curves.quantity_at([-1., 1e6])) == [0., 205.]
+    assert list(curves.quantity_at([-np.inf, np.inf])) == [0., 205.]
+    assert list(curves.quantity_at(1e300)) == [205., 205.]
+    assert np.isnan(curves.price_at(np.inf)).all()
+    assert list(curves.price_at(-np.inf)) == [0., 40.]
+
+    marginal = curves.marginal_offers([56., 30.])
+    assert list(marginal.index) == [1, 2]
+    assert list(marginal["station"]) == ["HLY", "HLY"]
+    assert list(marginal["band"]) == [1, 3]
+
+    # Band level offers give the same curves
+    stacked = supply_curves(stack_bands(offers), keys=["trading_period"])
+    assert list(stacked.price_at(100.)) == list(curves.price_at(100.))
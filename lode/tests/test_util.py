@@ -82,3 +82,62 @@ def test_create_timestamp():
 
     assert ro1 == datetime.datetime(2014, 5, 24, 16, 30)
     assert ro2 == datetime.datetime(2014, 5, 24, 16, 15)
+
+
+def test_daylight_saving_days():
+
+    assert util.dst_start(2014) == datetime.date(2014, 9, 28)
+    assert util.dst_end(2014) == datetime.date(2014, 4, 6)
+    assert util.dst_start(2006) == datetime.date(2006, 10, 1)
+    assert util.dst_end(2007) == datetime.date(2007, 3, 18)
+
+    # Periods which do not exist on the short day are rejected
+    assert_raises(ValueError, util.create_timestamp,
+                  (datetime.date(2014, 9, 28), 47))
+    r1 = util.create_timestamp((datetime.date(2014, 9, 28), 5))
+    r2 = util.create_timestamp((datetime.date(2014, 4, 6), 50))
+
+    assert r1 == datetime.datetime(2014, 9, 28, 3, 0)
+    assert r2 == datetime.datetime(2014, 4, 6, 23, 30)
+
+
+def test_periods_to_timestamps():
+
+    dates = ["2014-05-24", "2014-09-28", "2014-09-28", "2014-04-06",
+             "2014-04-06", "2014-05-24"]
+    periods = [33, 4, 5, 5, 7, 49]
+
+    r1 = util.periods_to_timestamps(dates, periods)
+
+    assert r1[0] == datetime.datetime(2014, 5, 24, 16, 0)
+    assert r1[1] == datetime.datetime(2014, 9, 28, 1, 30)
+    assert r1[2] == datetime.datetime(2014, 9, 28, 3, 0)
+    # The hour from 2am is repeated when daylight saving ends
+    assert r1[3] == datetime.datetime(2014, 4, 6, 2, 0)
+    assert r1[4] == datetime.datetime(2014, 4, 6, 2, 0)
+    # No period 49 on a normal day
+    assert r1.isnull()[5]
+
+    r2 = util.periods_to_timestamps(dates[3:5], periods[3:5], tz="UTC")
+    assert (r2[1] - r2[0]) == datetime.timedelta(hours=1)
+
+    # Agrees with the scalar conversion
+    assert r1[0] == util.create_timestamp(("20140524", 33))
+
+
+def test_parse_dates():
+
+    dates = ["15/01/2008", 20080115, "15-01-2008", "2008-01-15",
+             datetime.date(2008, 1, 15), "15 January 2008", "15/01/2008"]
+
+    parsed = util.parse_dates(dates)
+
+    assert parsed == [datetime.datetime(2008, 1, 15)] * len(dates)
+
+    # Many distinct dates are parsed in bulk
+    days = [datetime.date(2008, 1, 1) + datetime.timedelta(days=i)
+            for i in range(500)]
+    strings = [d.strftime("%d/%m/%Y") for d in days]
+    assert util.parse_dates(strings) == util.parse_dates(days)
+
+    assert_raises(ValueError, util.parse_dates, ["not a date"])
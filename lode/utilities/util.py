@@ -1,5 +1,8 @@
 import datetime
+# Imported up front as strptime is not thread safe on its first use
+import _strptime
 import pandas
+import numpy as np
 from dateutil.parser import parse
 import simplejson
 import os
@@ -13,22 +16,111 @@ config_name = os.path.join(module_path, 'config.json')
 # Meta information is located here
 meta_path = os.path.join(module_path, "static/nodal_metadata.csv")
 
+# Years covered by the daylight saving calendar
+calendar_years = (1990, 2040)
+
+# Formats tried before falling back to dateutil, the market data is day
+# first while ISO dates are year first, which dateutil would get wrong
+date_formats = ("%d/%m/%Y", "%Y%m%d", "%d-%m-%Y", "%Y-%m-%d")
+
+# Below this many distinct strings strptime is faster than pandas
+bulk_parse_size = 100
+
+# Strings which have been parsed, cleared when it grows past the maximum
+_parsed_dates = {}
+max_parsed_dates = 100000
+
+# New Zealand standard and daylight time as minutes ahead of UTC
+NZST, NZDT = 12 * 60, 13 * 60
+
+# The daylight saving calendar, built on first use
+_dst_calendar = {}
+
 
 def parse_date(x, dayfirst=True):
+    """ Parse a single date, see parse_dates """
+    return parse_dates([x], dayfirst=dayfirst)[0]
+
+
+def parse_dates(values, dayfirst=True):
+    """
+    Parse many dates at once. Strings are tried against the fixed
+    date_formats first, falling back to dateutil for anything else, and
+    each distinct string is only parsed once.
+
+    Parameters:
+    -----------
+    values: Iterable of date strings, ints (e.g. 20140524), dates or
+            datetimes, in any mix
+    dayfirst: Whether ambiguous dates are day first, e.g. 03/04/2014 is the
+              3rd of April
+
+    Returns:
+    --------
+    list: The datetime of each value in the same order
+    """
+    parsed, pending = [], {}
+    for position, x in enumerate(values):
+        if isinstance(x, datetime.datetime):
+            parsed.append(x)
+            continue
+        elif isinstance(x, datetime.date):
+            # Upcast to a datetime object
+            parsed.append(datetime.datetime.fromordinal(x.toordinal()))
+            continue
+        elif isinstance(x, np.datetime64):
+            parsed.append(pandas.Timestamp(x).to_pydatetime())
+            continue
+
+        # Sometimes dates are ints for weird reasons which fails with parse
+        if isinstance(x, (int, long, np.integer)):
+            x = str(x)
+
+        parsed.append(_parsed_dates.get((x, dayfirst)))
+        if parsed[-1] is None:
+            pending.setdefault(x, []).append(position)
 
-    allowable_dates = (datetime.datetime, pandas.tslib.Timestamp,
-                       datetime.date)
-    if type(x) in allowable_dates:
-        # Upcast to a datetime object
-        if type(x) == datetime.date:
-            return datetime.datetime.fromordinal(x.toordinal())
-        return x
+    if pending:
+        if len(_parsed_dates) + len(pending) > max_parsed_dates:
+            _parsed_dates.clear()
 
-    # Sometimes dates are ints for weird reasons which fails with parse
-    if type(x) == int:
-        x = str(x)
+        for x, dt in _parse_strings(list(pending), dayfirst).iteritems():
+            _parsed_dates[(x, dayfirst)] = dt
+            for position in pending[x]:
+                parsed[position] = dt
 
-    return parse(x, dayfirst=True)
+    return parsed
+
+
+def _parse_strings(strings, dayfirst):
+    """ Parse distinct date strings with the fixed formats, in bulk through
+    pandas for many strings, then dateutil for those which did not match
+    """
+    formats = [f for f in date_formats if dayfirst or f.startswith("%Y")]
+    parsed = {}
+    if len(strings) >= bulk_parse_size:
+        remaining = pandas.Series(strings)
+        for fmt in formats:
+            matched = pandas.to_datetime(remaining, format=fmt,
+                                         errors='coerce')
+            found = matched.notnull()
+            parsed.update(zip(remaining[found],
+                              matched[found].dt.to_pydatetime()))
+            remaining = remaining[~found]
+
+        strings = list(remaining)
+
+    for x in strings:
+        for fmt in formats:
+            try:
+                parsed[x] = datetime.datetime.strptime(x, fmt)
+                break
+            except (TypeError, ValueError):
+                continue
+        else:
+            parsed[x] = parse(x, dayfirst=dayfirst)
+
+    return parsed
 
 
 def load_config(config_name=config_name):
@@ -71,13 +163,156 @@ def create_timestamp(x, offset=30):
         tpid = int(x)
         parsed_date, period = parse_date(tpid / 100), tpid % 100
 
-    # Fucking daylight saving
-    if period > 48:
-        period = 1
+    # Daylight saving days have 46 or 50 periods so use the calendar
+    calendar = dst_calendar()
+    index = (parsed_date.date() - calendar["first"].astype(object)).days
+    if not 0 <= index < len(calendar["periods"]):
+        raise ValueError("Dates must be between %s and %s" % calendar_years)
+
+    if not 1 <= period <= calendar["periods"][index]:
+        raise ValueError("%s does not have a trading period %s" % (
+            parsed_date.date(), period))
 
     # Minutes for the end of the trading period
     minutes = period * 30 - offset
 
-    # Create the timestamp
+    # Clock time moves by an hour part way through the daylight saving days
+    if minutes >= calendar["change"][index]:
+        minutes += calendar["after"][index] - calendar["midnight"][index]
+
+    return parsed_date + datetime.timedelta(minutes=int(minutes))
+
+
+def nth_sunday(year, month, n):
+    """ The nth Sunday of a month, or the last Sunday if n is -1 """
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(6 - first.weekday()) % 7 +
+                                          7 * (n - 1))
+
+    following = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last = following - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() + 1) % 7)
+
+
+def dst_start(year):
+    """ The day daylight saving starts, clocks go forward at 2am NZST """
+    if year <= 2006:
+        return nth_sunday(year, 10, 1)
+    return nth_sunday(year, 9, -1)
+
+
+def dst_end(year):
+    """ The day daylight saving ends, clocks go back at 3am NZDT """
+    if year <= 2007:
+        return nth_sunday(year, 3, 3)
+    return nth_sunday(year, 4, 1)
+
+
+def dst_calendar():
+    """
+    The trading period calendar of each day from 1990 to 2040 under the New
+    Zealand daylight saving rules, built once and then reused.
+
+    Returns:
+    --------
+    dict: numpy arrays indexed by days since the first day of the calendar
+          of, the number of trading periods in the day (46, 48 or 50), the
+          UTC offset in minutes at midnight, the minutes after midnight at
+          which the clocks change and the UTC offset afterwards
+    """
+    if _dst_calendar:
+        return _dst_calendar
+
+    first = datetime.date(calendar_years[0], 1, 1)
+    days = (datetime.date(calendar_years[1], 12, 31) - first).days + 1
+
+    periods = np.full(days, 48, dtype=np.int64)
+    midnight = np.full(days, NZST, dtype=np.int64)
+    change = np.full(days, 24 * 60, dtype=np.int64)
+    after = np.full(days, NZST, dtype=np.int64)
+
+    for year in range(calendar_years[0], calendar_years[1] + 1):
+        start = (dst_start(year) - first).days
+        end = (dst_end(year) - first).days
+        year_end = (datetime.date(year, 12, 31) - first).days
+
+        # Daylight time from the day after it starts through to the day it
+        # ends, midnight of the last day is still daylight time
+        midnight[start + 1:year_end + 1] = NZDT
+        midnight[(datetime.date(year, 1, 1) - first).days:end + 1] = NZDT
+
+        periods[start], change[start] = 46, 2 * 60
+        periods[end], change[end] = 50, 3 * 60
+
+    after[:] = midnight
+    after[periods == 46] = NZDT
+    after[periods == 50] = NZST
+
+    _dst_calendar.update({"first": np.datetime64(first, 'D'),
+                          "periods": periods, "midnight": midnight,
+                          "change": change, "after": after})
+    return _dst_calendar
+
+
+def periods_to_timestamps(dates, periods, offset=30, tz=None):
+    """
+    Convert whole columns of trading dates and periods to timestamps at
+    once, using the daylight saving calendar so that the 46 and 50 period
+    days are handled correctly.
+
+    Parameters:
+    -----------
+    dates: Array like of trading dates, e.g. a DataFrame column
+    periods: Array like of trading periods, the same length as dates
+    offset: Minutes before the end of the period, 30 gives the start of the
+            period and 0 the end, as for create_timestamp
+    tz: If None the local New Zealand clock time is returned, note that the
+        hour repeated when daylight saving ends appears twice. Otherwise
+        timezone aware timestamps in tz, e.g. "UTC", which are unambiguous
+
+    Returns:
+    --------
+    DatetimeIndex: The timestamps, NaT where a period does not exist on
+                   the day, e.g. period 49 on a 48 period day
+    """
+    calendar = dst_calendar()
+
+    dates = np.asarray(dates)
+    if dates.dtype.kind != 'M':
+        # Parse each distinct date once, there are few compared to rows
+        codes, uniques = pandas.factorize(dates)
+        parsed = pandas.to_datetime(uniques).values.astype('datetime64[D]')
+        dates = np.where(codes >= 0, parsed.take(codes),
+                         np.datetime64('NaT'))
+    dates = dates.astype('datetime64[D]')
+
+    index = (dates - calendar["first"]).astype(np.int64)
+    missing = np.isnat(dates)
+    if ((index < 0) | (index >= len(calendar["periods"])))[~missing].any():
+        raise ValueError("Dates must be between %s and %s" % calendar_years)
+    index = np.where(missing, 0, index)
+
+    periods = np.asarray(periods, dtype=np.float64)
+    minutes = periods * 30 - offset
+    valid = (~missing & (periods >= 1) &
+             (periods <= calendar["periods"][index]))
+
+    # The clocks change part way through the daylight saving days
+    utc_offset = np.where(minutes >= calendar["change"][index],
+                          calendar["after"][index],
+                          calendar["midnight"][index])
+
+    midnight = dates.astype('datetime64[m]').astype(np.int64)
+    utc = midnight - calendar["midnight"][index] + minutes
+    local = np.where(valid, utc + utc_offset if tz is None else utc, 0)
+
+    stamps = local.astype(np.int64).astype('datetime64[m]')
+    stamps = stamps.astype('datetime64[ns]')
+    stamps[~valid] = np.datetime64('NaT')
+
+    timestamps = pandas.DatetimeIndex(stamps)
+    if tz is not None:
+        timestamps = timestamps.tz_localize('UTC').tz_convert(tz)
 
-    return parsed_date + datetime.timedelta(minutes=minutes)
+    return timestamps